@@ -1,49 +1,156 @@
-# Example of to to load test an Agentless scanner by repeatedly sending a file
-# for scanning and then printing a summary of the results to the console
+# Example of to to load test an Agentless scanner by sending files for scanning
+# and then printing a summary of the results to the console
 #
-# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S 
-# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW, 
-# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS, 
-# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY 
-# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR 
-# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE 
-# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS, 
-# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, 
-# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY, 
+# Scans are sent by a pool of concurrent workers, either as fast as the workers
+# allow (closed loop, target_scans_per_second = 0) or at a fixed target rate
+# regardless of how quickly the scanner responds (open loop). In open loop mode
+# latency is measured from the time each scan was scheduled to be sent, so that
+# queueing caused by a saturated scanner is included in the results. Scans which
+# start during the warm-up period are sent but excluded from the results.
+#
+# The summary is written to a JSON file per run and appended as one row to a CSV
+# file, so that results of successive runs can be compared over time.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
 # FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
 #
 #
 
-import deepinstinctagentless as di, time, json
+import deepinstinctagentless as di, time, json, datetime, csv, os, threading, collections, concurrent.futures
 
 #CONFIGURATION
-scanner_ip = '192.168.0.50'
-file_to_scan = 'example.pdf'
+scanner_ips = ['192.168.0.50'] #scans are distributed round-robin across these scanners
+files_to_scan = ['example.pdf'] #corpus of files, sent in rotation
 number_of_scans = 5000
+concurrency = 8 #number of scans in flight at once
+target_scans_per_second = 0 #0 to send as fast as the workers allow (closed loop)
+warm_up_in_seconds = 10 #scans started in this period are excluded from the results
+results_json_file_name = f'agentless_load_test_{datetime.datetime.now().strftime("%Y-%m-%d_%H.%M")}.json'
+results_csv_file_name = 'agentless_load_test_history.csv' #one row appended per run
 
 # ESTABLISH VARIABLES
-start_time = time.perf_counter()
-n = 0
-total_scan_duration_in_microseconds = 0
-total_file_size_in_bytes = 0
+scanner = di.AgentlessScanner(scanner_ips, pool_size=concurrency)
+samples = []
+errors_by_class = collections.Counter()
+lock = threading.Lock()
+completed_count = 0
+
+# SEND ONE SCAN AND RECORD ITS MEASUREMENTS
+def run_scan(scan_number, scheduled_time):
+    global completed_count
+    file_name = files_to_scan[scan_number % len(files_to_scan)]
+    send_time = time.perf_counter()
+    try:
+        verdict = scanner.scan_file(file_name)
+        error_class = None if verdict is not None else 'UnexpectedResponseCode'
+    except Exception as e:
+        verdict = None
+        error_class = type(e).__name__
+    end_time = time.perf_counter()
+    if scheduled_time is None:
+        scheduled_time = send_time
+
+    with lock:
+        completed_count += 1
+        print('Completed scan', completed_count, 'of', number_of_scans, end='\r')
+        if send_time - start_time < warm_up_in_seconds:
+            return
+        if error_class is not None:
+            errors_by_class[error_class] += 1
+            return
+        samples.append({'latency_in_seconds': end_time - scheduled_time,
+                        'round_trip_in_seconds': end_time - send_time,
+                        'scan_duration_in_seconds': verdict['scan_duration_in_microseconds'] / 1000000,
+                        'file_size_in_bytes': verdict['file_size_in_bytes']})
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def summarize(values):
+    values = sorted(values)
+    return {'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': values[-1] if values else None,
+            'mean': sum(values) / len(values) if values else None}
 
 # EXECUTE THE SCANS
-while n < number_of_scans:
-    verdict = di.scan_file(file_to_scan, scanner_ip)
-    total_scan_duration_in_microseconds += verdict['scan_duration_in_microseconds']
-    total_file_size_in_bytes += verdict['file_size_in_bytes']
-    n += 1
-    print('Completed scan', n,'of',number_of_scans, end='\r')
+start_time = time.perf_counter()
+with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = []
+    for scan_number in range(number_of_scans):
+        if target_scans_per_second:
+            #open loop: submit each scan at its scheduled time, whether or not earlier scans have completed
+            scheduled_time = start_time + scan_number / target_scans_per_second
+            time.sleep(max(0, scheduled_time - time.perf_counter()))
+        else:
+            #closed loop: keep the workers busy, with latency measured from when a worker picks up the scan
+            scheduled_time = None
+        futures.append(executor.submit(run_scan, scan_number, scheduled_time))
+    concurrent.futures.wait(futures)
+runtime_in_seconds = time.perf_counter() - start_time
+scanner.close()
 
 # CALCULATE RESULTS
+measured_in_seconds = runtime_in_seconds - warm_up_in_seconds
+total_file_size_in_bytes = sum(sample['file_size_in_bytes'] for sample in samples)
+total_scan_duration_in_seconds = sum(sample['scan_duration_in_seconds'] for sample in samples)
+
 results = {}
-results['scan_count'] = n
-results['runtime_in_seconds'] = time.perf_counter() - start_time
-results['scan_time_in_seconds'] = total_scan_duration_in_microseconds / 1000000
+results['timestamp'] = datetime.datetime.now().isoformat(timespec='seconds')
+results['scanner_ips'] = ' '.join(scanner_ips)
+results['file_count'] = len(files_to_scan)
+results['concurrency'] = concurrency
+results['target_scans_per_second'] = target_scans_per_second
+results['warm_up_in_seconds'] = warm_up_in_seconds
+results['scan_count'] = completed_count
+results['measured_scan_count'] = len(samples)
+results['error_count'] = sum(errors_by_class.values())
+results['errors_by_class'] = dict(errors_by_class)
+results['runtime_in_seconds'] = runtime_in_seconds
+results['measured_runtime_in_seconds'] = measured_in_seconds
 results['scan_volume_in_megabytes'] = total_file_size_in_bytes / 1000000
-results['ratio_of_time_spent_scanning'] = results['scan_time_in_seconds'] / results['runtime_in_seconds']
-results['gross_throughput_in_megabytes_per_second'] = results['scan_volume_in_megabytes'] / results['scan_time_in_seconds']
-results['net_throughput_in_megabytes_per_second'] = results['scan_volume_in_megabytes'] / results['runtime_in_seconds']
+results['achieved_scans_per_second'] = len(samples) / measured_in_seconds if measured_in_seconds > 0 else None
+results['net_throughput_in_megabytes_per_second'] = results['scan_volume_in_megabytes'] / measured_in_seconds if measured_in_seconds > 0 else None
+results['gross_throughput_in_megabytes_per_second'] = results['scan_volume_in_megabytes'] / total_scan_duration_in_seconds if total_scan_duration_in_seconds else None
+results['latency_in_seconds'] = summarize([sample['latency_in_seconds'] for sample in samples])
+results['round_trip_in_seconds'] = summarize([sample['round_trip_in_seconds'] for sample in samples])
+results['scan_duration_in_seconds'] = summarize([sample['scan_duration_in_seconds'] for sample in samples])
+results['client_overhead_in_seconds'] = summarize([sample['round_trip_in_seconds'] - sample['scan_duration_in_seconds'] for sample in samples])
+
+if warm_up_in_seconds and measured_in_seconds <= 0:
+    print('\nWARNING: The run completed within the warm-up period, so no scans were measured. Reduce warm_up_in_seconds or increase number_of_scans.')
+
+# WRITE RESULTS TO DISK
+with open(results_json_file_name, 'w') as f:
+    json.dump(results, f, indent=4)
+
+csv_row = {}
+for field, value in results.items():
+    if isinstance(value, dict) and field != 'errors_by_class':
+        for statistic, statistic_value in value.items():
+            csv_row[f'{field}_{statistic}'] = statistic_value
+    elif field == 'errors_by_class':
+        csv_row[field] = json.dumps(value)
+    else:
+        csv_row[field] = value
+write_header = not os.path.exists(results_csv_file_name)
+with open(results_csv_file_name, 'a', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(csv_row.keys()))
+    if write_header:
+        writer.writeheader()
+    writer.writerow(csv_row)
 
 # PRINT RESULTS TO CONSOLE
 print('\n', json.dumps(results, indent=4))
+print('Results written to', results_json_file_name, 'and appended to', results_csv_file_name)
@@ -48,23 +48,16 @@ event_id_list = []
 for event in events:
     event_id_list.append(event['id'])
 
-#break event_id_list into a list of smaller lists
-batch_size = 250
-event_id_list_broken_into_batches = [event_id_list[i:i + batch_size] for i in range(0, len(event_id_list), batch_size)]
-
-#iterate through the batches of event ids and close (and optionally archive) them
-batch_number = 1
-for batch in event_id_list_broken_into_batches:
-
-    print('Processing batch', batch_number, 'of', len(event_id_list_broken_into_batches))
-
-    #close the events
-    print('  Closing', len(batch), 'events')
-    di.close_events(batch)
-
-    #Optionally uncomment the code below to archive the events (in addition to closing them)
-    #
-    #print('  Archiving', len(batch), 'events')
-    #di.archive_events(batch)
-
-    batch_number += 1
+#close the events (di.bulk_event_action sizes the batches automatically and
+#sends several of them to the server concurrently)
+print('Closing', len(event_id_list), 'events')
+results = di.bulk_event_action(event_id_list, 'close')
+if len(results['failed_ids']) > 0:
+    print('WARNING:', len(results['failed_ids']), 'events could not be closed:', results['failed_ids'])
+
+#Optionally uncomment the code below to archive the events (in addition to closing them)
+#
+#print('Archiving', len(event_id_list), 'events')
+#results = di.bulk_event_action(event_id_list, 'archive')
+#if len(results['failed_ids']) > 0:
+#    print('WARNING:', len(results['failed_ids']), 'events could not be archived:', results['failed_ids'])
@@ -15,7 +15,7 @@
 #
 
 #---import required libraries---
-import time, json, requests, datetime, deepinstinct30 as di
+import time, json, os, requests, datetime, deepinstinct3 as di
 from dateutil import parser
 
 #---configuration---
@@ -40,19 +40,26 @@ def send_to_slack(entry, simulate=False):
     else:
         requests.post(slack_webhook_url, json=slack_data, headers={'Content-Type': 'application/json'})
 
-# a method to read config from .conf file on disk
+# a method to read the audit log position (offset of the next entry and id of
+# the last entry sent) from .conf file on disk
 def get_config():
     try:
         with open(persistent_config_file_name, 'r') as f:
-            return int(f.read())
-    except OSError as e:
-        return 0
+            config = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        return {}
+    #earlier versions of this script stored only the id of the last entry sent
+    if isinstance(config, int):
+        return {'last_id': config}
+    return config
 
-# a method to write config to .conf file on disk
-def save_config(offset):
+# a method to write the audit log position to .conf file on disk, replacing the
+# previous file in one step so that it is never left partially written
+def save_config(cursor):
     try:
-        with open(persistent_config_file_name, 'w') as f:
-            f.write(str(offset))
+        with open(persistent_config_file_name + '.tmp', 'w') as f:
+            f.write(json.dumps(cursor))
+        os.replace(persistent_config_file_name + '.tmp', persistent_config_file_name)
     except OSError as e:
         now = datetime.datetime.now()
         print(now.strftime("%H:%M"), 'ERROR:', e)
@@ -60,21 +67,12 @@ def save_config(offset):
 
 #---runtime---
 while True:
-    offset = get_config()
-    print('Getting new entries with id greater than', offset)
+    cursor = get_config()
+    print('Getting new entries with id greater than', cursor.get('last_id', 0))
 
+    entry_count = 0
     try:
-        new_entries = di.get_audit_log(offset=offset, categories=categories)
-    except requests.exceptions.RequestException as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
-        new_entries = []
-
-    print(len(new_entries), 'items were returned')
-
-    if len(new_entries) > 0:
-
-        for entry in new_entries:
+        for entry in di.iter_audit_log(cursor=cursor, categories=categories):
             print('Sending entry', entry['id'], 'to Slack')
             try:
                 send_to_slack(entry)
@@ -82,11 +80,17 @@ while True:
             except requests.exceptions.RequestException as e:
                 now = datetime.datetime.now()
                 print(now.strftime("%H:%M"), 'ERROR:', e)
-            if entry['id'] > offset:
-                offset = entry['id']
+            entry_count += 1
+            save_config(cursor)
+    except requests.exceptions.RequestException as e:
+        now = datetime.datetime.now()
+        print(now.strftime("%H:%M"), 'ERROR:', e)
+
+    #also record entries read but skipped because of their category
+    save_config(cursor)
 
-        print('Highest Audit Log Entry ID is now', offset)
-        save_config(offset)
+    print(entry_count, 'items were returned')
+    print('Highest Audit Log Entry ID is now', cursor.get('last_id', 0))
 
     print('Sleeping for', sleep_time_in_seconds, 'seconds')
     time.sleep(sleep_time_in_seconds)
@@ -82,39 +82,30 @@ def main():
             unarchive_events = False
 
 
-    #break event_id_list into a list of smaller lists
-    batch_size = 250
-    event_id_list_broken_into_batches = [event_id_list[i:i + batch_size] for i in range(0, len(event_id_list), batch_size)]
-    print('\nINFO: The', len(event_id_list), 'event IDs have been broken into', len(event_id_list_broken_into_batches), 'batches of', batch_size)
-
-    #iterate through the batches of event ids
-    batch_number = 1
-    for batch in event_id_list_broken_into_batches:
-        print('Processing batch', batch_number, 'of', len(event_id_list_broken_into_batches))
-
-        if close_events:
-            print('  Closing', len(batch), 'events')
-            di.close_events(batch)
-
-        if archive_events:
-            print('  Archiving', len(batch), 'events')
-            di.archive_events(batch)
-
-        if open_events:
-            print('  Opening', len(batch), 'events')
-            di.open_events(batch)
-
-        if unarchive_events:
-            print('  Unarchiving', len(batch), 'events')
-            di.unarchive_events(batch)
-
-        batch_number += 1
+    #apply the selected actions to all event ids (di.bulk_event_action sizes the
+    #batches automatically and sends several of them to the server concurrently)
+    selected_actions = []
+    if close_events:
+        selected_actions.append('close')
+    if archive_events:
+        selected_actions.append('archive')
+    if open_events:
+        selected_actions.append('open')
+    if unarchive_events:
+        selected_actions.append('unarchive')
+
+    for action in selected_actions:
+        print('\nINFO: Applying', action, 'to', len(event_id_list), 'events')
+        results = di.bulk_event_action(event_id_list, action)
+        if len(results['failed_ids']) > 0:
+            print('WARNING:', len(results['failed_ids']), 'events could not be modified:', results['failed_ids'])
 
 
 def get_event_ids_based_on_live_data():
 
-    #get all events from server
-    all_events = di.get_events()
+    #get all events from server (the local event store is deliberately not used
+    #here since it does not pick up status changes to events it already holds)
+    all_events = di.get_events(use_event_store=False)
     print('INFO:', len(all_events), 'total visible events on server')
 
     filtered_events = []
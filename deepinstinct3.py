@@ -30,10 +30,404 @@ debug_mode = False
 quiet_mode = False
 
 # Import various libraries used by one or more method below.
-import requests, json, datetime, pandas, re, ipaddress, time, os, hashlib
+import requests, json, datetime, pandas, re, ipaddress, time, os, hashlib, numpy
 #If any of the above throw import errors, try running 'pip install library_name'
 #If that doesn't fix the problem I recommend to search Google for the error
 #that you are getting.
+import threading, concurrent.futures, sqlite3, bisect, collections, contextlib, random, urllib.parse, email.utils, urllib3
+
+# HTTP connection pool settings for the shared session(s) used by every method
+# in this file. Change these before the first request, or call reset_sessions()
+# afterwards to apply new values.
+pool_connections = 10 #number of distinct hosts to keep pools for
+pool_maxsize = 32 #max keep-alive connections per host (raise for parallel work)
+
+# One requests.Session per server, keyed by fqdn. Reusing a session means that
+# consecutive requests (for example each page of get_devices or get_events)
+# reuse an existing keep-alive TCP+TLS connection instead of opening a new one.
+# The session also carries the Authorization header, so methods in this file
+# only add the headers specific to their request.
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Returns the shared session for the current value of fqdn, creating it on
+# first use. The Authorization header is kept in step with key, so a new value
+# of key takes effect on the next request.
+def get_session():
+    with sessions_lock:
+        session = sessions.get(fqdn)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+            sessions[fqdn] = session
+        if session.headers.get('Authorization') != key:
+            session.headers['Authorization'] = key
+        return session
+
+# Closes and discards all shared sessions (they are re-created on next use)
+def reset_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+# Retry policy applied by send_request to every request. Connection errors,
+# timeouts and responses with a status code in retry_status_codes are retried,
+# up to max_attempts attempts in total, after an exponentially increasing random
+# wait (full jitter) of up to max_retry_backoff_in_seconds, or after the time
+# given by the server in a Retry-After header (up to
+# max_retry_after_in_seconds). Requests which may not be safe to repeat (POST
+# other than searches) are only retried if the connection could not be opened
+# or the server declined them with 429 or 503. Set max_attempts = 1 to disable
+# retries.
+max_attempts = 5
+retry_backoff_in_seconds = 1
+max_retry_backoff_in_seconds = 60
+max_retry_after_in_seconds = 300
+retry_status_codes = (429, 500, 502, 503, 504)
+
+# Circuit breaker per server. After circuit_breaker_threshold consecutive failed
+# attempts (connection errors, timeouts or 5xx responses) on a server, requests
+# to it fail immediately with CircuitOpenError for
+# circuit_breaker_reset_in_seconds. After that a single trial request is let
+# through, which closes the circuit if it succeeds or re-opens it if it fails.
+circuit_breaker_threshold = 10
+circuit_breaker_reset_in_seconds = 60
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    # Returns True if a request may be sent now
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial_in_progress and time.monotonic() - self.opened_at >= circuit_breaker_reset_in_seconds:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    # Returns True if this failure opened the circuit
+    def record_failure(self):
+        with self.lock:
+            self.failure_count += 1
+            if self.trial_in_progress or (self.opened_at is None and self.failure_count >= circuit_breaker_threshold):
+                self.opened_at = time.monotonic()
+                self.trial_in_progress = False
+                return True
+            return False
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(server):
+    with circuit_breakers_lock:
+        if server not in circuit_breakers:
+            circuit_breakers[server] = CircuitBreaker()
+        return circuit_breakers[server]
+
+# Request governor per server, applied by send_request to every attempt. Each
+# request is assigned to an endpoint class (see get_endpoint_class), and for
+# each server and endpoint class at most max_in_flight requests are sent at
+# once (0 for no limit) and requests are started at no more than
+# requests_per_second (0 for no limit, with bursts of up to burst requests).
+# Limits for a specific server can be set in server_request_limits, keyed by
+# fqdn, for example server_request_limits['FOO.customers.deepinstinctweb.com']
+# = {'write': {'requests_per_second': 2, 'burst': 2, 'max_in_flight': 1}}.
+# Change these before the first request, or call reset_request_governors()
+# afterwards to apply new values. get_request_stats() reports how many requests
+# are queued and in flight and how long requests have waited for their turn.
+request_limits = {
+    'search': {'requests_per_second': 0, 'burst': 10, 'max_in_flight': 8},
+    'policy_data': {'requests_per_second': 0, 'burst': 10, 'max_in_flight': 8},
+    'write': {'requests_per_second': 10, 'burst': 10, 'max_in_flight': 4},
+    'default': {'requests_per_second': 0, 'burst': 10, 'max_in_flight': 0},
+}
+server_request_limits = {}
+
+# Returns the endpoint class used to look up request_limits for a request
+def get_endpoint_class(method, request_url):
+    path = urllib.parse.urlsplit(request_url).path
+    if '/search' in path:
+        return 'search'
+    if method.upper() != 'GET':
+        return 'write'
+    if path.startswith('/api/v1/policies/'):
+        return 'policy_data'
+    return 'default'
+
+# Hands out tokens at a fixed rate, allowing bursts of up to burst tokens.
+# Callers which find no token available reserve the next one and sleep until
+# it is due, so waiting callers are served in order.
+class TokenBucket:
+
+    def __init__(self, requests_per_second, burst=1):
+        self.rate = requests_per_second
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class RequestGovernor:
+
+    def __init__(self, requests_per_second=0, burst=10, max_in_flight=0):
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.semaphore = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.limits = {'requests_per_second': requests_per_second, 'burst': burst, 'max_in_flight': max_in_flight}
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.queued_count = 0
+        self.in_flight_count = 0
+        self.waited_count = 0
+        self.total_wait_in_seconds = 0.0
+        self.max_wait_in_seconds = 0.0
+
+    # Waits for a token and a free slot, then holds the slot for the duration of the with block
+    @contextlib.contextmanager
+    def slot(self):
+        start_time = time.perf_counter()
+        with self.lock:
+            self.queued_count += 1
+        try:
+            self.bucket.acquire()
+            if self.semaphore is not None:
+                self.semaphore.acquire()
+        finally:
+            wait_time = time.perf_counter() - start_time
+            with self.lock:
+                self.queued_count -= 1
+        with self.lock:
+            self.request_count += 1
+            self.in_flight_count += 1
+            self.total_wait_in_seconds += wait_time
+            self.max_wait_in_seconds = max(self.max_wait_in_seconds, wait_time)
+            if wait_time >= 0.001:
+                self.waited_count += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight_count -= 1
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.limits,
+                        requests=self.request_count,
+                        queued=self.queued_count,
+                        in_flight=self.in_flight_count,
+                        waited=self.waited_count,
+                        total_wait_in_seconds=round(self.total_wait_in_seconds, 3),
+                        mean_wait_in_seconds=round(self.total_wait_in_seconds / self.request_count, 4) if self.request_count else None,
+                        max_wait_in_seconds=round(self.max_wait_in_seconds, 3))
+
+request_governors = {}
+
+# Returns the governor for a server and endpoint class, creating it on first use
+def get_request_governor(server, endpoint_class):
+    with sessions_lock:
+        governor = request_governors.get((server, endpoint_class))
+        if governor is None:
+            limits = dict(request_limits.get(endpoint_class, request_limits['default']))
+            limits.update(server_request_limits.get(server, {}).get(endpoint_class, {}))
+            governor = RequestGovernor(**limits)
+            request_governors[(server, endpoint_class)] = governor
+        return governor
+
+# Discards all governors (they are re-created with current limits on next use)
+def reset_request_governors():
+    with sessions_lock:
+        request_governors.clear()
+
+# Sets limits (any of requests_per_second, burst and max_in_flight) for one
+# server and endpoint class in server_request_limits, and applies them to the
+# next request
+def set_request_limits(server, endpoint_class, **limits):
+    with sessions_lock:
+        server_request_limits.setdefault(server, {}).setdefault(endpoint_class, {}).update(limits)
+        request_governors.pop((server, endpoint_class), None)
+
+# Returns statistics for each server and endpoint class which has sent requests,
+# as a dictionary keyed by server and then endpoint class
+def get_request_stats():
+    with sessions_lock:
+        governors = list(request_governors.items())
+    stats = {}
+    for (server, endpoint_class), governor in governors:
+        stats.setdefault(server, {})[endpoint_class] = governor.get_stats()
+    return stats
+
+# Returns the wait in seconds requested by a Retry-After header (given either
+# in seconds or as an HTTP date), or None if there is none
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Returns False if a request failed before a connection to the server was
+# opened, meaning that nothing was sent
+def connection_was_opened(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# Sends a request by calling send_attempt (which sends it once and returns the
+# response), applying the retry policy and circuit breaker above. Returns the
+# last response received (which may still have a status code in
+# retry_status_codes if all attempts failed), or raises the last exception if
+# no response was received.
+def send_with_retries(method, request_url, send_attempt, max_attempts=None):
+    if max_attempts is None:
+        max_attempts = globals()['max_attempts']
+    server = urllib.parse.urlsplit(request_url).netloc
+    circuit_breaker = get_circuit_breaker(server)
+    repeatable = method.upper() != 'POST' or '/search' in request_url
+
+    attempt = 1
+    while True:
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError(f'Requests to {server} are suspended after repeated failures')
+
+        response, error, wait_time = None, None, None
+        try:
+            response = send_attempt()
+        except requests.exceptions.RequestException as e:
+            error = e
+
+        if error is not None:
+            #certificate errors and invalid requests are not going to succeed on another attempt
+            failed = isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)) and not isinstance(error, requests.exceptions.SSLError)
+            retry = failed and (repeatable or not connection_was_opened(error))
+        else:
+            failed = response.status_code >= 500
+            retry = response.status_code in retry_status_codes and (repeatable or response.status_code in (429, 503))
+            if retry and response.status_code in (429, 503):
+                wait_time = get_retry_after(response)
+                if wait_time is not None:
+                    wait_time = min(wait_time, max_retry_after_in_seconds)
+
+        if failed:
+            if circuit_breaker.record_failure():
+                print('WARNING: Suspending requests to', server, 'for', circuit_breaker_reset_in_seconds, 'seconds after repeated failures')
+        else:
+            circuit_breaker.record_success()
+
+        if not retry or attempt >= max_attempts:
+            if error is not None:
+                raise error
+            return response
+
+        if wait_time is None:
+            wait_time = random.uniform(0, min(max_retry_backoff_in_seconds, retry_backoff_in_seconds * 2 ** (attempt - 1)))
+        if not quiet_mode:
+            print('WARNING:', method, request_url, 'failed with', error if error is not None else response.status_code,
+                  '. Retrying in', round(wait_time, 1), 'seconds (attempt', attempt + 1, 'of', str(max_attempts) + ')')
+        time.sleep(wait_time)
+        attempt += 1
+
+# Raises requests.exceptions.HTTPError for a response which, after any retries by
+# send_request, does not have the expected status code
+def check_response(response, expected_status_code=200):
+    if response.status_code != expected_status_code:
+        raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on {response.request.method} {response.url}', response=response)
+
+# Sends an HTTP request to the server using the shared session, applying the
+# retry policy and circuit breaker (see send_with_retries) and the request
+# governor above to every attempt. All methods in this file route their
+# requests through here.
+def send_request(method, request_url, max_attempts=None, **kwargs):
+    governor = get_request_governor(urllib.parse.urlsplit(request_url).netloc, get_endpoint_class(method, request_url))
+
+    def send_attempt():
+        with governor.slot():
+            return get_session().request(method, request_url, **kwargs)
+
+    return send_with_retries(method, request_url, send_attempt, max_attempts=max_attempts)
+
+# Sends one request per URL in request_urls (all for the same server and
+# endpoint class) and returns the responses in the same order as request_urls.
+# The rate and number of requests in flight are limited by the request governor
+# for the server and endpoint class (see request_limits), so by default as many
+# threads are used as the governor lets requests be in flight, up to
+# pool_maxsize. Pass max_workers to use fewer threads, or requests_per_second to
+# change the governor's rate for this server and endpoint class (with
+# set_request_limits, so it also applies to later requests).
+def send_requests_in_parallel(method, request_urls, max_workers=None, requests_per_second=None, **kwargs):
+    if len(request_urls) == 0:
+        return []
+    server = urllib.parse.urlsplit(request_urls[0]).netloc
+    endpoint_class = get_endpoint_class(method, request_urls[0])
+    if requests_per_second is not None:
+        set_request_limits(server, endpoint_class, requests_per_second=requests_per_second)
+    if max_workers is None:
+        max_workers = get_request_governor(server, endpoint_class).limits['max_in_flight'] or pool_maxsize
+    max_workers = min(max_workers, pool_maxsize, len(request_urls))
+
+    def send_one(request_url):
+        return send_request(method, request_url, **kwargs)
+
+    if max_workers <= 1:
+        return [send_one(request_url) for request_url in request_urls]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(send_one, request_urls))
+
+# Returns counts of requests sent vs. new connections opened (each new
+# connection is a TCP+TLS handshake) for the current fqdn. Any request that
+# did not need a new connection reused a pooled keep-alive connection.
+def get_connection_stats():
+    stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+    with sessions_lock:
+        session = sessions.get(fqdn)
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    stats['requests'] += pool.num_requests
+                    stats['new_connections'] += pool.num_connections
+    stats['reused_connections'] = stats['requests'] - stats['new_connections']
+    return stats
 
 # Export Device List to disk in Excel format
 def export_devices(include_deactivated=False):
@@ -57,9 +451,9 @@ def export_devices(include_deactivated=False):
 # a group name. Finds matching devices and matching group, then moves the
 # devices to that group. Note that even when using exact hostnames, there
 # may be multiple matches found, and in that case all will be moved.
-def move_devices(search_list, group_name, regex_hostname_search=False, cidr_search=False):
+def move_devices(search_list, group_name, regex_hostname_search=False, cidr_search=False, inventory=None):
     # Get device IDs
-    device_ids = get_device_ids(search_list=search_list, regex_hostname_search=regex_hostname_search, cidr_search=cidr_search)
+    device_ids = get_device_ids(search_list=search_list, regex_hostname_search=regex_hostname_search, cidr_search=cidr_search, inventory=inventory)
     # Lookup to get Device Group ID
     group_id = get_group_id(group_name=group_name, exclude_default_groups=True)
     # Execute the move
@@ -91,7 +485,7 @@ def move_devices_to_automatic_assignment(hostnames):
 #Archives (hides from GUI and API) a list of devices
 def archive_devices(device_ids, unarchive=False):
     # Calculate headers and URL
-    headers = {'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'Content-Type': 'application/json'}
     if unarchive:
         request_url = f'https://{fqdn}/api/v1/devices/actions/unarchive'
     else:
@@ -101,7 +495,7 @@ def archive_devices(device_ids, unarchive=False):
     payload = {'ids': device_ids}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
@@ -181,7 +575,7 @@ def enable_upgrades(platforms=['WINDOWS','MAC'], automatic_upgrade=True, return_
     modified_policies_id_list = []
 
     # Static headers for all requests in this function
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
 
     # Iterate through the polic0ies
     for policy in policies:
@@ -190,14 +584,14 @@ def enable_upgrades(platforms=['WINDOWS','MAC'], automatic_upgrade=True, return_
             # If yes, get policy data from the server
             policy_id = policy['id']
             request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
+            response = send_request('GET', request_url, headers=headers)
             policy_data = response.json()
             # Check if the upgrade setting needs changing
             if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
                 # If yes, set it to desired setting
                 policy_data['data']['automatic_upgrade'] = automatic_upgrade
                 # Write modified policy data back to server (saving change)
-                response = requests.put(request_url, json=policy_data, headers=headers)
+                response = send_request('PUT', request_url, json=policy_data, headers=headers)
                 # Increment the counter of how many policies we have modified
                 modified_policy_counter += 1
                 modified_policies_id_list.append(policy['id'])
@@ -223,19 +617,19 @@ def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
     modified_policy_counter = 0
 
     # Static headers for all requests in this function
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
 
     # Iterate through the poliocy ids provided
     for policy_id in policy_ids:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
         policy_data = response.json()
         # Check if the upgrade setting needs changing
         if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
             # If yes, set it to desired setting
             policy_data['data']['automatic_upgrade'] = automatic_upgrade
             # Write modified policy data back to server (saving change)
-            request = requests.put(request_url, json=policy_data, headers=headers)
+            request = send_request('PUT', request_url, json=policy_data, headers=headers)
             # Increment the counter of how many policies we have modified
             modified_policy_counter += 1
 
@@ -245,9 +639,9 @@ def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
 # Returns list of visible Tenants
 def get_tenants():
     #get data
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
@@ -258,18 +652,18 @@ def get_tenants():
         return []
 
 
-# Returns a list of all visible Devices
-def get_devices(include_deactivated=False):
+# Returns a list of all visible Devices (or, if after_device_id is provided,
+# only those with a higher device id)
+def get_devices(include_deactivated=False, after_device_id=0):
 
-    headers = {'accept': 'application/json', 'Authorization': key}
-    last_id = 0
-    error_count = 0
+    headers = {'accept': 'application/json'}
+    last_id = after_device_id
     collected_devices = []
 
     while last_id != None:
 
         request_url = f'https://{fqdn}/api/v1/devices?after_device_id={last_id}'
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
 
         if response.status_code == 200:
             response = response.json()
@@ -284,47 +678,212 @@ def get_devices(include_deactivated=False):
                     collected_devices.append(device)
 
         else:
-            error_count += 1
-            print('WARNING:', request_url, 'returned an unexpected status code', response.status_code, '. Error count is now', error_count, '. Will try again in 15 seconds.')
-            time.sleep(15)
+            #send_request has already retried, so give up rather than retrying forever
+            print('ERROR:', request_url, 'returned an unexpected status code', response.status_code)
+            check_response(response)
 
     return collected_devices
 
 
-# Translates a list of device names, regex patterns, or CIDRs to a list of device IDs
-def get_device_ids(search_list, regex_hostname_search=False, cidr_search=False):
+# An in-process copy of the device list with indexes on device id, hostname
+# (case-insensitive), MAC address and IP address, so that bulk lookups do not
+# need to scan the full device list (or re-page /devices) for every item.
+#
+# The data is fully re-downloaded once it is older than max_age_in_seconds
+# (checked by refresh_if_stale). refresh() without full=True only adds devices
+# with an id higher than any already known (using after_device_id), which is
+# cheap but does not pick up changes to existing devices.
+class DeviceInventory:
+
+    def __init__(self, include_deactivated=False, max_age_in_seconds=900):
+        self.include_deactivated = include_deactivated
+        self.max_age_in_seconds = max_age_in_seconds
+        self.clear()
+
+    def clear(self):
+        self.devices_by_id = {}
+        self.devices_by_hostname = {}
+        self.devices_by_mac_address = {}
+        self.ip_index = {4: ([], []), 6: ([], [])} #per IP version: (sorted ints, matching devices)
+        self.last_id = 0
+        self.refresh_time = None
+
+    # Download devices from the server and update the indexes
+    def refresh(self, full=False):
+        if full:
+            self.clear()
+        #always collect deactivated devices so that last_id reflects everything seen
+        new_devices = get_devices(include_deactivated=True, after_device_id=self.last_id)
+        for device in new_devices:
+            self.last_id = max(self.last_id, device['id'])
+            if device['license_status'] == 'ACTIVATED' or self.include_deactivated:
+                self.add(device)
+        if len(new_devices) > 0:
+            self.build_ip_index()
+        self.refresh_time = time.monotonic()
+        return len(new_devices)
+
+    # Do a full refresh if the data has never been loaded or is too old
+    def refresh_if_stale(self):
+        if self.refresh_time is None or time.monotonic() - self.refresh_time > self.max_age_in_seconds:
+            self.refresh(full=True)
+        return self
+
+    def add(self, device):
+        self.devices_by_id[device['id']] = device
+        if device.get('hostname'):
+            self.devices_by_hostname.setdefault(device['hostname'].lower(), []).append(device)
+        if device.get('mac_address'):
+            self.devices_by_mac_address.setdefault(normalize_mac_address(device['mac_address']), []).append(device)
+
+    def build_ip_index(self):
+        entries = {4: [], 6: []}
+        for device in self.devices_by_id.values():
+            try:
+                ip = ipaddress.ip_address(device.get('ip_address'))
+            except ValueError:
+                continue
+            entries[ip.version].append((int(ip), device['id']))
+        for version in entries:
+            entries[version].sort()
+            self.ip_index[version] = ([entry[0] for entry in entries[version]], [self.devices_by_id[entry[1]] for entry in entries[version]])
+
+    # Returns a list of all devices in the inventory
+    def get_devices(self):
+        return list(self.devices_by_id.values())
+
+    # Returns the device with the given id, or None
+    def get_device(self, device_id):
+        return self.devices_by_id.get(device_id)
+
+    # Returns a list of devices with the given hostname (case-insensitive)
+    def find_by_hostname(self, hostname):
+        return list(self.devices_by_hostname.get(hostname.lower(), []))
+
+    # Returns a list of devices with the given MAC address (any common format)
+    def find_by_mac_address(self, mac_address):
+        return list(self.devices_by_mac_address.get(normalize_mac_address(mac_address), []))
+
+    # Returns a list of devices whose IP address is within the given CIDR
+    def find_by_cidr(self, cidr):
+        network = ipaddress.ip_network(cidr, strict=False)
+        ip_ints, devices = self.ip_index[network.version]
+        start = bisect.bisect_left(ip_ints, int(network.network_address))
+        end = bisect.bisect_right(ip_ints, int(network.broadcast_address))
+        return devices[start:end]
+
+
+# Returns a lowercase, separator-free MAC address for use as a lookup key
+def normalize_mac_address(mac_address):
+    return re.sub('[^0-9a-f]', '', mac_address.lower())
+
+
+# Returns a shared DeviceInventory for the current fqdn, refreshing it first
+# if it is older than max_age_in_seconds
+device_inventories = {}
+def get_device_inventory(include_deactivated=False, max_age_in_seconds=900):
+    inventory_key = (fqdn, include_deactivated)
+    if inventory_key not in device_inventories:
+        device_inventories[inventory_key] = DeviceInventory(include_deactivated=include_deactivated, max_age_in_seconds=max_age_in_seconds)
+    inventory = device_inventories[inventory_key]
+    inventory.max_age_in_seconds = max_age_in_seconds
+    return inventory.refresh_if_stale()
+
+
+# Translates a list of device names, regex patterns, or CIDRs to a list of device IDs.
+# Optionally provide a DeviceInventory (see get_device_inventory) to search
+# it instead of downloading the full device list.
+def get_device_ids(search_list, regex_hostname_search=False, cidr_search=False, inventory=None):
     # GET ALL DEVICES
-    devices = get_devices(include_deactivated=False)
+    if inventory is not None:
+        devices = inventory.get_devices()
+    else:
+        devices = get_devices(include_deactivated=False)
+
+    # Hostname search (exact match only), using the inventory hostname index if available
+    if inventory is not None and not regex_hostname_search and not cidr_search:
+        matched_ids = set()
+        for hostname in set(search_list):
+            for device in inventory.find_by_hostname(hostname):
+                if device['hostname'] == hostname:
+                    matched_ids.add(device['id']) #add id to search results
+        #return the results in device list order, the same as the other searches
+        return [device['id'] for device in devices if device['id'] in matched_ids]
+
+    # RETURN THE SEARCH RESULTS
+    return match_device_ids(devices, search_list, regex_hostname_search=regex_hostname_search, cidr_search=cidr_search)
 
-    # CREATE A LIST TO COLLECT SEARCH RESULTS
-    device_ids = []
 
-    # ITERATE THROUGH THE DEVICES, COLLECT MATCHES
+# Returns the ids of the devices (in the order provided, without duplicates)
+# that match any entry in search_list. Entries are exact hostnames, regex
+# patterns matched against the start of the hostname (regex_hostname_search)
+# or CIDRs (cidr_search).
+def match_device_ids(devices, search_list, regex_hostname_search=False, cidr_search=False):
 
-    # Regex-based matching on hostname
+    # Regex-based matching on hostname. All patterns are compiled once and, if
+    # none of them contain groups, combined into a single alternation so each
+    # hostname is tested in one pass. Patterns with groups are matched one by
+    # one, because combining them renumbers their groups, which silently
+    # changes the meaning of any backreference.
     if regex_hostname_search:
-        for device in devices:
-            for regex in search_list: #for each regex...
-                if re.match(regex, device['hostname']): #check if hostname matches
-                    if device['id'] not in device_ids: #avoid duplicates
-                        device_ids.append(device['id']) #append id to search results
+        patterns = [re.compile(regex) for regex in search_list]
+        if len(patterns) > 1 and not any(pattern.groups for pattern in patterns):
+            try:
+                patterns = [re.compile('|'.join(f'(?:{regex})' for regex in search_list))]
+            except re.error:
+                pass #patterns that cannot be combined (for example inline flags) are matched one by one
+        return [device['id'] for device in devices if any(pattern.match(device['hostname']) for pattern in patterns)]
 
     # IP range (CIDR) matching
     elif cidr_search:
-        for cidr in search_list: #for each cidr in the search list...
-            for device in devices:
-                if ipaddress.ip_address(device['ip_address']) in ipaddress.ip_network(cidr):
-                    if device['id'] not in device_ids: #avoid duplicates
-                        device_ids.append(device['id']) #append id to search results
+        matched = numpy.zeros(len(devices), dtype=bool)
+        networks = [ipaddress.ip_network(cidr, strict=False) for cidr in search_list]
+
+        # IPv4: convert device IPs to an integer array once, sort it, then find
+        # the slice of devices inside every CIDR with a vectorized binary search
+        ipv4_networks = [network for network in networks if network.version == 4]
+        ipv4_positions = []
+        ipv4_values = []
+        ipv6_positions = []
+        for position, device in enumerate(devices):
+            try:
+                ip = ipaddress.ip_address(device['ip_address'])
+            except ValueError:
+                continue #devices without a valid ip address can never match
+            if ip.version == 4:
+                ipv4_positions.append(position)
+                ipv4_values.append(int(ip))
+            else:
+                ipv6_positions.append(position)
+        if len(ipv4_networks) > 0 and len(ipv4_values) > 0:
+            ipv4_positions = numpy.array(ipv4_positions, dtype=numpy.int64)
+            ipv4_values = numpy.array(ipv4_values, dtype=numpy.int64)
+            order = numpy.argsort(ipv4_values, kind='stable')
+            sorted_values = ipv4_values[order]
+            lows = numpy.array([int(network.network_address) for network in ipv4_networks], dtype=numpy.int64)
+            highs = numpy.array([int(network.broadcast_address) for network in ipv4_networks], dtype=numpy.int64)
+            starts = numpy.searchsorted(sorted_values, lows, side='left')
+            ends = numpy.searchsorted(sorted_values, highs, side='right')
+            # mark every [start, end) range at once (overlapping CIDRs are fine)
+            coverage = numpy.zeros(len(sorted_values) + 1, dtype=numpy.int64)
+            numpy.add.at(coverage, starts, 1)
+            numpy.add.at(coverage, ends, -1)
+            matched[ipv4_positions[order[numpy.cumsum(coverage[:-1]) > 0]]] = True
+
+        # IPv6 addresses do not fit in a NumPy integer; match them directly
+        ipv6_networks = [network for network in networks if network.version == 6]
+        if len(ipv6_networks) > 0:
+            for position in ipv6_positions:
+                ip = ipaddress.ip_address(devices[position]['ip_address'])
+                if any(ip in network for network in ipv6_networks):
+                    matched[position] = True
+
+        return [devices[position]['id'] for position in numpy.flatnonzero(matched)]
 
     # Hostname search (exact match only)
     else:
-        for device in devices:
-            if device['hostname'] in search_list:
-                device_ids.append(device['id']) #append id to search results
-
-    # RETURN THE SEARCH RESULTS
-    return device_ids
+        search_set = set(search_list)
+        return [device['id'] for device in devices if device['hostname'] in search_set]
 
 
 # Translate a Device Group name into a Device Group IP
@@ -343,7 +902,7 @@ def get_group_id(group_name, exclude_default_groups=False):
 # Adds a list of Devices to a Device Group
 def add_devices_to_group(device_ids, group_id, remove=False):
     # Calculate headers and URL
-    headers = {'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'Content-Type': 'application/json'}
     if remove:
         request_url = f'https://{fqdn}/api/v1/groups/{group_id}/remove-devices'
     else:
@@ -353,7 +912,7 @@ def add_devices_to_group(device_ids, group_id, remove=False):
     payload = {'devices': device_ids}
 
     # Send to server, return confirmation if successful
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
     if response.status_code == 204: #expected return code
         if remove:
             return str(len(device_ids)) + ' devices removed from group ' + str(group_id)
@@ -368,16 +927,21 @@ def remove_devices_from_group(device_ids, group_id):
     return add_devices_to_group(device_ids=device_ids, group_id=group_id, remove=True)
 
 
-# Collect and return list of Device Policies.
-def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep_data_encapsulated=False, msp_id='ALL', os_list = ['ANDROID', 'IOS', 'WINDOWS', 'MAC', 'CHROME', 'NETWORK_AGENTLESS', 'LINUX']):
+# Collect and return list of Device Policies. When include_policy_data and/or
+# include_allow_deny_lists are enabled, the per-policy requests are sent in
+# parallel within the limits of the 'policy_data' request governor (see
+# request_limits and send_requests_in_parallel for max_workers and
+# requests_per_second). Return shape and order are the same regardless of
+# these settings.
+def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep_data_encapsulated=False, msp_id='ALL', os_list = ['ANDROID', 'IOS', 'WINDOWS', 'MAC', 'CHROME', 'NETWORK_AGENTLESS', 'LINUX'], max_workers=None, requests_per_second=None):
     # GET POLICIES (basic data only)
 
     # Calculate headers and URL
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/policies/'
 
     # Get data, convert to Python list
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     policies = response.json()
 
     # Apply filter based on msp, if enabled
@@ -398,12 +962,15 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
     # APPEND POLICY DATA (IF ENABLED)
     if include_policy_data:
         print('INFO: Collecting policy data for', len(policies), 'policies')
-        # Iterate through policy list
+        # Calculate one URL per policy and pull policy data from server
+        # (in parallel; responses are returned in order)
+        request_urls = []
         for policy in policies:
-            # Extract ID, calculate URL, and pull policy data from server
             policy_id = policy['id']
-            request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
+            request_urls.append(f'https://{fqdn}/api/v1/policies/{policy_id}/data')
+        responses = send_requests_in_parallel('GET', request_urls, headers=headers, max_workers=max_workers, requests_per_second=requests_per_second)
+        # Iterate through policy list
+        for policy, request_url, response in zip(policies, request_urls, responses):
             if not quiet_mode:
                 print(request_url, 'returned', response.status_code)
             # Check response code (for some platforms, no policy data available)
@@ -432,24 +999,27 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
         ]
 
         print('INFO: Collecting', len(allow_deny_and_exclusion_list_types), 'allow, deny, and exclusion list data types for', len(policies), 'policies')
-        # Iterate through policy list
+        # Calculate the URL for every (policy, list type) combination
+        request_keys = []
+        request_urls = []
         for policy in policies:
-
             # Extract the policy id, which is used in subsequent requests
             policy_id = policy['id']
-
             #create a dictionary in the policy to store this data
             policy['allow_deny_and_exclusion_lists'] = {}
-
-            #iterate through list types to migrate
             for list_type in allow_deny_and_exclusion_list_types:
+                request_keys.append((policy, list_type))
+                request_urls.append(f'https://{fqdn}/api/v1/policies/{policy_id}/{list_type}')
+
+        # Pull the data from the server (in parallel; responses are returned in order)
+        responses = send_requests_in_parallel('GET', request_urls, headers=headers, max_workers=max_workers, requests_per_second=requests_per_second)
 
-                request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/{list_type}'
-                response = requests.get(request_url, headers=headers)
-                print(request_url, 'returned', response.status_code, end='\r')
-                if response.status_code == 200:
-                    response = response.json()
-                    policy['allow_deny_and_exclusion_lists'][list_type] = response
+        # Attach the results to the policies in the original order
+        for (policy, list_type), request_url, response in zip(request_keys, request_urls, responses):
+            print(request_url, 'returned', response.status_code, end='\r')
+            if response.status_code == 200:
+                response = response.json()
+                policy['allow_deny_and_exclusion_lists'][list_type] = response
         if not quiet_mode:
             print('\n')
 
@@ -460,9 +1030,9 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
 # Returns list of visible MSPs
 def get_msps():
     #get data
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
@@ -476,12 +1046,12 @@ def get_msps():
 # Create a new MSP
 def create_msp(msp_name, license_limit):
     # Calculate headers, URL, and payload
-    headers = {'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'Content-Type': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/'
     payload = {'name': msp_name, 'license_limit': license_limit}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 200:
@@ -511,8 +1081,7 @@ def delete_msp(msp_name):
 
     # DELETE THE MSP
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/{msp_id}'
-    headers = {'Authorization': key}
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url)
 
     # RETURN SUCCESS/FAILURE BASED ON RETURN CODE
     if response.status_code == 204:
@@ -539,8 +1108,7 @@ def remove_device(device, device_id_only=False):
 
     #UNINSTALL THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/remove'
-    headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -551,86 +1119,236 @@ def remove_device(device, device_id_only=False):
         return False
 
 
-# Return a list of events matching specified search parameters and/or minimum
-# event id. If neither are provided, all visible events are returned.
-def get_events(search={}, minimum_event_id=0, suspicious=False):
+# Request a single page (up to 50 events) from the events search API (retried
+# by send_request), raising an exception if the server does not return it.
+# Returns the decoded response, which contains 'events' and 'last_id' (None
+# once there are no more events).
+def get_events_page(search={}, after_event_id=0, suspicious=False):
 
-    #define HTTP headers for all requests in this method
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    #define HTTP headers
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
 
-    #list to collect events
-    collected_events = []
+    #calculate request url
+    if suspicious:
+        request_url = f'https://{fqdn}/api/v1/suspicious-events/search?after_event_id={str(after_event_id)}'
+    else:
+        request_url = f'https://{fqdn}/api/v1/events/search?after_event_id={str(after_event_id)}'
+
+    #make request to server (send_request retries failures), store response
+    response = send_request('POST', request_url, headers=headers, json=search, timeout=30)
+
+    if response.status_code != 200:
+        print('ERROR:', request_url, 'returned an unexpected status code', response.status_code)
+        check_response(response)
+
+    #decode the page once
+    page = response.json()
+    #print result to console
+    if not quiet_mode:
+        print(request_url, 'returned', response.status_code, 'with last_id', page['last_id'], end='\r')
+    return page
+
+
+# Yield events matching specified search parameters and/or minimum event id,
+# one page at a time as after_event_id advances. Only the current page (plus
+# the prefetched next page) is held in memory, so callers can process any
+# number of events in bounded memory. If neither are provided, all visible
+# events are yielded.
+#
+# With prefetch enabled, the request for the next page (using the last_id
+# just returned) is sent on a background thread while the current page is
+# being handed to the caller, overlapping network round trips with the
+# caller's processing. The prefetch thread is finished (and any prefetch not yet
+# started is cancelled) before the generator completes or is closed, so no
+# request is left running after the caller stops iterating. Close the
+# generator (for example with contextlib.closing) when stopping early, before
+# changing fqdn or key.
+def iter_events(search={}, minimum_event_id=0, suspicious=False, prefetch=True):
 
     #Note that the API method we are calling returns up to 50 events at a time,
     #and we know we have all events when we get last_id=None back in the response
 
-    #loop until we have all the events
-    while minimum_event_id != None:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        if prefetch:
+            next_page = executor.submit(get_events_page, search, minimum_event_id, suspicious)
 
-        #calculate request url
-        if suspicious:
-            request_url = f'https://{fqdn}/api/v1/suspicious-events/search?after_event_id={str(minimum_event_id)}'
-        else:
-            request_url = f'https://{fqdn}/api/v1/events/search?after_event_id={str(minimum_event_id)}'
+        #loop until we have all the events
+        while True:
+            if prefetch:
+                page = next_page.result()
+            else:
+                page = get_events_page(search, minimum_event_id, suspicious)
 
-        try:
-            #make request to server, store response
-            response = requests.post(request_url, headers=headers, json=search, timeout=30)
-            if response.status_code == 200:
-                #store the returned last_id value
-                minimum_event_id = response.json()['last_id']
+            #store the returned last_id value
+            minimum_event_id = page['last_id']
 
-                #print result to console
-                if not quiet_mode:
-                    print(request_url, 'returned', response.status_code, 'with last_id', minimum_event_id, end='\r')
-
-                #if we got a none-null last_id back
-                if minimum_event_id != None:
-                    #then extract the events
-                    events = response.json()['events']
-                    #append the event(s) from this response to collected_events
-                    for event in events:
-                        collected_events.append(event)
-        except requests.exceptions.RequestException:
-            print('WARNING: Exception on', request_url, '. Will sleep for 10 seconds and try again.')
-            time.sleep(10)
+            #a null last_id means there are no more events
+            if minimum_event_id == None:
+                break
 
-        if response.status_code == 200:
-            #store the returned last_id value
-            minimum_event_id = response.json()['last_id']
+            #start fetching the next page before handing this one to the caller
+            if prefetch:
+                next_page = executor.submit(get_events_page, search, minimum_event_id, suspicious)
+
+            yield from page['events']
+    finally:
+        if executor is not None:
+            next_page.cancel()
+            executor.shutdown(wait=True)
 
-            #print result to console
-            if not quiet_mode:
-                print(request_url, 'returned', response.status_code, 'with last_id', minimum_event_id, end='\r')
-
-            #if we got a none-null last_id back
-            if minimum_event_id != None:
-                #then extract the events
-                events = response.json()['events']
-                #append the event(s) from this response to collected_events
-                for event in events:
-                    collected_events.append(event)
     if not quiet_mode:
         print('\n')
 
-    #return the list of collected events
-    return collected_events
+
+# Return a list of events matching specified search parameters and/or minimum
+# event id. If neither are provided, all visible events are returned. For
+# large result sets prefer iter_events, which does not hold all events in
+# memory at once.
+#
+# If use_event_store is enabled (or left as None and the module-level setting
+# use_event_store is True), the local event store is first synced with any
+# new events from the server and the results are then read from it instead of
+# being re-downloaded. See sync_event_store for caveats.
+def get_events(search={}, minimum_event_id=0, suspicious=False, prefetch=True, use_event_store=None):
+    if use_event_store is None:
+        use_event_store = globals()['use_event_store']
+    if use_event_store:
+        sync_event_store(suspicious=suspicious)
+        return list(iter_stored_events(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious))
+    return list(iter_events(search=search, minimum_event_id=minimum_event_id, suspicious=suspicious, prefetch=prefetch))
 
 
 # Return a list of suspicious events matching specified search parameters
 # and/or minimum event id. If neither are provided, all visible susipcious
 # events are returned.
-def get_suspicious_events(search={}, minimum_event_id=0):
-    return get_events(suspicious=True, search=search, minimum_event_id=minimum_event_id)
+def get_suspicious_events(search={}, minimum_event_id=0, use_event_store=None):
+    return get_events(suspicious=True, search=search, minimum_event_id=minimum_event_id, use_event_store=use_event_store)
+
+
+# LOCAL EVENT STORE
+# A SQLite database per server (stored in the server-specific export folder)
+# holding a copy of every event downloaded so far. Scripts that repeatedly
+# analyze the full event history can set di.use_event_store = True so that
+# each run only downloads events newer than the highest id already stored.
+use_event_store = False
+
+# Event fields stored in their own indexed columns (full event is kept as JSON)
+event_store_columns = ['device_id', 'type', 'status', 'action', 'file_hash', 'threat_severity']
+
+# Returns path to the event store database for the current fqdn
+def get_event_store_path():
+    return f'{create_export_folder()}/event_store.sqlite'
+
+# Opens (creating if necessary) the event store for the current fqdn
+def open_event_store():
+    connection = sqlite3.connect(get_event_store_path())
+    for table in ['events', 'suspicious_events']:
+        columns = ', '.join(event_store_columns) #no declared type, values are stored as-is
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {columns}, data TEXT NOT NULL)')
+        for column in event_store_columns:
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})')
+    connection.commit()
+    return connection
+
+# Downloads events with an id greater than the highest id already in the local
+# event store and adds them to it. Returns the number of events added.
+#
+# Note that this is incremental by event id only: changes made to events that
+# were already stored (for example closing or archiving them) are not picked
+# up. Use full_refresh=True to replace the stored events with a fresh download
+# of all events; this also removes events which no longer exist on the server.
+def sync_event_store(suspicious=False, full_refresh=False, batch_size=1000):
+    table = 'suspicious_events' if suspicious else 'events'
+    connection = open_event_store()
+    try:
+        if full_refresh:
+            minimum_event_id = 0
+            #the delete and all inserts form one transaction (committed at the
+            #end) so an interrupted refresh leaves the previous contents intact
+            connection.execute(f'DELETE FROM {table}')
+        else:
+            minimum_event_id = connection.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        if not quiet_mode:
+            print('INFO: Syncing', table, 'with id greater than', minimum_event_id, 'to', get_event_store_path())
+
+        placeholders = ', '.join(['?'] * (len(event_store_columns) + 2))
+        statement = f'INSERT OR REPLACE INTO {table} (id, {", ".join(event_store_columns)}, data) VALUES ({placeholders})'
+        added_count = 0
+        rows = []
+        for event in iter_events(minimum_event_id=minimum_event_id, suspicious=suspicious):
+            rows.append([event['id']] + [event.get(column) for column in event_store_columns] + [json.dumps(event)])
+            #write in batches; an incremental sync commits each one so that
+            #progress survives an interruption
+            if len(rows) >= batch_size:
+                connection.executemany(statement, rows)
+                if not full_refresh:
+                    connection.commit()
+                added_count += len(rows)
+                rows = []
+        if len(rows) > 0:
+            connection.executemany(statement, rows)
+            added_count += len(rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+    if not quiet_mode:
+        print('INFO:', added_count, table, 'added to local event store')
+    return added_count
+
+# Returns True if event matches the provided search parameters. Supports the
+# same formats as the server-side search: a list of accepted values, or a
+# dictionary with 'from' and/or 'to' for ranges (for example timestamps).
+def event_matches_search(event, search):
+    for field, accepted in search.items():
+        value = event.get(field)
+        if isinstance(accepted, dict):
+            if value is None:
+                return False
+            if 'from' in accepted and value < accepted['from']:
+                return False
+            if 'to' in accepted and value > accepted['to']:
+                return False
+        elif isinstance(accepted, (list, tuple, set)):
+            if value not in accepted:
+                return False
+        elif value != accepted:
+            return False
+    return True
+
+# Yields events from the local event store (in id order) matching specified
+# search parameters and/or minimum event id. Criteria on indexed columns are
+# evaluated by SQLite; any other criteria are applied to the decoded events.
+def iter_stored_events(search={}, minimum_event_id=0, suspicious=False):
+    table = 'suspicious_events' if suspicious else 'events'
+    where = ['id > ?']
+    parameters = [minimum_event_id]
+    for field, accepted in search.items():
+        if field in event_store_columns and isinstance(accepted, (list, tuple, set)):
+            accepted = list(accepted)
+            if len(accepted) == 0:
+                return
+            where.append(f'{field} IN ({", ".join(["?"] * len(accepted))})')
+            parameters.extend(accepted)
+    connection = open_event_store()
+    try:
+        cursor = connection.execute(f'SELECT data FROM {table} WHERE {" AND ".join(where)} ORDER BY id', parameters)
+        for row in cursor:
+            event = json.loads(row[0])
+            if event_matches_search(event, search):
+                yield event
+    finally:
+        connection.close()
 
 
 #Return a list of all visible Device Groups
 def get_groups(exclude_default_groups=False):
     # Calculate headers and URL
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/groups/'
     # Get Device Groups from server
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     #Check response code
     if response.status_code == 200:
         groups = response.json() #convert to Python list
@@ -648,10 +1366,10 @@ def get_groups(exclude_default_groups=False):
 #Gets a single device
 def get_device(device_id):
     # Calculate headers and URL
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}'
     # Get data on the requested device ID from the server
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     # Check response code
     if response.status_code == 200:
         device = response.json() #convert to Python list
@@ -664,7 +1382,7 @@ def get_device(device_id):
 def archive_events (event_id_list, unarchive=False, suspicious=False):
 
     # set headers (same for all requests in this method)
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
 
     # Create payload with list of event IDs as a Python dictionary
     payload = {'ids': event_id_list}
@@ -680,7 +1398,7 @@ def archive_events (event_id_list, unarchive=False, suspicious=False):
         request_url = f'https://{fqdn}/api/v1/suspicious-events/actions/unarchive'
 
     #send request to server
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = send_request('POST', request_url, headers=headers, json=payload)
 
     #return true if successful, false otherwise
     return (response.status_code == 204)
@@ -713,7 +1431,7 @@ def create_export_folder():
 def get_event(event_id, suspicious=False):
 
     #define headers
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
 
     #calculate request url
     if suspicious:
@@ -722,7 +1440,7 @@ def get_event(event_id, suspicious=False):
         request_url = f'https://{fqdn}/api/v1/events/{str(event_id)}'
 
     #make request, store response
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     # based on response code, return event or alternately an error code
     if response.status_code == 200:
@@ -737,7 +1455,7 @@ def get_event(event_id, suspicious=False):
 def create_policy(name, base_policy_id, comment='', quiet_mode=False):
 
     #define headers
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
 
     #calculate request url
     request_url = f'https://{fqdn}/api/v1/policies/'
@@ -746,7 +1464,7 @@ def create_policy(name, base_policy_id, comment='', quiet_mode=False):
     payload = {'name': name, 'comment': comment, 'base_policy_id': base_policy_id}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
@@ -762,13 +1480,13 @@ def create_policy(name, base_policy_id, comment='', quiet_mode=False):
 def delete_policy(policy_id):
 
     #define headers
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
 
     #calculate request url
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}'
 
     # Send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url, headers=headers)
 
     # Check response code
     if response.status_code == 204:
@@ -834,13 +1552,13 @@ def create_tenant(tenant_name, license_limit, msp_name):
                 'license_limit': license_limit }
 
     #calculate headers
-    headers = {'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'Content-Type': 'application/json'}
 
     #calculate URL
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return success or descriptive error
     if response.status_code == 200: #tenant creation was successful
@@ -879,12 +1597,11 @@ def delete_tenant(tenant_name, msp_name):
             if tenant['name'] == tenant_name:
                 tenant_id = tenant['id']
 
-    #calculate URL and headers
+    #calculate URL
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/{tenant_id}'
-    headers = {'Authorization': key}
 
     #send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -907,10 +1624,10 @@ def request_agent_logs(device_id, device_id_only=True):
 
     #calculate URL and headers
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/upload-logs'
-    headers = {'Authorization': key, 'accept': 'application/json'}
+    headers = {'accept': 'application/json'}
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -941,13 +1658,12 @@ def close_events(event_id_list, open=False, suspicious=False):
             request_url = f'https://{fqdn}/api/v1/events/actions/close'
 
     #calculate headers and payload
-    headers = {'Authorization': key,
-                'accept': 'application/json',
+    headers = {'accept': 'application/json',
                 'Content-Type': 'application/json'}
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -984,13 +1700,12 @@ def archive_events(event_id_list, unarchive=False, suspicious=False):
             request_url = f'https://{fqdn}/api/v1/events/actions/archive'
 
     #calculate headers and payload
-    headers = {'Authorization': key,
-                'accept': 'application/json',
+    headers = {'accept': 'application/json',
                 'Content-Type': 'application/json'}
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1003,6 +1718,112 @@ def archive_events(event_id_list, unarchive=False, suspicious=False):
         print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url)
         return False
 
+# Applies an action ('close', 'open', 'archive' or 'unarchive') to any number
+# of events by sending the ids in chunks, several chunks at a time.
+#
+# The chunk size adapts to the server: it starts at initial_batch_size, grows
+# after each successful chunk (up to max_batch_size), and shrinks when the
+# server pushes back with 413, 429 or 5xx (a chunk rejected with 413 is also
+# split in half). Rejected chunks and connection errors are retried up to
+# max_attempts times with exponential backoff. Retrying is safe because these
+# actions are idempotent (closing an already closed event is a no-op).
+#
+# Returns a summary dictionary including the ids that could not be processed
+# and the achieved throughput in events per second. Progress, retry and failure
+# messages are suppressed when quiet_mode is set; check failed_ids instead.
+def bulk_event_action(event_ids, action='close', suspicious=False, max_workers=4, initial_batch_size=250, max_batch_size=5000, max_attempts=5):
+
+    if action not in ('close', 'open', 'archive', 'unarchive'):
+        raise ValueError(f'Unsupported action {action}')
+
+    #calculate URL and headers
+    if suspicious:
+        request_url = f'https://{fqdn}/api/v1/suspicious-events/actions/{action}'
+    else:
+        request_url = f'https://{fqdn}/api/v1/events/actions/{action}'
+    headers = {'accept': 'application/json',
+                'Content-Type': 'application/json'}
+
+    #state shared by the worker threads
+    remaining_ids = collections.deque(dict.fromkeys(event_ids)) #de-duplicated, order preserved
+    state = {'batch_size': initial_batch_size, 'succeeded': 0, 'failed_ids': [], 'requests': 0, 'pushbacks': 0}
+    lock = threading.Lock()
+    start_time = time.perf_counter()
+
+    def take_chunk():
+        with lock:
+            chunk = []
+            while remaining_ids and len(chunk) < state['batch_size']:
+                chunk.append(remaining_ids.popleft())
+            return chunk
+
+    def process_chunks():
+        while True:
+            chunk = take_chunk()
+            if len(chunk) == 0:
+                return
+            attempt = 1
+            while True:
+                try:
+                    #this loop reduces the chunk size when the server pushes back, so send_request should not retry on its own
+                    status_code = send_request('POST', request_url, max_attempts=1, json={'ids': chunk}, headers=headers, timeout=120).status_code
+                except requests.exceptions.RequestException:
+                    status_code = None
+                with lock:
+                    state['requests'] += 1
+
+                if status_code == 204:
+                    with lock:
+                        state['succeeded'] += len(chunk)
+                        state['batch_size'] = min(max_batch_size, state['batch_size'] * 2)
+                    if not quiet_mode:
+                        print('INFO:', action, len(chunk), 'events succeeded', end='\r')
+                    break
+
+                if status_code is None or status_code in (413, 429) or status_code >= 500:
+                    #server pushed back (or connection failed); reduce chunk size
+                    with lock:
+                        state['pushbacks'] += 1
+                        state['batch_size'] = max(1, min(state['batch_size'], len(chunk)) // 2)
+                        if status_code == 413 and len(chunk) > 1:
+                            #payload too large: hand back the second half for any worker to pick up
+                            half = len(chunk) // 2
+                            remaining_ids.extendleft(reversed(chunk[half:]))
+                            chunk = chunk[:half]
+                    if attempt < max_attempts:
+                        if not quiet_mode:
+                            print('WARNING: Unexpected return code', status_code, 'on POST to', request_url, 'with', len(chunk), 'ids. Retrying (attempt', attempt + 1, 'of', str(max_attempts) + ')')
+                        time.sleep(min(60, 2 ** attempt))
+                        attempt += 1
+                        continue
+
+                if not quiet_mode:
+                    print('ERROR: Unexpected return code', status_code, 'on POST to', request_url, 'with', len(chunk), 'ids')
+                with lock:
+                    state['failed_ids'].extend(chunk)
+                break
+
+    if max_workers <= 1:
+        process_chunks()
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(process_chunks) for i in range(max_workers)]:
+                future.result()
+
+    runtime_in_seconds = time.perf_counter() - start_time
+    summary = {'action': action,
+                'event_count': state['succeeded'] + len(state['failed_ids']),
+                'succeeded': state['succeeded'],
+                'failed_ids': state['failed_ids'],
+                'requests': state['requests'],
+                'pushbacks': state['pushbacks'],
+                'final_batch_size': state['batch_size'],
+                'runtime_in_seconds': round(runtime_in_seconds, 3),
+                'events_per_second': round(state['succeeded'] / runtime_in_seconds, 1) if runtime_in_seconds > 0 else 0}
+    if not quiet_mode:
+        print('INFO:', action, summary['succeeded'], 'events in', summary['runtime_in_seconds'], 'seconds (' + str(summary['events_per_second']), 'events/second) with', len(summary['failed_ids']), 'failures')
+    return summary
+
 # Disable scanning and enforcement on a device
 def disable_device(device, device_id_only=False):
 
@@ -1016,8 +1837,7 @@ def disable_device(device, device_id_only=False):
 
     #DISABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/disable'
-    headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1041,8 +1861,7 @@ def enable_device(device, device_id_only=False):
 
     #ENABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/enable'
-    headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1055,8 +1874,9 @@ def enable_device(device, device_id_only=False):
 
 def get_event_counts_by_device_id(minimum_event_id=0, event_filters={}):
 
-    #get event data from server
-    events = get_events(minimum_event_id=minimum_event_id, search=event_filters)
+    #stream event data from server (events are counted as they arrive rather
+    #than collected first)
+    events = iter_events(minimum_event_id=minimum_event_id, search=event_filters)
 
     #convert to PivotTable style summary of event count by device id
     event_counts = count_data_by_field(events, 'device_id')
@@ -1096,6 +1916,30 @@ def count_data_by_field(data, field_name):
             result[record[field_name]] = 1
     return result
 
+# Returns a dictionary of records keyed by the value of field_name (for
+# example policies keyed by id), for constant-time lookups when joining data
+def index_by_field(records, field_name='id'):
+    index = {}
+    for record in records:
+        index[record[field_name]] = record
+    return index
+
+# Copies attributes from related records onto records in a single pass, using
+# a dictionary lookup instead of a nested loop. For example, to add the name
+# and prevention mode of each device's policy to the device:
+#   join_records(devices, policies, 'policy_id', {'name': 'policy_name', 'prevention_mode': 'in_prevention'})
+# fields maps the field name on the related record to the field name to set
+# on the record. Records with no matching related record are left unchanged.
+def join_records(records, related_records, foreign_key, fields, related_key='id'):
+    related_records_index = index_by_field(related_records, related_key)
+    for record in records:
+        related_record = related_records_index.get(record.get(foreign_key))
+        if related_record is not None:
+            for source_field_name, target_field_name in fields.items():
+                if source_field_name in related_record:
+                    record[target_field_name] = related_record[source_field_name]
+    return records
+
 def is_prevention_policy(policy, exclude_static_analysis=False, exclude_ransomware_behavior=False, exclude_remote_code_injection=False, exclude_arbritrary_shallcode_execution=False):
 
     verdict = False #start with false until proven otherwise
@@ -1116,9 +1960,9 @@ def is_prevention_policy(policy, exclude_static_analysis=False, exclude_ransomwa
     return verdict
 
 def download_uploaded_file(file_hash):
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/events/actions/download-uploaded-file/{file_hash}'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     if response.status_code == 200:
         folder_name = create_export_folder()
         file_name = f'{file_hash}.zip'
@@ -1131,11 +1975,11 @@ def download_uploaded_file(file_hash):
 def request_malware_sample(event_id):
 
     #calculate URL and headers
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/devices/actions/request-remote-file-upload/{event_id}'
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1148,10 +1992,10 @@ def request_malware_sample(event_id):
         print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url, 'with headers', headers)
         return False
 
-def isolate_from_network(devices, release_from_isolation=False, input_is_hostnames=True):
+def isolate_from_network(devices, release_from_isolation=False, input_is_hostnames=True, inventory=None):
 
     if input_is_hostnames:
-        device_ids = get_device_ids(search_list=devices)
+        device_ids = get_device_ids(search_list=devices, inventory=inventory)
     else:
         device_ids = devices
 
@@ -1161,11 +2005,10 @@ def isolate_from_network(devices, release_from_isolation=False, input_is_hostnam
         request_url = f'https://{fqdn}/api/v1/devices/actions/release-from-isolation'
 
     headers = {'accept': 'application/json',
-                'Content-Type': 'application/json',
-                'Authorization': key}
+                'Content-Type': 'application/json'}
     payload = {'ids': device_ids}
 
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = send_request('POST', request_url, headers=headers, json=payload)
 
     if response.status_code == 200:
         if remove_from_isolation:
@@ -1198,13 +2041,12 @@ def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platform
         payload['items'].append(payload_entry)
 
     headers = {'accept': 'application/json',
-                'Content-Type': 'application/json',
-                'Authorization': key}
+                'Content-Type': 'application/json'}
 
     error_count = 0
     for policy_id in policy_id_list:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/deny-list/hashes'
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = send_request('POST', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('INFO: Successfully added', len(payload['items']), 'hashes to the deny list for policy', policy_id)
         else:
@@ -1253,14 +2095,14 @@ def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['W
         #next step is to overwrite the policy data on the newly-create policy with data from source policy
         new_policy_id = new_policy['id']
         request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/data'
-        headers = {'accept': 'application/json', 'Authorization': key}
+        headers = {'accept': 'application/json'}
         payload = {'data': policy['data']}
-        response = requests.put(request_url, json=payload, headers=headers)
+        response = send_request('PUT', request_url, json=payload, headers=headers)
         if response.status_code != 204:
             print('ERROR: Unexpected response', response.status_code, 'on PUT to', request_url)
 
         #last step is to migrate the associated allow list, deny list, and exclusion lists for the policy
-        headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+        headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
         for list_type in allow_deny_and_exclusion_list_types:
             if list_type in policy['allow_deny_and_exclusion_lists']:
                 if len(policy['allow_deny_and_exclusion_lists'][list_type]['items']) > 0:
@@ -1274,7 +2116,7 @@ def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['W
 
                     payload = policy['allow_deny_and_exclusion_lists'][list_type]
                     request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/{list_type}'
-                    response = requests.post(request_url, headers=headers, json=payload)
+                    response = send_request('POST', request_url, headers=headers, json=payload)
                     if response.status_code != 204:
                         print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
 
@@ -1294,11 +2136,11 @@ def health_check(minimum_event_id=0):
 
 def add_process_exclusion(exclusion, policy_id, comment='', exclusion_type='process_path', delete=False):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/exclusion-list/{exclusion_type}'
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
 
     if not delete:
         payload = {'items': [ {'item': exclusion, 'comment': comment} ]}
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = send_request('POST', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('Successfully added', exclusion_type, 'exclusion', exclusion, 'to policy', policy_id)
             return True
@@ -1308,7 +2150,7 @@ def add_process_exclusion(exclusion, policy_id, comment='', exclusion_type='proc
 
     else:
         payload = {'items': [ {'item': exclusion} ]}
-        response = requests.delete(request_url, headers=headers, json=payload)
+        response = send_request('DELETE', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('Successfully removed', exclusion_type, 'exclusion', exclusion, 'from policy', policy_id)
             return True
@@ -1327,10 +2169,10 @@ def remove_folder_exclusion(exclusion, policy_id):
     return add_folder_exclusionn(exclusion=exclusion, policy_id=policy_id, delete=True)
 
 def remove_all_exclusions(policy_id, exclusion_types=['folder_path', 'process_path']):
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     for exclusion_type in exclusion_types:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/exclusion-list/{exclusion_type}'
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
         exclusions = response.json()['items']
         if len(exclusions) > 0:
             print('INFO: Removing', len(exclusions), exclusion_type, 'exclusions from policy', policy_id)
@@ -1340,7 +2182,7 @@ def remove_all_exclusions(policy_id, exclusion_types=['folder_path', 'process_pa
 
 def add_allow_list_hashes(hash_list, policy_id, comment='', delete=False):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/hashes'
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
 
     item_list = []
     for hash in hash_list:
@@ -1349,9 +2191,9 @@ def add_allow_list_hashes(hash_list, policy_id, comment='', delete=False):
     payload = {'items': item_list}
 
     if not delete:
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = send_request('POST', request_url, headers=headers, json=payload)
     else:
-        response = requests.delete(request_url, headers=headers, json=payload)
+        response = send_request('DELETE', request_url, headers=headers, json=payload)
 
     if response.status_code == 204:
         if not delete:
@@ -1368,7 +2210,7 @@ def remove_allow_list_hashes(hash_list, policy_id):
 
 def is_server_multitenancy_enabled():
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp'
-    response = requests.get(request_url)
+    response = send_request('GET', request_url)
     if response.status_code == 404:
         return False
     else:
@@ -1393,12 +2235,19 @@ def archive_device(device, device_id_only=False):
     return archive_devices(device_ids)
 
 #returns first (lowest device id) device ID matching a single hostname; excludes deactivated devices
-def get_device_id(hostname):
-    headers = {'accept': 'application/json', 'Authorization': key}
+#optionally provide a DeviceInventory (see get_device_inventory) for an
+#indexed lookup instead of paging through /devices
+def get_device_id(hostname, inventory=None):
+    if inventory is not None:
+        for device in sorted(inventory.find_by_hostname(hostname), key=lambda device: device['id']):
+            if device['license_status'] == 'ACTIVATED':
+                return device['id']
+        return 0
+    headers = {'accept': 'application/json'}
     last_id = 0
     while last_id != None:
         request_url = f'https://{fqdn}/api/v1/devices?after_device_id={last_id}'
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
         if response.status_code == 200:
             response = response.json()
             if 'devices' in response:
@@ -1410,16 +2259,16 @@ def get_device_id(hostname):
             else:
                 last_id = None
         else:
-            print('Unexpected return code', response.status_code, 'on GET', request_url, 'with headers', headers)
-            time.sleep(10)
+            print('Unexpected return code', response.status_code, 'on GET', request_url)
+            check_response(response)
     #no match found
     return 0
 
 #returns list of Administrator Accounts
 def get_users():
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/users/'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     if response.status_code == 200:
         users = response.json()
         return users
@@ -1436,7 +2285,7 @@ def export_users():
 
 #creates a user
 def create_user(username, password, first_name='First', last_name='Last', email='user@domain.com', role='MASTER_ADMINISTRATOR', msp_id=None, tenant_id=None):
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
     payload = {'first_name': first_name, 'last_name': last_name, 'email': email,
                 'username': username, 'role': role, 'password': password,
                 'auth_type': 'LOCAL'}
@@ -1445,7 +2294,7 @@ def create_user(username, password, first_name='First', last_name='Last', email=
     if tenant_id != None:
         payload['tenant_id'] = tenant_id
     request_url = f'https://{fqdn}/api/v1/users/'
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
     if response.status_code == 200:
         print('INFO: Successfully created user\n', json.dumps(response.json(), indent=4))
     elif response.status_code == 409:
@@ -1459,9 +2308,9 @@ def create_user(username, password, first_name='First', last_name='Last', email=
 
 #deletes a user
 def delete_user(user):
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     request_url = f'https://{fqdn}/api/v1/users/{user["id"]}'
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url, headers=headers)
     if response.status_code == 204:
         print('INFO: User', user['id'], user['username'], 'deleted')
     elif response.status_code == 404:
@@ -1474,10 +2323,10 @@ def change_user_role(username, new_role='READ_ONLY'):
     all_users = get_users()
     for user in all_users:
         if user['username'] == username:
-            headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': key}
+            headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
             request_url = f'https://{fqdn}/api/v1/users/{user["id"]}'
             payload = {'first_name': user['first_name'], 'last_name': user['last_name'], 'email': user['email'], 'role': new_role}
-            response = requests.put(request_url, json=payload, headers=headers)
+            response = send_request('PUT', request_url, json=payload, headers=headers)
             if response.status_code == 204:
                 print('INFO: User', user['id'], user['username'], 'updated to new role', new_role)
             elif response.status_code == 404:
@@ -1489,25 +2338,25 @@ def change_user_role(username, new_role='READ_ONLY'):
 
 def set_uninstall_password(policy_id, new_password):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-    headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.get(request_url, headers=headers)
+    headers = {'accept': 'application/json'}
+    response = send_request('GET', request_url, headers=headers)
     policy_data = response.json()
     policy_data['data']['uninstall_password_hash'] = hashlib.sha256(new_password.encode('utf-16-le')).hexdigest()
-    response = requests.put(request_url, json=policy_data, headers=headers)
+    response = send_request('PUT', request_url, json=policy_data, headers=headers)
 
 def set_disable_password(policy_id, new_password):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-    headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.get(request_url, headers=headers)
+    headers = {'accept': 'application/json'}
+    response = send_request('GET', request_url, headers=headers)
     policy_data = response.json()
     policy_data['data']['disable_password_hash'] = hashlib.sha256(new_password.encode('utf-16-le')).hexdigest()
-    response = requests.put(request_url, json=policy_data, headers=headers)
+    response = send_request('PUT', request_url, json=policy_data, headers=headers)
 
 def get_behavioral_allow_lists(policy_id):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     behavioral_allow_lists = []
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     if response.status_code == 200:
         items = response.json()['items']
         for item in items:
@@ -1561,8 +2410,8 @@ def add_behavioral_allow_lists(policy_id, process_list, behavior_name_list, comm
     payload = {'items': allow_lists_to_add}
 
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
-    headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.post(request_url, headers=headers, json=payload)
+    headers = {'accept': 'application/json'}
+    response = send_request('POST', request_url, headers=headers, json=payload)
 
     if response.status_code == 204:
         print('Successfully added', len(process_list), 'entries to the', behavior_name_list, 'allow lists for policy', policy_id)
@@ -1576,8 +2425,8 @@ def remove_behavioral_allow_lists(policy_id, process_list):
     for process in process_list:
         payload['items'].append({'item': process})
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/process_paths'
-    headers = {'accept': 'application/json', 'Authorization': key}
-    response = requests.delete(request_url, headers=headers, json=payload)
+    headers = {'accept': 'application/json'}
+    response = send_request('DELETE', request_url, headers=headers, json=payload)
     if response.status_code == 204:
         print('Successfully removed', len(process_list), 'entries from the Behavioral Allow List for policy', policy_id)
         return True
@@ -1594,9 +2443,9 @@ def remove_all_behavioral_allow_lists(policy_id):
 
 def add_script_path_allow_list(policy_id, path, comment=''):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/allow-list/scripts'
-    headers = {'accept': 'application/json', 'Authorization': key}
+    headers = {'accept': 'application/json'}
     payload = {'items': [ {'comment': comment, 'item': path} ] }
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = send_request('POST', request_url, headers=headers, json=payload)
     if response.status_code == 204:
         print('Successfully added', path, 'to script path allow list for policy', policy_id)
         return True
@@ -1604,27 +2453,86 @@ def add_script_path_allow_list(policy_id, path, comment=''):
         print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
         return False
 
-def get_audit_log(page_size=100, offset=0, categories=['LOGIN', 'FAILED_LOGIN', 'LOGOUT', 'NOTIFICATION', 'COMMENT', 'ADMINISTRATOR_MANAGEMENT', 'POLICY', 'ALLOW_LIST_DENY_LIST', 'GROUP', 'SYSTEM_SETTINGS', 'DEPLOYMENT', 'SYSTEM_REPORT_SEEN', 'SANDBOX_REPORT', 'BACKUP_AND_RESTORE', 'REMEDIATION', 'SERVER_TLS_CERTIFICATE', 'REPORTING']):
-    #page_size = 100
-    #offset = 0
-    collected_data = []
-    headers = {'accept': 'application/json', 'Authorization': key}
+# Page size settings used by iter_audit_log. The page size starts at
+# audit_log_page_size and doubles (up to audit_log_max_page_size) while full
+# pages are returned in less than half of audit_log_target_page_seconds, and
+# halves when a page takes longer than that or the server rejects it.
+audit_log_page_size = 500
+audit_log_min_page_size = 50
+audit_log_max_page_size = 5000
+audit_log_target_page_seconds = 2
+
+audit_log_categories = ['LOGIN', 'FAILED_LOGIN', 'LOGOUT', 'NOTIFICATION', 'COMMENT', 'ADMINISTRATOR_MANAGEMENT', 'POLICY', 'ALLOW_LIST_DENY_LIST', 'GROUP', 'SYSTEM_SETTINGS', 'DEPLOYMENT', 'SYSTEM_REPORT_SEEN', 'SANDBOX_REPORT', 'BACKUP_AND_RESTORE', 'REMEDIATION', 'SERVER_TLS_CERTIFICATE', 'REPORTING']
+
+# Returns one page of audit log entries starting at offset, along with the
+# time taken and the page size which was finally used
+def get_audit_log_page(offset=0, page_size=100):
+    headers = {'accept': 'application/json'}
     while True:
         request_url = f'https://{fqdn}/api/v1/audit_logs/?size={page_size}&offset={offset}'
-        response = requests.get(request_url, headers=headers)
-        #print(request_url, 'returned', response.status_code)
+        start_time = time.perf_counter()
+        response = send_request('GET', request_url, headers=headers, timeout=60)
         if response.status_code == 200:
-            audit_log_entries = response.json()
-            #print('The above request returned', len(audit_log_entries), 'entries.')
-            if len(audit_log_entries) > 0:
-                for item in audit_log_entries:
-                    offset += 1
-                    #print('DEBUG: Item category is', item['category'])
-                    if item['category'] in categories:
-                        collected_data.append(item)
-            else:
-                break
-        else:
-            print('ERROR: Unexpected response code', response.status_code, 'on GET', request_url, 'with headers', headers)
-            time.sleep(10)
-    return collected_data
+            return response.json(), time.perf_counter() - start_time, page_size
+        print('ERROR: Unexpected response code', response.status_code, 'on GET', request_url)
+        #a smaller page may succeed where a large one was rejected or failed on the server (send_request has
+        #already retried this page size)
+        if response.status_code in (413, 500, 502, 503, 504) and page_size > audit_log_min_page_size:
+            page_size = max(audit_log_min_page_size, page_size // 2)
+            continue
+        check_response(response)
+
+# Yields audit log entries newer than cursor as they are read from the server.
+# cursor is a dictionary with the offset of the next entry to read and the id
+# of the last entry read ('offset' and 'last_id'), and is updated in place as
+# entries are yielded, so saving it after processing an entry allows a later
+# call to resume after that entry. Before resuming, the entry at offset - 1 is
+# re-read to confirm it is still last_id; if older entries have been removed
+# from the server in the meantime, the log is re-read from the start, skipping
+# entries up to last_id. Entries whose category is not in categories (if
+# provided) are skipped.
+def iter_audit_log(cursor=None, categories=None, page_size=None):
+    if cursor is None:
+        cursor = {}
+    if page_size is None:
+        page_size = audit_log_page_size
+    categories = set(categories) if categories is not None else None
+    offset = cursor.get('offset', 0)
+    last_id = cursor.get('last_id')
+
+    if offset > 0 and last_id is not None:
+        page, elapsed, size = get_audit_log_page(offset=offset - 1, page_size=1)
+        if len(page) == 0 or page[0]['id'] != last_id:
+            print('WARNING: Audit log entry at offset', offset - 1, 'is no longer', last_id, '- reading from the start')
+            offset = 0
+
+    while True:
+        page, elapsed, page_size = get_audit_log_page(offset=offset, page_size=page_size)
+        if not quiet_mode:
+            print('Read', len(page), 'audit log entries at offset', offset, 'in', round(elapsed, 2), 'seconds', end='\r')
+        if len(page) == 0:
+            break
+
+        for entry in page:
+            offset += 1
+            cursor['offset'] = offset
+            if last_id is not None and entry['id'] <= last_id:
+                continue
+            last_id = entry['id']
+            cursor['last_id'] = last_id
+            if categories is None or entry['category'] in categories:
+                yield entry
+
+        if len(page) >= page_size and elapsed < audit_log_target_page_seconds / 2:
+            page_size = min(audit_log_max_page_size, page_size * 2)
+        elif elapsed > audit_log_target_page_seconds:
+            page_size = max(audit_log_min_page_size, page_size // 2)
+
+    if not quiet_mode:
+        print()
+
+# Returns a list of audit log entries starting at offset whose category is in
+# categories. For incremental reads prefer iter_audit_log, which resumes from
+# the last entry read.
+def get_audit_log(page_size=100, offset=0, categories=audit_log_categories):
+    return list(iter_audit_log(cursor={'offset': offset}, categories=categories, page_size=page_size))
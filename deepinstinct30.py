@@ -28,12 +28,177 @@
 #
 #
 debug_mode = False
+quiet_mode = False
 
 # Import various libraries used by one or more method below.
 import requests, json, datetime, pandas, re, ipaddress, time, os
 #If any of the above throw import errors, try running 'pip install library_name'
 #If that doesn't fix the problem I recommend to search Google for the error
 #that you are getting.
+import random, threading, urllib.parse, email.utils, urllib3
+
+# The retry policy, circuit breaker, send_with_retries and check_response below
+# are the same as in deepinstinct3.py. They are kept as a copy here, because
+# each wrapper is a standalone file which users download on its own;
+# tests/test_shared_code.py checks that the two copies stay identical.
+#
+# Retry policy applied by send_request to every request. Connection errors,
+# timeouts and responses with a status code in retry_status_codes are retried,
+# up to max_attempts attempts in total, after an exponentially increasing random
+# wait (full jitter) of up to max_retry_backoff_in_seconds, or after the time
+# given by the server in a Retry-After header (up to
+# max_retry_after_in_seconds). Requests which may not be safe to repeat (POST
+# other than searches) are only retried if the connection could not be opened
+# or the server declined them with 429 or 503. Set max_attempts = 1 to disable
+# retries.
+max_attempts = 5
+retry_backoff_in_seconds = 1
+max_retry_backoff_in_seconds = 60
+max_retry_after_in_seconds = 300
+retry_status_codes = (429, 500, 502, 503, 504)
+
+# Circuit breaker per server. After circuit_breaker_threshold consecutive failed
+# attempts (connection errors, timeouts or 5xx responses) on a server, requests
+# to it fail immediately with CircuitOpenError for
+# circuit_breaker_reset_in_seconds. After that a single trial request is let
+# through, which closes the circuit if it succeeds or re-opens it if it fails.
+circuit_breaker_threshold = 10
+circuit_breaker_reset_in_seconds = 60
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    # Returns True if a request may be sent now
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial_in_progress and time.monotonic() - self.opened_at >= circuit_breaker_reset_in_seconds:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    # Returns True if this failure opened the circuit
+    def record_failure(self):
+        with self.lock:
+            self.failure_count += 1
+            if self.trial_in_progress or (self.opened_at is None and self.failure_count >= circuit_breaker_threshold):
+                self.opened_at = time.monotonic()
+                self.trial_in_progress = False
+                return True
+            return False
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(server):
+    with circuit_breakers_lock:
+        if server not in circuit_breakers:
+            circuit_breakers[server] = CircuitBreaker()
+        return circuit_breakers[server]
+
+# Returns the wait in seconds requested by a Retry-After header (given either
+# in seconds or as an HTTP date), or None if there is none
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Returns False if a request failed before a connection to the server was
+# opened, meaning that nothing was sent
+def connection_was_opened(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# Sends a request by calling send_attempt (which sends it once and returns the
+# response), applying the retry policy and circuit breaker above. Returns the
+# last response received (which may still have a status code in
+# retry_status_codes if all attempts failed), or raises the last exception if
+# no response was received.
+def send_with_retries(method, request_url, send_attempt, max_attempts=None):
+    if max_attempts is None:
+        max_attempts = globals()['max_attempts']
+    server = urllib.parse.urlsplit(request_url).netloc
+    circuit_breaker = get_circuit_breaker(server)
+    repeatable = method.upper() != 'POST' or '/search' in request_url
+
+    attempt = 1
+    while True:
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError(f'Requests to {server} are suspended after repeated failures')
+
+        response, error, wait_time = None, None, None
+        try:
+            response = send_attempt()
+        except requests.exceptions.RequestException as e:
+            error = e
+
+        if error is not None:
+            #certificate errors and invalid requests are not going to succeed on another attempt
+            failed = isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)) and not isinstance(error, requests.exceptions.SSLError)
+            retry = failed and (repeatable or not connection_was_opened(error))
+        else:
+            failed = response.status_code >= 500
+            retry = response.status_code in retry_status_codes and (repeatable or response.status_code in (429, 503))
+            if retry and response.status_code in (429, 503):
+                wait_time = get_retry_after(response)
+                if wait_time is not None:
+                    wait_time = min(wait_time, max_retry_after_in_seconds)
+
+        if failed:
+            if circuit_breaker.record_failure():
+                print('WARNING: Suspending requests to', server, 'for', circuit_breaker_reset_in_seconds, 'seconds after repeated failures')
+        else:
+            circuit_breaker.record_success()
+
+        if not retry or attempt >= max_attempts:
+            if error is not None:
+                raise error
+            return response
+
+        if wait_time is None:
+            wait_time = random.uniform(0, min(max_retry_backoff_in_seconds, retry_backoff_in_seconds * 2 ** (attempt - 1)))
+        if not quiet_mode:
+            print('WARNING:', method, request_url, 'failed with', error if error is not None else response.status_code,
+                  '. Retrying in', round(wait_time, 1), 'seconds (attempt', attempt + 1, 'of', str(max_attempts) + ')')
+        time.sleep(wait_time)
+        attempt += 1
+
+# Raises requests.exceptions.HTTPError for a response which, after any retries by
+# send_request, does not have the expected status code
+def check_response(response, expected_status_code=200):
+    if response.status_code != expected_status_code:
+        raise requests.exceptions.HTTPError(f'Unexpected return code {response.status_code} on {response.request.method} {response.url}', response=response)
+
+# Sends an HTTP request, applying the retry policy and circuit breaker above.
+# All methods in this file route their requests through here.
+def send_request(method, request_url, max_attempts=None, **kwargs):
+    return send_with_retries(method, request_url, lambda: requests.request(method, request_url, **kwargs), max_attempts=max_attempts)
 
 # Export Device List to disk in Excel format
 def export_devices(include_deactivated=False):
@@ -101,7 +266,7 @@ def archive_devices(device_ids, unarchive=False):
     payload = {'ids': device_ids}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
@@ -190,14 +355,14 @@ def enable_upgrades(platforms=['WINDOWS','MAC'], automatic_upgrade=True, return_
             # If yes, get policy data from the server
             policy_id = policy['id']
             request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
+            response = send_request('GET', request_url, headers=headers)
             policy_data = response.json()
             # Check if the upgrade setting needs changing
             if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
                 # If yes, set it to desired setting
                 policy_data['data']['automatic_upgrade'] = automatic_upgrade
                 # Write modified policy data back to server (saving change)
-                response = requests.put(request_url, json=policy_data, headers=headers)
+                response = send_request('PUT', request_url, json=policy_data, headers=headers)
                 # Increment the counter of how many policies we have modified
                 modified_policy_counter += 1
                 modified_policies_id_list.append(policy['id'])
@@ -228,14 +393,14 @@ def enable_upgrades_for_list_of_policy_ids(policy_ids, automatic_upgrade=True):
     # Iterate through the poliocy ids provided
     for policy_id in policy_ids:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
         policy_data = response.json()
         # Check if the upgrade setting needs changing
         if policy_data['data']['automatic_upgrade'] != automatic_upgrade:
             # If yes, set it to desired setting
             policy_data['data']['automatic_upgrade'] = automatic_upgrade
             # Write modified policy data back to server (saving change)
-            request = requests.put(request_url, json=policy_data, headers=headers)
+            request = send_request('PUT', request_url, json=policy_data, headers=headers)
             # Increment the counter of how many policies we have modified
             modified_policy_counter += 1
 
@@ -247,7 +412,7 @@ def get_tenants():
     #get data
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
@@ -273,13 +438,12 @@ def get_devices(include_deactivated=True):
     # device id returned. We will know we have all devices visible to our API
     # key when we get last_id=None in a response.
 
-    error_count = 0
     # COLLECT DATA
-    while last_id != None and error_count < 10: #loop until all visible devices have been collected
+    while last_id != None: #loop until all visible devices have been collected
         #calculate URL for request
         request_url = f'https://{fqdn}/api/v1/devices?after_device_id={last_id}'
         #make request, store response
-        response = requests.get(request_url, headers=headers)
+        response = send_request('GET', request_url, headers=headers)
         if response.status_code == 200:
             response = response.json() #convert to Python list
             if 'last_id' in response:
@@ -293,10 +457,9 @@ def get_devices(include_deactivated=True):
                     if device['license_status'] == 'ACTIVATED' or include_deactivated:
                         collected_devices.append(device) #add to collected devices
         else:
-            print('WARNING: Unexpected return code', response.status_code,
-            'on request to\n', request_url, '\nwith headers\n', headers)
-            error_count += 1  #increment error counter
-            time.sleep(10) #wait before trying request again
+            #send_request has already retried with backoff, so give up rather than return a partial device list
+            print('ERROR:', request_url, 'returned an unexpected status code', response.status_code)
+            check_response(response)
     print('\n')
 
     # When while loop exists, we know we have collected all visible data
@@ -368,7 +531,7 @@ def add_devices_to_group(device_ids, group_id, remove=False):
     payload = {'devices': device_ids}
 
     # Send to server, return confirmation if successful
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
     if response.status_code == 204: #expected return code
         if remove:
             return str(len(device_ids)) + ' devices removed from group ' + str(group_id)
@@ -392,7 +555,7 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
     request_url = f'https://{fqdn}/api/v1/policies/'
 
     # Get data, convert to Python list
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     policies = response.json()
 
     # Apply filter based on msp, if enabled
@@ -411,7 +574,7 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
             # Extract ID, calculate URL, and pull policy data from server
             policy_id = policy['id']
             request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/data'
-            response = requests.get(request_url, headers=headers)
+            response = send_request('GET', request_url, headers=headers)
             print(request_url, 'returned', response.status_code, end='\r')
             # Check response code (for some platforms, no policy data available)
             if response.status_code == 200:
@@ -450,7 +613,7 @@ def get_policies(include_policy_data=False, include_allow_deny_lists=False, keep
             for list_type in allow_deny_and_exclusion_list_types:
 
                 request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/{list_type}'
-                response = requests.get(request_url, headers=headers)
+                response = send_request('GET', request_url, headers=headers)
                 print(request_url, 'returned', response.status_code, end='\r')
                 if response.status_code == 200:
                     response = response.json()
@@ -466,7 +629,7 @@ def get_msps():
     #get data
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     #return data
     if response.status_code == 200:
@@ -485,7 +648,7 @@ def create_msp(msp_name, license_limit):
     payload = {'name': msp_name, 'license_limit': license_limit}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 200:
@@ -516,7 +679,7 @@ def delete_msp(msp_name):
     # DELETE THE MSP
     request_url = f'https://{fqdn}/api/v1/multitenancy/msp/{msp_id}'
     headers = {'Authorization': key}
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url, headers=headers)
 
     # RETURN SUCCESS/FAILURE BASED ON RETURN CODE
     if response.status_code == 204:
@@ -544,7 +707,7 @@ def remove_device(device, device_id_only=False):
     #UNINSTALL THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/remove'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -578,7 +741,7 @@ def get_events(search={}, minimum_event_id=0, suspicious=False):
             request_url = f'https://{fqdn}/api/v1/events/search?after_event_id={str(minimum_event_id)}'
 
         #make request to server, store response
-        response = requests.post(request_url, headers=headers, json=search)
+        response = send_request('POST', request_url, headers=headers, json=search)
 
         #check HTTP return code, and in case of error exit the method and return empty list
         if response.status_code != 200:
@@ -617,7 +780,7 @@ def get_groups(exclude_default_groups=False):
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/groups/'
     # Get Device Groups from server
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     #Check response code
     if response.status_code == 200:
         groups = response.json() #convert to Python list
@@ -638,7 +801,7 @@ def get_device(device_id):
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}'
     # Get data on the requested device ID from the server
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     # Check response code
     if response.status_code == 200:
         device = response.json() #convert to Python list
@@ -674,7 +837,7 @@ def archive_events (event_id_list, unarchive=False, suspicious=False, input_is_i
         request_url = f'https://{fqdn}/api/v1/suspicious-events/actions/unarchive'
 
     #send request to server
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = send_request('POST', request_url, headers=headers, json=payload)
 
     #return true if successful, false otherwise
     return (response.status_code == 204)
@@ -716,7 +879,7 @@ def get_event(event_id, suspicious=False):
         request_url = f'https://{fqdn}/api/v1/events/{str(event_id)}'
 
     #make request, store response
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
 
     # based on response code, return event or alternately an error code
     if response.status_code == 200:
@@ -740,7 +903,7 @@ def create_policy(name, base_policy_id, comment='', quiet_mode=False):
     payload = {'name': name, 'comment': comment, 'base_policy_id': base_policy_id}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check response code
     if response.status_code == 200:
@@ -762,7 +925,7 @@ def delete_policy(policy_id):
     request_url = f'https://{fqdn}/api/v1/policies/{policy_id}'
 
     # Send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url, headers=headers)
 
     # Check response code
     if response.status_code == 204:
@@ -834,7 +997,7 @@ def create_tenant(tenant_name, license_limit, msp_name):
     request_url = f'https://{fqdn}/api/v1/multitenancy/tenant/'
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return success or descriptive error
     if response.status_code == 200: #tenant creation was successful
@@ -878,7 +1041,7 @@ def delete_tenant(tenant_name, msp_name):
     headers = {'Authorization': key}
 
     #send request to server
-    response = requests.delete(request_url, headers=headers)
+    response = send_request('DELETE', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -904,7 +1067,7 @@ def request_agent_logs(device_id, device_id_only=True):
     headers = {'Authorization': key, 'accept': 'application/json'}
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -941,7 +1104,7 @@ def close_events(event_id_list, open=False, suspicious=False):
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -984,7 +1147,7 @@ def archive_events(event_id_list, unarchive=False, suspicious=False):
     payload = {'ids': event_id_list}
 
     # Send request to server
-    response = requests.post(request_url, json=payload, headers=headers)
+    response = send_request('POST', request_url, json=payload, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1011,7 +1174,7 @@ def disable_device(device, device_id_only=False):
     #DISABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/disable'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1036,7 +1199,7 @@ def enable_device(device, device_id_only=False):
     #ENABLE THE DEVICE
     request_url = f'https://{fqdn}/api/v1/devices/{device_id}/actions/enable'
     headers = {'Authorization': key}
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     #RETURN TRUE/FALSE BASED ON WHETHER WE GOT THE EXPECTED RETURN CODE
     if response.status_code == 204:
@@ -1112,7 +1275,7 @@ def is_prevention_policy(policy, exclude_static_analysis=False, exclude_ransomwa
 def download_uploaded_file(file_hash):
     headers = {'accept': 'application/json', 'Authorization': key}
     request_url = f'https://{fqdn}/api/v1/events/actions/download-uploaded-file/{file_hash}'
-    response = requests.get(request_url, headers=headers)
+    response = send_request('GET', request_url, headers=headers)
     if response.status_code == 200:
         folder_name = create_export_folder()
         file_name = f'{file_hash}.zip'
@@ -1129,7 +1292,7 @@ def request_malware_sample(event_id):
     request_url = f'https://{fqdn}/api/v1/devices/actions/request-remote-file-upload/{event_id}'
 
     # Send request to server
-    response = requests.post(request_url, headers=headers)
+    response = send_request('POST', request_url, headers=headers)
 
     # Check return code and return Success or descriptive error
     if response.status_code == 204:
@@ -1159,7 +1322,7 @@ def isolate_from_network(devices, release_from_isolation=False, input_is_hostnam
                 'Authorization': key}
     payload = {'ids': device_ids}
 
-    response = requests.post(request_url, headers=headers, json=payload)
+    response = send_request('POST', request_url, headers=headers, json=payload)
 
     if response.status_code == 200:
         if remove_from_isolation:
@@ -1198,7 +1361,7 @@ def add_hashes_to_deny_list(hash_list, policy_id=0, all_policies=False, platform
     error_count = 0
     for policy_id in policy_id_list:
         request_url = f'https://{fqdn}/api/v1/policies/{policy_id}/deny-list/hashes'
-        response = requests.post(request_url, headers=headers, json=payload)
+        response = send_request('POST', request_url, headers=headers, json=payload)
         if response.status_code == 204:
             print('INFO: Successfully added', len(payload['items']), 'hashes to the deny list for policy', policy_id)
         else:
@@ -1249,7 +1412,7 @@ def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['W
         request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/data'
         headers = {'accept': 'application/json', 'Authorization': key}
         payload = {'data': policy['data']}
-        response = requests.put(request_url, json=payload, headers=headers)
+        response = send_request('PUT', request_url, json=payload, headers=headers)
         if response.status_code != 204:
             print('ERROR: Unexpected response', response.status_code, 'on PUT to', request_url)
 
@@ -1260,7 +1423,7 @@ def migrate_policies(source_msp_id, destination_msp_id, platforms_to_migrate=['W
                 if len(policy['allow_deny_and_exclusion_lists'][list_type]['items']) > 0:
                     payload = policy['allow_deny_and_exclusion_lists'][list_type]
                     request_url = f'https://{fqdn}/api/v1/policies/{new_policy_id}/{list_type}'
-                    response = requests.post(request_url, headers=headers, json=payload)
+                    response = send_request('POST', request_url, headers=headers, json=payload)
                     if response.status_code != 204:
                         print('ERROR: Unexpected response', response.status_code, 'on POST to', request_url, 'with payload', payload)
 
@@ -16,44 +16,285 @@
 #
 
 #Import required libraries
-import requests, base64, json, urllib3
+import requests, base64, json, urllib3, os, threading, copy, time
 
 #Disable SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+#Size of the blocks read from disk while streaming a file to the scanner
+stream_chunk_size = 1024 * 1024
+
+
+#File-like wrapper which base64-encodes an open file incrementally as it is read, so that
+#the encoded copy of the file is never held in memory in full. Exposes its total encoded
+#length so that the request is still sent with a Content-Length header.
+class Base64FileStream:
+
+    def __init__(self, f, chunk_size=None):
+        self.f = f
+        #read size must be a multiple of 3 so that each block encodes without padding
+        self.chunk_size = max(3, ((chunk_size or stream_chunk_size) // 3) * 3)
+        self.length = 4 * ((os.fstat(f.fileno()).st_size + 2) // 3)
+        self.buffer = b''
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            raw_data = self.f.read(self.chunk_size)
+            if not raw_data:
+                break
+            self.buffer += base64.b64encode(raw_data)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+#Reusable client for one or more Agentless scanners. Holds a pooled requests.Session per
+#scanner so that connections (and their TLS handshakes) are kept alive and reused between
+#scans, and distributes scans across the scanners, either round-robin or (load_balancing =
+#'least_loaded') to the scanner with the lowest expected wait based on its in-flight scans
+#and latency. Size pool_size to match the number of threads scanning concurrently.
+#
+#Each scanner's in-flight count, latency EWMA and error rate are tracked (see get_stats).
+#A scan which fails with a connection error, timeout or 5xx response is retried once on
+#another scanner, and a scanner which fails max_consecutive_errors scans in a row is ejected
+#(receives no scans) for a backoff period which doubles on each consecutive ejection. After
+#the backoff the next scan sent to it acts as a probe: success restores it, failure ejects
+#it again. Optionally answers scans of previously scanned content from a
+#verdict_cache.VerdictCache. Safe to share between threads.
+class AgentlessScanner:
+
+    def __init__(self, scanner_ips, scanner_port=5000, protocol='https', pool_size=10, timeout=20, verify=False, verdict_cache=None,
+                 load_balancing='round_robin', max_consecutive_errors=3, ejection_backoff_in_seconds=5, max_ejection_backoff_in_seconds=300,
+                 ewma_weight=0.2, retry_on_another_scanner=True):
+        if load_balancing not in ('round_robin', 'least_loaded'):
+            raise ValueError(f'Unsupported load_balancing {load_balancing}')
+        if isinstance(scanner_ips, str):
+            scanner_ips = [scanner_ips]
+        if len(scanner_ips) == 0:
+            raise ValueError('At least one scanner IP is required')
+        self.scanner_ips = list(scanner_ips)
+        self.scanner_port = scanner_port
+        self.protocol = protocol
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.verify = verify
+        self.verdict_cache = verdict_cache
+        self.sessions = {}
+        for scanner_ip in self.scanner_ips:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount(f'{protocol}://', adapter)
+            self.sessions[scanner_ip] = session
+        self.load_balancing = load_balancing
+        self.max_consecutive_errors = max_consecutive_errors
+        self.ejection_backoff_in_seconds = ejection_backoff_in_seconds
+        self.max_ejection_backoff_in_seconds = max_ejection_backoff_in_seconds
+        self.ewma_weight = ewma_weight
+        self.retry_on_another_scanner = retry_on_another_scanner
+        self.scanner_stats = {}
+        for scanner_ip in self.scanner_ips:
+            self.scanner_stats[scanner_ip] = {'in_flight': 0, 'scans': 0, 'errors': 0, 'consecutive_errors': 0,
+                                              'latency_ewma_in_seconds': None, 'error_rate_ewma': 0.0,
+                                              'ejections': 0, 'consecutive_ejections': 0, 'ejected_until': 0}
+        self.next_scanner_index = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+    #returns the scanner to send the next scan to, skipping ejected scanners and those in exclude
+    def get_scanner_ip(self, exclude=()):
+        with self.lock:
+            return self.select_scanner_ip(exclude)
+
+    #selects a scanner (called with lock held)
+    def select_scanner_ip(self, exclude=()):
+        now = time.monotonic()
+        candidates = [scanner_ip for scanner_ip in self.scanner_ips if scanner_ip not in exclude] or self.scanner_ips
+        healthy = [scanner_ip for scanner_ip in candidates if self.scanner_stats[scanner_ip]['ejected_until'] <= now]
+        if len(healthy) == 0:
+            #every scanner is ejected; use the one due back soonest rather than failing the scan
+            healthy = [min(candidates, key=lambda scanner_ip: self.scanner_stats[scanner_ip]['ejected_until'])]
+
+        #start from the next scanner in rotation, so that ties are spread evenly
+        rotation = self.scanner_ips[self.next_scanner_index:] + self.scanner_ips[:self.next_scanner_index]
+        healthy = [scanner_ip for scanner_ip in rotation if scanner_ip in healthy]
+        if self.load_balancing == 'least_loaded':
+            known_latencies = [self.scanner_stats[scanner_ip]['latency_ewma_in_seconds'] for scanner_ip in self.scanner_ips
+                               if self.scanner_stats[scanner_ip]['latency_ewma_in_seconds'] is not None]
+            default_latency = sum(known_latencies) / len(known_latencies) if known_latencies else 0
+            def expected_wait(scanner_ip):
+                latency = self.scanner_stats[scanner_ip]['latency_ewma_in_seconds']
+                in_flight = self.scanner_stats[scanner_ip]['in_flight']
+                return ((in_flight + 1) * (latency if latency is not None else default_latency), in_flight)
+            scanner_ip = min(healthy, key=expected_wait)
+        else:
+            scanner_ip = healthy[0]
+        self.next_scanner_index = (self.scanner_ips.index(scanner_ip) + 1) % len(self.scanner_ips)
+        return scanner_ip
+
+    #selects a scanner (unless one is given) and counts the scan as in flight on it
+    def acquire_scanner(self, scanner_ip=None, exclude=()):
+        with self.lock:
+            if scanner_ip is None:
+                scanner_ip = self.select_scanner_ip(exclude)
+            self.scanner_stats[scanner_ip]['in_flight'] += 1
+        return scanner_ip
+
+    #records the outcome of a scan, ejecting the scanner if it has failed too many scans in a row
+    def release_scanner(self, scanner_ip, latency_in_seconds, failed):
+        with self.lock:
+            stats = self.scanner_stats[scanner_ip]
+            stats['in_flight'] -= 1
+            stats['scans'] += 1
+            stats['error_rate_ewma'] += self.ewma_weight * ((1.0 if failed else 0.0) - stats['error_rate_ewma'])
+            if failed:
+                stats['errors'] += 1
+                stats['consecutive_errors'] += 1
+                if stats['consecutive_errors'] >= self.max_consecutive_errors:
+                    backoff_in_seconds = min(self.max_ejection_backoff_in_seconds, self.ejection_backoff_in_seconds * 2 ** stats['consecutive_ejections'])
+                    stats['ejected_until'] = time.monotonic() + backoff_in_seconds
+                    stats['ejections'] += 1
+                    stats['consecutive_ejections'] += 1
+                    print('WARNING: Scanner', scanner_ip, 'failed', stats['consecutive_errors'], 'consecutive scans and is ejected for', backoff_in_seconds, 'seconds')
+            else:
+                stats['consecutive_errors'] = 0
+                stats['consecutive_ejections'] = 0
+                if stats['latency_ewma_in_seconds'] is None:
+                    stats['latency_ewma_in_seconds'] = latency_in_seconds
+                else:
+                    stats['latency_ewma_in_seconds'] += self.ewma_weight * (latency_in_seconds - stats['latency_ewma_in_seconds'])
+
+    #returns a snapshot of the per-scanner statistics
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            results = {}
+            for scanner_ip, stats in self.scanner_stats.items():
+                results[scanner_ip] = {'healthy': stats['ejected_until'] <= now,
+                                       'in_flight': stats['in_flight'],
+                                       'scans': stats['scans'],
+                                       'errors': stats['errors'],
+                                       'error_rate_ewma': round(stats['error_rate_ewma'], 4),
+                                       'latency_ewma_in_seconds': round(stats['latency_ewma_in_seconds'], 4) if stats['latency_ewma_in_seconds'] is not None else None,
+                                       'ejections': stats['ejections'],
+                                       'ejected_for_seconds': round(max(0, stats['ejected_until'] - now), 1)}
+        return results
+
+    #sends one scan request to the given scanner and returns the response and URL
+    def send_scan(self, scanner_ip, file_name, encoded=False):
+
+        # open file from disk (rb means opens the file in binary format for reading); the file
+        # is streamed to the scanner in blocks rather than read into memory, so memory use
+        # per scan is bounded regardless of file size
+        with open(file_name, 'rb') as f:
+
+            if encoded:
+                #encode data as it is sent and set URL to match
+                data = Base64FileStream(f)
+                request_url = f'{self.protocol}://{scanner_ip}:{self.scanner_port}/scan/base64'
+            else:
+                #leave data as-is and set URL to match
+                data = f
+                request_url = f'{self.protocol}://{scanner_ip}:{self.scanner_port}/scan/binary'
+
+            #an empty file is sent as an empty body (a zero-length stream would be sent chunked)
+            if os.fstat(f.fileno()).st_size == 0:
+                data = b''
+
+            # send scan request, capture response
+            response = self.sessions[scanner_ip].post(request_url, data=data, timeout=self.timeout, verify=self.verify)
+
+        return response, request_url
+
+    def scan_file(self, file_name, simplified=False, encoded=False, scanner_ip=None, verdict_cache=None):
+
+        if verdict_cache is None:
+            verdict_cache = self.verdict_cache
+
+        #return the cached verdict if this content has been scanned before
+        #(verdict_cache.py is only imported when a cache is in use)
+        if verdict_cache is not None:
+            from verdict_cache import hash_file
+            file_hash = hash_file(file_name)
+            verdict = verdict_cache.get(file_hash, source='agentless')
+            if verdict is not None:
+                return simplify_verdict(verdict) if simplified else verdict
+
+        #send the scan, retrying once on another scanner if it fails with a connection error, timeout or 5xx
+        tried_scanner_ips = []
+        while True:
+            scanner_ip = self.acquire_scanner(scanner_ip if len(tried_scanner_ips) == 0 else None, exclude=tried_scanner_ips)
+            tried_scanner_ips.append(scanner_ip)
+            can_retry = self.retry_on_another_scanner and len(tried_scanner_ips) == 1 and len(self.scanner_ips) > 1
+            start_time = time.perf_counter()
+            try:
+                response, request_url = self.send_scan(scanner_ip, file_name, encoded)
+            except requests.exceptions.RequestException as e:
+                self.release_scanner(scanner_ip, time.perf_counter() - start_time, failed=True)
+                if can_retry:
+                    print('WARNING: Scan of', file_name, 'on', scanner_ip, 'failed with', type(e).__name__, 'and will be retried on another scanner')
+                    continue
+                raise
+            self.release_scanner(scanner_ip, time.perf_counter() - start_time, failed=response.status_code >= 500)
+            if response.status_code >= 500 and can_retry:
+                print('WARNING: Scan of', file_name, 'on', scanner_ip, 'returned', response.status_code, 'and will be retried on another scanner')
+                continue
+            break
+
+        # validate response code and proceed if expected value 200
+        if response.status_code == 200:
+            #convert to Python dictionary
+            verdict = response.json()
+            if verdict_cache is not None:
+                simplified_verdict = simplify_verdict(copy.deepcopy(verdict))
+                if simplified_verdict is not None:
+                    verdict_cache.put(file_hash, verdict, source='agentless', verdict=simplified_verdict['verdict'], scan_guid=simplified_verdict['scan_guid'])
+            if simplified:
+                #Call function to simplify the verdict
+                verdict = simplify_verdict(verdict)
+            #Return [simplified] verdict
+            return verdict
+        else:
+            print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url)
+            return None
+
+
+#AgentlessScanner which routes each scan to the least-loaded healthy scanner in a fleet
+class ScannerPool(AgentlessScanner):
+
+    def __init__(self, scanner_ips, load_balancing='least_loaded', **kwargs):
+        super().__init__(scanner_ips, load_balancing=load_balancing, **kwargs)
+
+
+#AgentlessScanner objects used by scan_file, one per scanner endpoint, so that repeated
+#calls to scan_file reuse connections
+scanners = {}
+scanners_lock = threading.Lock()
+
+def get_scanner(scanner_ip, scanner_port=5000, protocol='https'):
+    with scanners_lock:
+        if (scanner_ip, scanner_port, protocol) not in scanners:
+            scanners[(scanner_ip, scanner_port, protocol)] = AgentlessScanner(scanner_ip, scanner_port=scanner_port, protocol=protocol)
+        return scanners[(scanner_ip, scanner_port, protocol)]
+
+
 #Primary method which accepts file name and optional config data, submits scan, simplifies it, and returns result
-def scan_file(file_name, scanner_ip, simplified=False, encoded=False, scanner_port=5000, protocol='https'):
-
-    # read file from disk (rb means opens the file in binary format for reading)
-    with open(file_name, 'rb') as f:
-        #read file
-        data = f.read()
-        #close file
-        f.close()
-
-    if encoded:
-        #encode data and set URL to match
-        data = base64.b64encode(data)
-        request_url = f'{protocol}://{scanner_ip}:{scanner_port}/scan/base64'
-    else:
-        #leave data as-is and set URL to match
-        request_url = f'{protocol}://{scanner_ip}:{scanner_port}/scan/binary'
-
-    # send scan request, capture response
-    response = requests.post(request_url, data=data, timeout=20, verify=False)
-
-    # validate response code and proceed if expected value 200
-    if response.status_code == 200:
-        #convert to Python dictionary
-        verdict = response.json()
-        if simplified:
-            #Call function to simplify the verdict
-            verdict = simplify_verdict(verdict)
-        #Return [simplified] verdict
-        return verdict
-    else:
-        print('ERROR: Unexpected return code', response.status_code, 'on POST to', request_url)
-        return None
+#(pass a verdict_cache.VerdictCache as verdict_cache to answer previously scanned content locally)
+def scan_file(file_name, scanner_ip, simplified=False, encoded=False, scanner_port=5000, protocol='https', verdict_cache=None):
+    scanner = get_scanner(scanner_ip, scanner_port=scanner_port, protocol=protocol)
+    return scanner.scan_file(file_name, simplified=simplified, encoded=encoded, verdict_cache=verdict_cache)
 
 
 #Wrapper which invokes scan_file with the parameter to use encoding
@@ -52,6 +52,14 @@ def main():
         elif user_input.lower() in ['yes', '']:
             config['ignore_suspicious_events'] = False
 
+    config['use_event_store'] = ''
+    while config['use_event_store'] not in [True, False]:
+        user_input = input('YES/NO: Use local event store (only downloads events newer than the last run; status changes to previously stored events are not picked up) [NO]: ')
+        if user_input.lower() == 'yes':
+            config['use_event_store'] = True
+        elif user_input.lower() in ['no', '']:
+            config['use_event_store'] = False
+
     config['ignore_html_applications_action'] = ''
     while config['ignore_html_applications_action'] not in [True, False]:
         user_input = input('YES/NO: Ignore "HTML Applications (HTA files) and JavaScript via rundll32 executions" policy setting [NO]: ')
@@ -195,6 +203,7 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
     di.fqdn = fqdn
     di.key = key
     di.quiet_mode = True
+    di.use_event_store = config.get('use_event_store', False)
     config = config
     mt = di.is_server_multitenancy_enabled()
 
@@ -247,13 +256,11 @@ def run_deployment_phase_progression_readiness(fqdn, key, config):
             print(result)
             policy_evaluation_results.append(result)
 
+    di.join_records(devices, policies, 'policy_id', {'deployment_phase': 'deployment_phase'})
     filtered_devices = []
     for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                device['deployment_phase'] = policy['deployment_phase']
-                if device['deployment_phase'] == config['deployment_phase']:
-                    filtered_devices.append(device)
+        if 'deployment_phase' in device and device['deployment_phase'] == config['deployment_phase']:
+            filtered_devices.append(device)
     excluded_device_count = len(devices) - len(filtered_devices)
     devices = filtered_devices
 
@@ -0,0 +1,473 @@
+# Library file which defines a forwarder engine used by event_forwarder_slack.py
+# and event_forwarder_email.py to deliver new events from a Deep Instinct server
+# to one or more destinations ("sinks") from a single pull of events.
+#
+# Events are read with deepinstinct3.iter_events and grouped into batches of up
+# to batch_size events, or fewer if batch_window_in_seconds elapses before the
+# batch is full. Each batch is handed to all sinks concurrently, and while one
+# batch is being delivered the next one is being fetched. Sinks keep their
+# connections open between batches (a pooled session per webhook, a single SMTP
+# login for e-mail).
+#
+# Between fetch and delivery every event is written to a local SQLite queue
+# (queue_file_name), in the same transaction which advances the high water mark,
+# so an event is either queued or will be fetched again after a restart. Each
+# sink acknowledges events individually: delivered events are removed from the
+# queue, failed events are retried with exponential backoff on later polls, and
+# events which still fail after max_attempts are moved to a dead letter table
+# where they are kept for inspection (see DeliveryQueue.requeue_dead_letters).
+# An event is only sent again to a sink which had not acknowledged it, which can
+# happen at most once per event if the process stops mid-delivery.
+#
+# EventForwarder.run polls at an adaptive interval: immediately after a poll
+# which returned new events it waits only min_sleep_time_in_seconds, and after
+# each poll which returned none the wait doubles, up to sleep_time_in_seconds.
+# The delay between each event being recorded on the server (its
+# insertion_timestamp) and being delivered is measured, and a summary is printed
+# after each poll (see get_delivery_delay_stats).
+#
+# A sink is any object with a unique name attribute and a send_batch(events)
+# method which returns a dictionary mapping the id of each event which could not
+# be delivered to a description of the error.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
+#
+#
+
+#Import required libraries
+import json, time, datetime, random, sqlite3, threading, collections, contextlib, requests, concurrent.futures, deepinstinct3 as di
+
+
+#prints a message to console prefixed with the current time
+def log(*message):
+    print(datetime.datetime.now().strftime("%H:%M"), *message)
+
+
+#returns the number of seconds since an event was recorded on the server, or None if unknown
+def get_event_age_in_seconds(event, now=None):
+    timestamp = event.get('insertion_timestamp') or event.get('timestamp')
+    if not timestamp:
+        return None
+    try:
+        recorded_at = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return (now - recorded_at).total_seconds()
+
+
+#returns the value at percentile p (0 to 100) of a sorted list
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+#splits a list of events into consecutive lists of up to size events
+def group_events(events, size):
+    return [events[i:i + size] for i in range(0, len(events), max(1, size))]
+
+
+class SlackSink:
+
+    #format_message, if provided, is called with a list of events and returns the payload to post
+    def __init__(self, webhook_url, max_workers=4, events_per_message=1, timeout=30, format_message=None, name='slack'):
+        self.webhook_url = webhook_url
+        self.max_workers = max_workers
+        self.events_per_message = events_per_message
+        self.timeout = timeout
+        self.format_message = format_message if format_message is not None else self.default_format_message
+        self.name = name
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    @staticmethod
+    def default_format_message(events):
+        if len(events) == 1:
+            return {'event_data': json.dumps(events[0], indent=4)}
+        return {'event_data': json.dumps(events, indent=4)}
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    #posts one message, raising an exception if the webhook did not accept it
+    def post(self, events):
+        response = self.session.post(self.webhook_url, json=self.format_message(events), timeout=self.timeout)
+        response.raise_for_status()
+
+    def send_batch(self, events):
+        messages = group_events(events, self.events_per_message)
+        futures = {self.executor.submit(self.post, message): message for message in messages}
+        failed = {}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except requests.exceptions.RequestException as e:
+                log('ERROR: Sending', len(futures[future]), 'event(s) to', self.name, 'failed:', e)
+                failed.update({event['id']: str(e) for event in futures[future]})
+        return failed
+
+
+class EmailSink:
+
+    #format_message, if provided, is called with a list of events and returns a (subject, body) tuple
+    def __init__(self, username, password, recipient, events_per_message=1, format_message=None, name='email'):
+        self.username = username
+        self.password = password
+        self.recipient = recipient
+        self.events_per_message = events_per_message
+        self.format_message = format_message if format_message is not None else self.default_format_message
+        self.name = name
+        self.smtp = None
+
+    @staticmethod
+    def default_format_message(events):
+        if len(events) == 1:
+            event = events[0]
+            hostname = event.get('recorded_device_info', {}).get('hostname')
+            return f"New DI event on {hostname} of type {event['type']} (ID {event['id']}) | {di.fqdn}", json.dumps(event, indent=4)
+        return f"{len(events)} new DI events (IDs {events[0]['id']} to {events[-1]['id']}) | {di.fqdn}", json.dumps(events, indent=4)
+
+    #opens the SMTP session on first use and keeps it open for subsequent messages
+    def connect(self):
+        if self.smtp is None:
+            import yagmail
+            self.smtp = yagmail.SMTP(self.username, self.password)
+        return self.smtp
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+            self.smtp = None
+
+    def send_batch(self, events):
+        failed = {}
+        for message in group_events(events, self.events_per_message):
+            subject, body = self.format_message(message)
+            #the server may have closed an idle session, so on failure reconnect and try once more
+            for attempt in (1, 2):
+                try:
+                    self.connect().send(self.recipient, subject, body)
+                    break
+                except Exception as e:
+                    self.close()
+                    if attempt == 2:
+                        log('ERROR: Sending', len(message), 'event(s) to', self.recipient, 'failed:', e)
+                        failed.update({event['id']: str(e) for event in message})
+        return failed
+
+
+class DeliveryQueue:
+
+    def __init__(self, path='event_forwarder.sqlite', max_attempts=10, retry_backoff_in_seconds=30,
+                 max_retry_backoff_in_seconds=3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_backoff_in_seconds = retry_backoff_in_seconds
+        self.max_retry_backoff_in_seconds = max_retry_backoff_in_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS pending (
+                                       sink TEXT NOT NULL,
+                                       event_id INTEGER NOT NULL,
+                                       event TEXT NOT NULL,
+                                       attempts INTEGER NOT NULL DEFAULT 0,
+                                       next_attempt_at REAL NOT NULL,
+                                       last_error TEXT,
+                                       PRIMARY KEY (sink, event_id))''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS dead_letters (
+                                       sink TEXT NOT NULL,
+                                       event_id INTEGER NOT NULL,
+                                       event TEXT NOT NULL,
+                                       attempts INTEGER NOT NULL,
+                                       failed_at REAL NOT NULL,
+                                       last_error TEXT,
+                                       PRIMARY KEY (sink, event_id))''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS checkpoints (
+                                       name TEXT PRIMARY KEY,
+                                       event_id INTEGER NOT NULL)''')
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    #returns the highest event id queued so far, or None if nothing has been queued yet
+    def get_checkpoint(self, name='events'):
+        with self.lock:
+            row = self.connection.execute('SELECT event_id FROM checkpoints WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_checkpoint(self, event_id, name='events'):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?)', (name, event_id))
+
+    #queues events for each of sink_names and advances the checkpoint to event_id in a single transaction
+    def enqueue(self, events, sink_names, event_id, name='events'):
+        now = time.time()
+        rows = [(sink_name, event['id'], json.dumps(event), now) for sink_name in sink_names for event in events]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO pending (sink, event_id, event, next_attempt_at) VALUES (?, ?, ?, ?)', rows)
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?)', (name, event_id))
+
+    #returns up to limit events queued for sink_name which are due to be sent, oldest first
+    def get_due(self, sink_name, limit):
+        with self.lock:
+            rows = self.connection.execute('SELECT event FROM pending WHERE sink = ? AND next_attempt_at <= ? ORDER BY event_id LIMIT ?',
+                                           (sink_name, time.time(), limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    #removes events delivered to sink_name from the queue
+    def ack(self, sink_name, event_ids):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM pending WHERE sink = ? AND event_id = ?',
+                                        [(sink_name, event_id) for event_id in event_ids])
+
+    #records a failed attempt for each event id in errors (a dictionary of event id to error), scheduling
+    #a retry with exponential backoff and jitter, or moving the event to dead_letters after max_attempts
+    def fail(self, sink_name, errors):
+        now = time.time()
+        dead_letter_count = 0
+        with self.lock, self.connection:
+            for event_id, error in errors.items():
+                row = self.connection.execute('SELECT attempts FROM pending WHERE sink = ? AND event_id = ?', (sink_name, event_id)).fetchone()
+                if row is None:
+                    continue
+                attempts = row[0] + 1
+                if attempts >= self.max_attempts:
+                    self.connection.execute('''INSERT OR REPLACE INTO dead_letters
+                                               SELECT sink, event_id, event, ?, ?, ? FROM pending WHERE sink = ? AND event_id = ?''',
+                                            (attempts, now, error, sink_name, event_id))
+                    self.connection.execute('DELETE FROM pending WHERE sink = ? AND event_id = ?', (sink_name, event_id))
+                    dead_letter_count += 1
+                else:
+                    backoff = min(self.max_retry_backoff_in_seconds, self.retry_backoff_in_seconds * 2 ** (attempts - 1))
+                    self.connection.execute('UPDATE pending SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE sink = ? AND event_id = ?',
+                                            (attempts, now + backoff * random.uniform(0.5, 1), error, sink_name, event_id))
+        return dead_letter_count
+
+    #moves dead letters (for one sink, or all sinks if sink_name is None) back to the queue for another round of attempts
+    def requeue_dead_letters(self, sink_name=None):
+        condition, parameters = ('WHERE sink = ?', (sink_name,)) if sink_name is not None else ('', ())
+        with self.lock, self.connection:
+            self.connection.execute(f'''INSERT OR IGNORE INTO pending (sink, event_id, event, next_attempt_at, last_error)
+                                        SELECT sink, event_id, event, ?, last_error FROM dead_letters {condition}''',
+                                    (time.time(),) + parameters)
+            return self.connection.execute(f'DELETE FROM dead_letters {condition}', parameters).rowcount
+
+    def get_stats(self):
+        with self.lock:
+            pending = self.connection.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+            dead_letters = self.connection.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+        return {'pending': pending, 'dead_letters': dead_letters}
+
+
+class AdaptivePollInterval:
+
+    #the interval drops to min_interval_in_seconds whenever a poll returns events, and is multiplied by
+    #backoff_factor (up to max_interval_in_seconds) after each poll which returns none
+    def __init__(self, min_interval_in_seconds=15, max_interval_in_seconds=300, backoff_factor=2):
+        self.min_interval_in_seconds = min_interval_in_seconds
+        self.max_interval_in_seconds = max_interval_in_seconds
+        self.backoff_factor = backoff_factor
+        self.interval = min_interval_in_seconds
+
+    #records the number of events returned by the last poll and returns the time to wait before the next one
+    def update(self, event_count):
+        if event_count:
+            self.interval = self.min_interval_in_seconds
+        else:
+            self.interval = min(self.max_interval_in_seconds, self.interval * self.backoff_factor)
+        return self.interval
+
+
+class EventForwarder:
+
+    #state_file_name is the plain text high water mark used by earlier versions of the forwarders, and
+    #is read only to initialize a new queue
+    def __init__(self, sinks, search={}, fields_to_remove=[], batch_size=50, batch_window_in_seconds=10,
+                 queue_file_name='event_forwarder.sqlite', state_file_name=None, max_attempts=10,
+                 retry_backoff_in_seconds=30, max_retry_backoff_in_seconds=3600):
+        if len(set(sink.name for sink in sinks)) != len(sinks):
+            raise ValueError('Each sink must have a unique name')
+        self.sinks = sinks
+        self.search = search
+        self.fields_to_remove = fields_to_remove
+        self.batch_size = batch_size
+        self.batch_window_in_seconds = batch_window_in_seconds
+        self.state_file_name = state_file_name
+        self.queue = DeliveryQueue(queue_file_name, max_attempts=max_attempts, retry_backoff_in_seconds=retry_backoff_in_seconds,
+                                   max_retry_backoff_in_seconds=max_retry_backoff_in_seconds)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(sinks)))
+        self.lock = threading.Lock()
+        self.delivered_count = 0
+        self.failed_count = 0
+        self.dead_letter_count = 0
+        self.delivery_delays = collections.deque(maxlen=10000)
+        self.poll_delivery_delays = []
+
+    def close(self):
+        self.executor.shutdown()
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+        self.queue.close()
+
+    #returns the highest event id queued previously, falling back to state_file_name for a new queue
+    def get_config(self):
+        event_id = self.queue.get_checkpoint()
+        if event_id is not None:
+            return event_id
+        try:
+            with open(self.state_file_name, 'r') as f:
+                return int(f.read())
+        except (OSError, TypeError, ValueError) as e:
+            return 0
+
+    def sanitize_event(self, event):
+        for field in self.fields_to_remove:
+            event.pop(field, None)
+        return event
+
+    #hands each sink its list of events at once and returns a future for each sink
+    def deliver(self, events_by_sink):
+        futures = {}
+        for sink in self.sinks:
+            events = events_by_sink.get(sink.name)
+            if events:
+                log('Sending events', events[0]['id'], 'to', events[-1]['id'], 'to', sink.name)
+                futures[sink.name] = (self.executor.submit(sink.send_batch, events), events)
+        return futures
+
+    #waits for a delivery to complete, then acknowledges delivered events and records failures in the queue
+    def complete(self, delivery):
+        for sink_name, (future, events) in delivery.items():
+            try:
+                errors = future.result() or {}
+            except Exception as e:
+                log('ERROR: Sink', sink_name, 'failed:', e)
+                errors = {event['id']: str(e) for event in events}
+            delivered_events = [event for event in events if event['id'] not in errors]
+            self.queue.ack(sink_name, [event['id'] for event in delivered_events])
+            now = datetime.datetime.now(datetime.timezone.utc)
+            delays = [delay for delay in (get_event_age_in_seconds(event, now) for event in delivered_events) if delay is not None]
+            dead_letter_count = self.queue.fail(sink_name, errors)
+            if dead_letter_count:
+                log('ERROR:', dead_letter_count, 'event(s) could not be delivered to', sink_name, 'and were moved to dead letters')
+            with self.lock:
+                self.delivered_count += len(events) - len(errors)
+                self.failed_count += len(errors)
+                self.dead_letter_count += dead_letter_count
+                self.delivery_delays.extend(delays)
+                self.poll_delivery_delays.extend(delays)
+
+    #returns percentiles of the delay in seconds between events being recorded on the server and being delivered,
+    #over the last 10000 deliveries (or over deliveries since the last poll started if last_poll_only is True)
+    def get_delivery_delay_stats(self, last_poll_only=False):
+        with self.lock:
+            delays = sorted(self.poll_delivery_delays if last_poll_only else self.delivery_delays)
+        return {'count': len(delays),
+                'p50': percentile(delays, 50),
+                'p90': percentile(delays, 90),
+                'p99': percentile(delays, 99),
+                'max': delays[-1] if delays else None}
+
+    #sends events left in the queue by failed attempts or an earlier run which are now due, and returns
+    #the number of events sent
+    def retry_due(self):
+        event_count = 0
+        while True:
+            events_by_sink = {sink.name: self.queue.get_due(sink.name, self.batch_size) for sink in self.sinks}
+            delivery = self.deliver(events_by_sink)
+            if not delivery:
+                return event_count
+            self.complete(delivery)
+            event_count += sum(len(events) for events in events_by_sink.values())
+
+    #queues a batch of new events for every sink and starts delivering it
+    def enqueue_and_deliver(self, batch):
+        self.queue.enqueue(batch, [sink.name for sink in self.sinks], max(event['id'] for event in batch))
+        return self.deliver({sink.name: batch for sink in self.sinks})
+
+    #pulls all events newer than the saved high water mark once, delivering them in batches, and
+    #returns the number of events read
+    def poll(self):
+        with self.lock:
+            self.poll_delivery_delays = []
+        retried_count = self.retry_due()
+        if retried_count:
+            log('Retried', retried_count, 'queued event deliveries')
+
+        max_event_processed_previously = self.get_config()
+        log('Getting new events with id greater than', max_event_processed_previously)
+
+        event_count = 0
+        batch = []
+        batch_started_at = None
+        in_flight = None
+        try:
+            #closing the generator on the way out also waits for its prefetch, so that no request to the
+            #server is still running once poll returns (the poller daemon then switches to another server)
+            with contextlib.closing(di.iter_events(search=self.search, minimum_event_id=max_event_processed_previously)) as events:
+                for event in events:
+                    if batch_started_at is None:
+                        batch_started_at = time.monotonic()
+                    batch.append(self.sanitize_event(event))
+                    event_count += 1
+                    if len(batch) >= self.batch_size or time.monotonic() - batch_started_at >= self.batch_window_in_seconds:
+                        #only one batch is delivered at a time, so that sinks receive events in order
+                        if in_flight is not None:
+                            self.complete(in_flight)
+                        in_flight = self.enqueue_and_deliver(batch)
+                        batch = []
+                        batch_started_at = None
+        finally:
+            #events already read are still queued and delivered if the pull was interrupted part way through
+            if in_flight is not None:
+                self.complete(in_flight)
+            if len(batch) > 0:
+                self.complete(self.enqueue_and_deliver(batch))
+
+        log(event_count, 'events were returned, max_event_processed_previously is now', self.get_config())
+        log('Queue:', self.queue.get_stats())
+        delay_stats = self.get_delivery_delay_stats(last_poll_only=True)
+        if delay_stats['count']:
+            log('Delivery delay in seconds: p50', round(delay_stats['p50'], 1), 'p90', round(delay_stats['p90'], 1), 'max', round(delay_stats['max'], 1))
+        return event_count
+
+    #polls for new events until the process is stopped, waiting between polls for an interval which adapts
+    #between min_sleep_time_in_seconds and sleep_time_in_seconds (pass only sleep_time_in_seconds for a fixed interval)
+    def run(self, sleep_time_in_seconds=300, min_sleep_time_in_seconds=None, backoff_factor=2):
+        if min_sleep_time_in_seconds is None:
+            min_sleep_time_in_seconds = sleep_time_in_seconds
+        poll_interval = AdaptivePollInterval(min_sleep_time_in_seconds, sleep_time_in_seconds, backoff_factor)
+        while True:
+            start_time = time.monotonic()
+            try:
+                event_count = self.poll()
+            except requests.exceptions.RequestException as e:
+                log('ERROR:', e)
+                event_count = 0
+            #the interval is measured from the start of each poll, so time spent delivering counts towards it
+            sleep_time = max(0, poll_interval.update(event_count) - (time.monotonic() - start_time))
+            log('Sleeping for', round(sleep_time), 'seconds')
+            time.sleep(sleep_time)
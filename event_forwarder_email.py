@@ -1,26 +1,35 @@
 # Example of how to build your own e-mail forwarder, meaning you can define
 # exactly what events you want to send and to who and with what template.
 # This sample uses https://pypi.org/project/yagmail/ to send e-mail using a
-# GMail account, but you can replace the  send_event_via_email method with your
-# own code to use any library and e-mail service of your choice.
+# GMail account, but you can replace the EmailSink in event_forwarder.py with
+# your own code to use any library and e-mail service of your choice. All
+# e-mails are sent over a single SMTP session which is kept open between
+# batches of events.
 #
 # USAGE
-# 1. Save the latest version of both this file (event_forwarder_email.py) and
-#    the DI API Wrapper (deepinstinct3.py) to the same folder on disk.
+# 1. Save the latest version of this file (event_forwarder_email.py), the
+#    forwarder engine (event_forwarder.py) and the DI API Wrapper
+#    (deepinstinct3.py) to the same folder on disk.
 # 2. Review and adjust configuration in-line below, then save changes.
 # 3. By default the script will pull all events matching your configured search
 #    parameters. To start at a specific event ID, save that ID as a file
-#    'event_forwarder_email.conf' in the same directory as the script.
-# 4. Optionally replace or modify the send_event_via_email() method to use
-#    any mail template, library, or service of your choosing.
+#    'event_forwarder_email.conf' in the same directory as the script before
+#    running it for the first time.
+# 4. Optionally replace or modify the format_email() method to use any mail
+#    template of your choosing.
 # 5. Execute the script with this command: python event_forwarder_email.py
 #
 # NOTE: In order to avoid re-sending the same events, the script maintains a
-#       record of the last event previously sent on disk. This is stored in
-#       'event_forwarder_email.conf' in the same directory as the script. This
-#       allows preservation of this "high water mark" even if the script is
-#       killed and restarted. Be cautious not to delete/rename/move the .conf
-#       file. Doing so will cause the script to re-send all events.
+#       record of the last event previously fetched, and of each event which
+#       has not yet been delivered, on disk. This is stored in
+#       'event_forwarder_email.sqlite' in the same directory as the script.
+#       This allows preservation of this "high water mark" and of undelivered
+#       events even if the script is killed and restarted. Failed deliveries
+#       are retried with increasing delays on later runs, and events which
+#       still fail after 10 attempts are kept in the dead_letters table of the
+#       same file. Be cautious not to delete/rename/move the .sqlite file.
+#       Doing so will cause the script to re-send all events. The .conf file is
+#       only read if the .sqlite file does not exist yet.
 #
 # DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S 
 # PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW, 
@@ -35,7 +44,7 @@
 #
 #
 #---import required libraries---
-import time, json, requests, datetime, yagmail, deepinstinct30 as di
+import json, deepinstinct3 as di, event_forwarder
 
 
 #---configuration---
@@ -51,9 +60,23 @@ password = 'PASSWORD'
 # Where to send the e-mails
 recepient = 'USER@DOMAIN'
 
-# Define sleep time between queries to server in seconds (default 5 minutes)
+# Define sleep time between queries to server in seconds. After a query which
+# returns new events the script waits min_sleep_time_in_seconds, and after each
+# query which returns none the wait doubles, up to sleep_time_in_seconds
+# (default 15 seconds to 5 minutes). Set both to the same value for a fixed
+# interval.
+min_sleep_time_in_seconds = 15
 sleep_time_in_seconds = 300
 
+# Define how many events are included in each e-mail (1 sends an e-mail per
+# event, a larger value sends a digest of up to that many events)
+events_per_message = 1
+
+# Define the maximum number of events in a batch, and the maximum time in
+# seconds to wait for a batch to fill before sending it
+batch_size = 50
+batch_window_in_seconds = 10
+
 # Define a list of fields to remove from events before sending the e-mail
 fields_to_remove = []
 
@@ -66,76 +89,28 @@ search_parameters = {}
 
 #---define methods used at runtime---
 
-# a method for forwarding a single event via e-mail
-def send_event_via_email(event, recepient):
-
-    subject_line = f"New DI event on {event['recorded_device_info']['hostname']} of type {event['type']} (ID {event['id']}) | {di.fqdn}"
-    body = json.dumps(event, indent=4)
-
-    try:
-        yag = yagmail.SMTP(username,password)
-        yag.send(recepient,subject_line,body)
-    except:
-        print('Error sending e-mail')
+# a method which builds the subject line and body of the e-mail for a list of events
+def format_email(events):
+    if len(events) == 1:
+        event = events[0]
+        subject_line = f"New DI event on {event['recorded_device_info']['hostname']} of type {event['type']} (ID {event['id']}) | {di.fqdn}"
+        body = json.dumps(event, indent=4)
     else:
-        print('Email was sent successfully')
-
-# a method to remove a key from a dictionary if it is present
-def remove_key(dict, key):
-    if key in dict:
-        dict.pop(key)
-
-# a method to remove unwanted fields from event data
-def sanitize_event(event):
-    for field in fields_to_remove:
-        remove_key(event, field)
-
-# a method to read config from .conf file on disk
-def get_config():
-    try:
-        with open('event_forwarder_email.conf', 'r') as f:
-            return int(f.read())
-    except OSError as e:
-        return 0
-
-# a method to write config to .conf file on disk
-def save_config(event_id):
-    try:
-        with open('event_forwarder_email.conf', 'w') as f:
-            f.write(str(event_id))
-    except OSError as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
+        subject_line = f"{len(events)} new DI events (IDs {events[0]['id']} to {events[-1]['id']}) | {di.fqdn}"
+        body = json.dumps(events, indent=4)
+    return subject_line, body
 
 
 #---runtime---
-while True:
-    max_event_processed_previously = get_config()
-    print('Getting new events with id greater than', max_event_processed_previously)
-
-    try:
-        new_events = di.get_events(minimum_event_id=max_event_processed_previously, search=search_parameters)
-    except requests.exceptions.RequestException as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
-        new_events = []
-
-    print(len(new_events), 'events were returned')
-
-    if len(new_events) > 0:
-
-        for event in new_events:
-            sanitize_event(event)
-            print('Sending event', event['id'], 'to', recepient)
-            try:
-                send_event_via_email(event, recepient)
-            except requests.exceptions.RequestException as e:
-                now = datetime.datetime.now()
-                print(now.strftime("%H:%M"), 'ERROR:', e)
-            if event['id'] > max_event_processed_previously:
-                max_event_processed_previously = event['id']
-
-    print('max_event_processed_previously is now', max_event_processed_previously)
-    save_config(max_event_processed_previously)
-    print('Sleeping for', sleep_time_in_seconds, 'seconds')
-    time.sleep(sleep_time_in_seconds)
+sinks = [event_forwarder.EmailSink(username, password, recepient, events_per_message=events_per_message,
+                                   format_message=format_email)]
+
+# Events can be sent to further destinations from the same pull by adding sinks,
+# for example a Slack workflow:
+#sinks.append(event_forwarder.SlackSink('https://hooks.slack.com/workflows/REDACTED'))
+
+forwarder = event_forwarder.EventForwarder(sinks, search=search_parameters, fields_to_remove=fields_to_remove,
+                                           batch_size=batch_size, batch_window_in_seconds=batch_window_in_seconds,
+                                           queue_file_name='event_forwarder_email.sqlite',
+                                           state_file_name='event_forwarder_email.conf')
+forwarder.run(sleep_time_in_seconds, min_sleep_time_in_seconds=min_sleep_time_in_seconds)
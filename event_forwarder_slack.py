@@ -3,20 +3,30 @@
 # a Slack Incoming Webhook.
 #
 # USAGE
-# 1. Save the latest version of both this file (event_forwarder_slack.py) and
-#    the DI API Wrapper (deepinstinct3.py) to the same folder on disk.
+# 1. Save the latest version of this file (event_forwarder_slack.py), the
+#    forwarder engine (event_forwarder.py) and the DI API Wrapper
+#    (deepinstinct3.py) to the same folder on disk.
 # 2. Review and adjust configuration in-line below, then save changes.
 # 3. By default the script will pull all events matching your configured search
 #    parameters. To start at a specific event ID, save that ID as a file
-#    'event_forwarder_slack.conf' in the same directory as the script.
+#    'event_forwarder_slack.conf' in the same directory as the script before
+#    running it for the first time.
 # 3. Execute the script with this command: python event_forwarder_slack.py
 
 # NOTE: In order to avoid re-sending the same events, the script maintains a
-#       record of the last event previously sent on disk. This is stored in
-#       'event_forwarder_slack.conf' in the same directory as the script. This
-#       allows preservation of this "high water mark" even if the script is
-#       killed and restarted. Be cautious not to delete/rename/move the .conf
-#       file. Doing so will cause the script to re-send all events.
+#       record of the last event previously fetched, and of each event which
+#       has not yet been delivered, on disk. This is stored in
+#       'event_forwarder_slack.sqlite' in the same directory as the script.
+#       This allows preservation of this "high water mark" and of undelivered
+#       events even if the script is killed and restarted. Failed deliveries
+#       are retried with increasing delays on later runs, and events which
+#       still fail after 10 attempts are kept in the dead_letters table of the
+#       same file. Be cautious not to delete/rename/move the .sqlite file.
+#       Doing so will cause the script to re-send all events. The .conf file is
+#       only read if the .sqlite file does not exist yet.
+#
+# NOTE: New events are sent in batches of up to batch_size events, with up to
+#       max_workers messages posted to Slack at once over a pooled connection.
 
 #
 # DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S 
@@ -32,19 +42,34 @@
 #
 
 #---import required libraries---
-import time, json, requests, datetime, deepinstinct30 as di
+import json, deepinstinct3 as di, event_forwarder
 
 
 #---configuration---
 di.fqdn = 'FOO.customers.deepinstinctweb.com'
 di.key = 'BAR'
 
-# Define sleep time between queries to server in seconds (default 5 minutes)
+# Define sleep time between queries to server in seconds. After a query which
+# returns new events the script waits min_sleep_time_in_seconds, and after each
+# query which returns none the wait doubles, up to sleep_time_in_seconds
+# (default 15 seconds to 5 minutes). Set both to the same value for a fixed
+# interval.
+min_sleep_time_in_seconds = 15
 sleep_time_in_seconds = 300
 
 # Define a webhook URL for sending event data to Slack
 webhook_url = 'https://hooks.slack.com/workflows/REDACTED'
 
+# Define how many messages are posted to Slack at once, and how many events are
+# included in each message (1 sends each event as a message of its own)
+max_workers = 4
+events_per_message = 1
+
+# Define the maximum number of events in a batch, and the maximum time in
+# seconds to wait for a batch to fill before sending it
+batch_size = 50
+batch_window_in_seconds = 10
+
 # Define a list of fields to remove from events before sending to Slack
 fields_to_remove = ['msp_name', 'msp_id', 'tenant_name', 'tenant_id',
                     'mitre_classifications',
@@ -60,68 +85,24 @@ search_parameters = {}
 
 #---define methods used at runtime---
 
-# a method for forwarding a single event to Slack using the provided webhook_url
-def send_event_to_slack(event):
-    slack_data = {'event_data': json.dumps(event, indent=4)}
-    response = requests.post(webhook_url, json=slack_data, headers={'Content-Type': 'application/json'})
-
-# a method to remove a key from a dictionary if it is present
-def remove_key(dict, key):
-    if key in dict:
-        dict.pop(key)
-
-# a method to remove unwanted fields from event data
-def sanitize_event(event):
-    for field in fields_to_remove:
-        remove_key(event, field)
-
-# a method to read config from .conf file on disk
-def get_config():
-    try:
-        with open('event_forwarder_slack.conf', 'r') as f:
-            return int(f.read())
-    except OSError as e:
-        return 0
-
-# a method to write config to .conf file on disk
-def save_config(event_id):
-    try:
-        with open('event_forwarder_slack.conf', 'w') as f:
-            f.write(str(event_id))
-    except OSError as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
+# a method which builds the message posted to Slack for a list of events
+def format_slack_message(events):
+    if len(events) == 1:
+        return {'event_data': json.dumps(events[0], indent=4)}
+    return {'event_data': json.dumps(events, indent=4)}
 
 
 #---runtime---
-while True:
-    max_event_processed_previously = get_config()
-    print('Getting new events with id greater than', max_event_processed_previously)
-
-    try:
-        new_events = di.get_events(minimum_event_id=max_event_processed_previously, search=search_parameters)
-    except requests.exceptions.RequestException as e:
-        now = datetime.datetime.now()
-        print(now.strftime("%H:%M"), 'ERROR:', e)
-        new_events = []
-
-    print(len(new_events), 'events were returned')
-
-    if len(new_events) > 0:
-
-        for event in new_events:
-            sanitize_event(event)
-            print('Sending event', event['id'], 'to Slack')
-            try:
-                send_event_to_slack(event)
-            except requests.exceptions.RequestException as e:
-                now = datetime.datetime.now()
-                print(now.strftime("%H:%M"), 'ERROR:', e)
-            if event['id'] > max_event_processed_previously:
-                max_event_processed_previously = event['id']
-
-        print('max_event_processed_previously is now', max_event_processed_previously)
-        save_config(max_event_processed_previously)
-
-    print('Sleeping for', sleep_time_in_seconds, 'seconds')
-    time.sleep(sleep_time_in_seconds)
+sinks = [event_forwarder.SlackSink(webhook_url, max_workers=max_workers, events_per_message=events_per_message,
+                                   format_message=format_slack_message)]
+
+# Events can be sent to further destinations from the same pull by adding sinks,
+# for example a second Slack workflow or e-mail:
+#sinks.append(event_forwarder.SlackSink('https://hooks.slack.com/workflows/REDACTED2', name='slack2'))
+#sinks.append(event_forwarder.EmailSink('USERNAME@gmail.com', 'PASSWORD', 'USER@DOMAIN'))
+
+forwarder = event_forwarder.EventForwarder(sinks, search=search_parameters, fields_to_remove=fields_to_remove,
+                                           batch_size=batch_size, batch_window_in_seconds=batch_window_in_seconds,
+                                           queue_file_name='event_forwarder_slack.sqlite',
+                                           state_file_name='event_forwarder_slack.conf')
+forwarder.run(sleep_time_in_seconds, min_sleep_time_in_seconds=min_sleep_time_in_seconds)
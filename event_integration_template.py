@@ -1,8 +1,14 @@
 # Generic template for building custom integrations with events in a standalone
 # Python file (no need for API Wrapper). Shows how to query the server for new
-# events at a 5 minute intervals. Just drop in code for whatever you want to do
+# events at 15 second to 5 minute intervals. Just drop in code for whatever you want to do
 # with those events.
 #
+# The interval adapts to the rate at which events arrive: after a query which
+# returned new events the script waits min_sleep_time_in_seconds, and after
+# each query which returned none the wait doubles, up to
+# max_sleep_time_in_seconds. For each query the delay between the newest event
+# being recorded on the server and being collected is printed.
+#
 # DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S 
 # PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW, 
 # DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS, 
@@ -16,21 +22,28 @@
 #
 #
 # Import required libraries
-import requests, time, json
+import requests, time, json, datetime
 
 
 # Define server configuration
 fqdn = 'FOO.customers.deepinstinctweb.com'
 key = 'BAR'
 
+# Define sleep time between queries to server in seconds
+min_sleep_time_in_seconds = 15
+max_sleep_time_in_seconds = 300
+
 
 # Runtime
 
 highest_event_id_collected_previously = 0
+sleep_time_in_seconds = min_sleep_time_in_seconds
 
 while True:
 
     last_id = highest_event_id_collected_previously
+    new_event_count = 0
+    newest_event_timestamp = None
 
     while last_id != None:
 
@@ -50,6 +63,8 @@ while True:
                 for event in events:
                     if event['id'] > highest_event_id_collected_previously:
                         highest_event_id_collected_previously = event['id']
+                        new_event_count += 1
+                        newest_event_timestamp = event.get('insertion_timestamp', newest_event_timestamp)
 
                     #TODO: Insert code here to ingest data in SIEM, generate e-mail, or take
                     #      other desired action. For now the placeholder pretty-prints event
@@ -61,5 +76,17 @@ while True:
             time.sleep(15)
 
 
-    print('INFO: Sleeping for 5 minutes')
-    time.sleep(300)
+    if new_event_count > 0:
+        sleep_time_in_seconds = min_sleep_time_in_seconds
+        try:
+            recorded_at = datetime.datetime.fromisoformat(newest_event_timestamp.replace('Z', '+00:00')) if newest_event_timestamp else None
+        except ValueError:
+            recorded_at = None #timestamp in an unexpected format, so the delay is not reported
+        if recorded_at is not None:
+            delay = (datetime.datetime.now(datetime.timezone.utc) - recorded_at).total_seconds()
+            print('INFO: Collected', new_event_count, 'new events, newest was recorded', round(delay), 'seconds ago')
+    else:
+        sleep_time_in_seconds = min(max_sleep_time_in_seconds, sleep_time_in_seconds * 2)
+
+    print('INFO: Sleeping for', sleep_time_in_seconds, 'seconds')
+    time.sleep(sleep_time_in_seconds)
@@ -0,0 +1,77 @@
+# Micro-benchmark for the device matching used by di.get_device_ids (regex
+# hostname search and CIDR search), run entirely offline against a synthetic
+# device inventory. Compares di.match_device_ids with the previous approach
+# (nested device x pattern loops with list-based de-duplication), which is
+# run against a smaller inventory because it grows quadratically.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
+#
+#
+
+import deepinstinct3 as di, time, json, random, re, ipaddress
+
+#CONFIGURATION
+device_count = 100000
+legacy_device_count = 10000
+cidr_list = [f'10.{second_octet}.0.0/16' for second_octet in range(0, 256, 8)] + ['192.168.0.0/16', '172.16.0.0/12']
+regex_list = ['^WKS-0[0-4]', 'SRV-.*-DB', '^LAPTOP-[A-F]', 'KIOSK']
+random.seed(1)
+
+# BUILD A SYNTHETIC INVENTORY
+def build_devices(count):
+    devices = []
+    for device_id in range(1, count + 1):
+        prefix = random.choice(['WKS', 'SRV', 'LAPTOP', 'KIOSK'])
+        ip_address = str(ipaddress.IPv4Address(random.getrandbits(32)))
+        if random.random() < 0.5:
+            ip_address = f'10.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(1, 254)}'
+        devices.append({'id': device_id, 'hostname': f'{prefix}-{random.randint(0, 99999):05d}-{random.choice(["DB", "APP", "FS"])}', 'ip_address': ip_address})
+    return devices
+
+# PREVIOUS IMPLEMENTATION, FOR COMPARISON
+def legacy_match_device_ids(devices, search_list, regex_hostname_search=False, cidr_search=False):
+    device_ids = []
+    if regex_hostname_search:
+        for device in devices:
+            for regex in search_list:
+                if re.match(regex, device['hostname']):
+                    if device['id'] not in device_ids:
+                        device_ids.append(device['id'])
+    elif cidr_search:
+        for cidr in search_list:
+            for device in devices:
+                if ipaddress.ip_address(device['ip_address']) in ipaddress.ip_network(cidr):
+                    if device['id'] not in device_ids:
+                        device_ids.append(device['id'])
+    return device_ids
+
+def measure(function, devices, search_list, **kwargs):
+    start_time = time.perf_counter()
+    device_ids = function(devices, search_list, **kwargs)
+    runtime_in_seconds = time.perf_counter() - start_time
+    return {'device_count': len(devices), 'matches': len(device_ids),
+            'runtime_in_seconds': round(runtime_in_seconds, 4),
+            'devices_per_second': round(len(devices) / runtime_in_seconds) if runtime_in_seconds else 0}, device_ids
+
+# EXECUTE THE MEASUREMENTS
+devices = build_devices(device_count)
+legacy_devices = devices[:legacy_device_count]
+results = {}
+for search_type, search_list, kwargs in [('cidr', cidr_list, {'cidr_search': True}), ('regex', regex_list, {'regex_hostname_search': True})]:
+    results[search_type] = {}
+    results[search_type]['match_device_ids'], device_ids = measure(di.match_device_ids, devices, search_list, **kwargs)
+    results[search_type]['legacy'], legacy_device_ids = measure(legacy_match_device_ids, legacy_devices, search_list, **kwargs)
+    # sanity check: both approaches find the same devices in the legacy subset
+    results[search_type]['results_match'] = sorted(legacy_device_ids) == di.match_device_ids(legacy_devices, search_list, **kwargs)
+
+# PRINT RESULTS TO CONSOLE
+print(json.dumps(results, indent=4))
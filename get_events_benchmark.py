@@ -0,0 +1,59 @@
+# Example of how to benchmark event retrieval throughput (events per second)
+# from a Deep Instinct server, comparing di.iter_events with page prefetch
+# disabled (each page is requested only after the previous one has been fully
+# processed) and enabled (the next page is requested on a background thread
+# while the current page is processed).
+#
+# Prefetch overlaps network round trips with your own per-event processing, so
+# the difference is largest when processing_time_per_event_in_seconds is
+# non-zero (as it is for forwarders and reports) or the server is far away.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
+#
+#
+
+import deepinstinct3 as di, time, json
+
+#CONFIGURATION
+di.fqdn = 'SERVER-NAME'
+di.key = 'API-KEY'
+di.quiet_mode = True
+minimum_event_id = 0
+maximum_events = 100000 #stop each run after this many events (0 for all)
+processing_time_per_event_in_seconds = 0.0002 #simulated per-event work
+
+# RUN ONE PASS OVER THE EVENTS AND RETURN THE MEASUREMENTS
+def run(prefetch):
+    start_time = time.perf_counter()
+    event_count = 0
+    for event in di.iter_events(minimum_event_id=minimum_event_id, prefetch=prefetch):
+        if processing_time_per_event_in_seconds:
+            time.sleep(processing_time_per_event_in_seconds)
+        event_count += 1
+        if maximum_events and event_count >= maximum_events:
+            break
+    runtime_in_seconds = time.perf_counter() - start_time
+    return {'prefetch': prefetch,
+            'event_count': event_count,
+            'runtime_in_seconds': round(runtime_in_seconds, 3),
+            'events_per_second': round(event_count / runtime_in_seconds, 1) if runtime_in_seconds else 0}
+
+# EXECUTE THE RUNS
+results = {}
+results['without_prefetch'] = run(prefetch=False)
+results['with_prefetch'] = run(prefetch=True)
+if results['without_prefetch']['events_per_second']:
+    results['speedup'] = round(results['with_prefetch']['events_per_second'] / results['without_prefetch']['events_per_second'], 2)
+results['connection_stats'] = di.get_connection_stats()
+
+# PRINT RESULTS TO CONSOLE
+print(json.dumps(results, indent=4))
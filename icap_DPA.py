@@ -1,25 +1,62 @@
 import argparse
+import asyncio
 import logging
 import socket
 import sys
-from typing import List
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    # verdict_cache.py is only needed (and imported) when a verdict cache is used
+    from verdict_cache import VerdictCache
 
 logger = logging.getLogger()
 
+ICAP_PORT = 1344
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_ASYNC_CHUNK_SIZE = 64 * 1024
+CHUNKS_PER_DRAIN = 64
+MAX_BUFFERS_PER_SEND = 1024  # IOV_MAX on Linux and macOS
+
+
+def send_icap_content(scanner_ip: str, file_content: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      verdict_cache: Optional['VerdictCache'] = None):
+    file_hash, cached_result = _get_cached_result(verdict_cache=verdict_cache, file_content=file_content)
+    if cached_result is not None:
+        return cached_result
 
-def send_icap_content(scanner_ip: str, file_content: bytes):
     service = f'icap://{scanner_ip}/classify'.encode('latin-1')
-    port = 1344
+    port = ICAP_PORT
     logger.info(f'Sending scan request to {service.decode()} on port {port}')
     sock = _establish_socket_connection(host=scanner_ip, port=port)
-    chunks, req, resp = _create_icap_request_parts(file_content=file_content)
+    chunks, req, resp = _create_icap_request_parts(file_content=file_content, chunk_size=chunk_size)
     _send_content(content_chunks=chunks, perimeter_ip=scanner_ip, req=req, resp=resp, service=service, sock=sock)
     response = _receive_response(sock=sock)
 
     result_content, header, verdict = _parse_response(response=response)
+    _cache_result(verdict_cache=verdict_cache, file_hash=file_hash, header=header, verdict=verdict)
     return result_content, header, verdict
 
 
+def _get_cached_result(verdict_cache: Optional['VerdictCache'], file_content: bytes):
+    # returns the content hash and, if this content has been scanned before, the result in the same form as
+    # _parse_response (benign content is returned by the scanner unmodified, so it is returned as-is)
+    if verdict_cache is None:
+        return None, None
+    from verdict_cache import hash_content
+    file_hash = hash_content(file_content)
+    cached_verdict = verdict_cache.get(file_hash, source='icap')
+    if cached_verdict is None:
+        return file_hash, None
+    logger.info(f'Verdict for {file_hash} found in verdict cache')
+    result_content = file_content if cached_verdict['verdict'] == 'Benign' else 'NON-RELEVANT'
+    return file_hash, (result_content, cached_verdict['icap_headers'], cached_verdict['verdict'])
+
+
+def _cache_result(verdict_cache: Optional['VerdictCache'], file_hash: Optional[str], header: str, verdict: str):
+    if verdict_cache is not None:
+        verdict_cache.put(file_hash, {'verdict': verdict, 'icap_headers': header}, source='icap', verdict=verdict)
+
+
 def _parse_response(response: bytes):
     # allure.attach(body=str(response), name='ICAP raw response', attachment_type=allure.attachment_type.TEXT)
     icap_headers_bytes, http_headers_bytes, content, *extra_stuff = response.strip().split(b'\r\n\r\n')
@@ -51,36 +88,59 @@ def _parse_response(response: bytes):
 
 def _receive_response(sock: socket.socket) -> bytes:
     sock.shutdown(socket.SHUT_WR)
-    data = sock.recv(1024)
-    response = data
+    response = bytearray()
+    data = sock.recv(65536)
     while len(data):
-        data = sock.recv(1024)
-        response = response + data
+        response += data
+        data = sock.recv(65536)
     sock.close()
-    return response
+    return bytes(response)
 
 
 def _send_content(content_chunks: List, perimeter_ip: str, req: bytes, resp: bytes, service: bytes,
                   sock: socket.socket):
-    send_messages = [b"RESPMOD %s ICAP/1.0\r\n" % service, b"Host: %s\r\n" % (perimeter_ip.encode('latin-1')),
-                     f"Encapsulated: req-hdr=0, res-hdr={len(req)}, res-body={len(req) + len(resp)}\r\n".encode(
-                         'latin-1'), b"\r\n", req, resp]
-    for message in send_messages:
-        sock.send(message)
+    send_messages = _create_icap_headers(perimeter_ip=perimeter_ip, req=req, resp=resp, service=service)
     for chunk in content_chunks:
-        sock.send(hex((len(chunk)))[2:].encode('latin-1') + b"\r\n")
-        sock.send(chunk + b'\r\n')
-    sock.send(b"0\r\n")
-    sock.send(b"\r\n")
+        send_messages += [hex(len(chunk))[2:].encode('latin-1') + b"\r\n", chunk, b'\r\n']
+    send_messages.append(b"0\r\n\r\n")
+    _send_buffers(sock=sock, buffers=send_messages)
+
+
+def _send_buffers(sock: socket.socket, buffers: List):
+    # sends the buffers in order without joining them into one copy: with vectored writes (sendmsg) where the
+    # platform supports it, otherwise one sendall per buffer
+    if not hasattr(sock, 'sendmsg'):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i:i + MAX_BUFFERS_PER_SEND])
+        # skip the buffers which were sent in full and keep the unsent part of a partially sent one
+        while sent:
+            if sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            else:
+                buffers[i] = buffers[i][sent:]
+                sent = 0
 
 
-def _create_icap_request_parts(file_content: bytes):
+def _create_icap_headers(perimeter_ip: str, req: bytes, resp: bytes, service: bytes) -> List[bytes]:
+    return [b"RESPMOD %s ICAP/1.0\r\n" % service, b"Host: %s\r\n" % (perimeter_ip.encode('latin-1')),
+            f"Encapsulated: req-hdr=0, res-hdr={len(req)}, res-body={len(req) + len(resp)}\r\n".encode(
+                'latin-1'), b"\r\n", req, resp]
+
+
+def _create_icap_request_parts(file_content: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE):
     req = b"GET /origin-resource HTTP/1.1\r\n" + b"Host: www.origin-server.com\r\n" + \
           b"Accept: text/html, text/plain, image/gif\r\n" + b"Accept-Encoding: gzip, compress\r\n\r\n"
     resp = b"HTTP/1.1 200 OK\r\n" + b"Date: Mon, 10 Jan 2000 09:52:22 GMT\r\n" + b"Server: Apache/1.3.6 (Unix)\r\n" + \
            b'ETag: "63840-1ab7-378d415b"\r\n' + b"Content-Type: text/html\r\n" + \
            f"Content-Length: {len(file_content)}\r\n".encode('latin-1') + b"\r\n"
-    chunks = [file_content[i:i + 1000] for i in range(0, len(file_content), 1000)]
+    content_view = memoryview(file_content)
+    chunks = [content_view[i:i + chunk_size] for i in range(0, len(file_content), chunk_size)]
     return chunks, req, resp
 
 
@@ -98,18 +158,209 @@ def _establish_socket_connection(host: str, port: int):
     return sock
 
 
+class AsyncIcapClient:
+    """
+    asyncio ICAP client that keeps up to max_in_flight files being scanned concurrently against a DPA scanner
+    (or a load balancer in front of several scanners). Connections are kept open and reused for the next file
+    unless the scanner answers with 'Connection: close'. Request bodies are written with writelines in chunks
+    of chunk_size bytes, and responses are parsed incrementally into a bytearray as they arrive. If a verdict_cache
+    is given, content which has been scanned before is answered from the cache without contacting the scanner.
+    """
+
+    def __init__(self, scanner_ip: str, port: int = ICAP_PORT, max_in_flight: int = 8,
+                 chunk_size: int = DEFAULT_ASYNC_CHUNK_SIZE, timeout: Optional[float] = 120,
+                 verdict_cache: Optional['VerdictCache'] = None):
+        self.scanner_ip = scanner_ip
+        self.port = port
+        self.max_in_flight = max_in_flight
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.verdict_cache = verdict_cache
+        self.service = f'icap://{scanner_ip}/classify'.encode('latin-1')
+        self._idle_connections = []
+        self._semaphore = None
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        while self._idle_connections:
+            _, writer = self._idle_connections.pop()
+            await self._close_connection(writer)
+
+    async def scan(self, file_content: bytes):
+        file_hash, cached_result = _get_cached_result(verdict_cache=self.verdict_cache, file_content=file_content)
+        if cached_result is not None:
+            return cached_result
+        result_content, header, verdict = await self._scan(file_content=file_content)
+        _cache_result(verdict_cache=self.verdict_cache, file_hash=file_hash, header=header, verdict=verdict)
+        return result_content, header, verdict
+
+    async def _scan(self, file_content: bytes):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            # a reused connection may have been closed by the scanner while idle, so retry once on a new one
+            for attempt in (1, 2):
+                reader, writer, reused = await self._acquire_connection(fresh=attempt > 1)
+                try:
+                    response, keep_alive = await asyncio.wait_for(
+                        self._exchange(reader=reader, writer=writer, file_content=file_content), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as msg:
+                    await self._close_connection(writer)
+                    if reused and attempt == 1:
+                        logger.info(f'Reused connection to {self.scanner_ip} was closed ({msg}), reconnecting')
+                        continue
+                    raise
+                except BaseException:
+                    await self._close_connection(writer)
+                    raise
+                if keep_alive:
+                    self._idle_connections.append((reader, writer))
+                else:
+                    await self._close_connection(writer)
+                return _parse_response(response=response)
+
+    async def scan_many(self, file_contents: List[bytes]):
+        # results are returned in the same order as file_contents; a failed scan returns its exception
+        return await asyncio.gather(*[self.scan(file_content) for file_content in file_contents],
+                                    return_exceptions=True)
+
+    async def _acquire_connection(self, fresh: bool = False):
+        if self._idle_connections and not fresh:
+            reader, writer = self._idle_connections.pop()
+            return reader, writer, True
+        reader, writer = await asyncio.open_connection(host=self.scanner_ip, port=self.port)
+        self.connections_opened += 1
+        return reader, writer, False
+
+    @staticmethod
+    async def _close_connection(writer: asyncio.StreamWriter):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, file_content: bytes):
+        await self._write_request(writer=writer, file_content=file_content)
+        self.requests_sent += 1
+        return await self._read_response(reader=reader)
+
+    async def _write_request(self, writer: asyncio.StreamWriter, file_content: bytes):
+        chunks, req, resp = _create_icap_request_parts(file_content=file_content, chunk_size=self.chunk_size)
+        writer.writelines(_create_icap_headers(perimeter_ip=self.scanner_ip, req=req, resp=resp,
+                                               service=self.service))
+        # drain periodically so that large files are not buffered in memory all at once
+        for i in range(0, len(chunks), CHUNKS_PER_DRAIN):
+            send_messages = []
+            for chunk in chunks[i:i + CHUNKS_PER_DRAIN]:
+                send_messages += [hex(len(chunk))[2:].encode('latin-1') + b"\r\n", chunk, b'\r\n']
+            writer.writelines(send_messages)
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader):
+        response = bytearray(await reader.readuntil(b'\r\n\r\n'))
+        icap_headers = {}
+        for line in response.decode('latin-1').split('\r\n')[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                icap_headers[name.strip().lower()] = value.strip()
+
+        # the Encapsulated header gives the offset of the body (if any) after the encapsulated HTTP headers
+        body_offset, has_body = 0, False
+        for part in icap_headers.get('encapsulated', '').split(','):
+            if '=' in part:
+                name, offset = part.strip().split('=', 1)
+                if name.endswith('-body'):
+                    body_offset, has_body = int(offset), name != 'null-body'
+        if body_offset:
+            response += await reader.readexactly(body_offset)
+
+        if has_body:
+            while True:
+                size_line = await reader.readuntil(b'\r\n')
+                response += size_line
+                chunk_size = int(size_line.split(b';')[0].strip(), 16)
+                if chunk_size == 0:
+                    # consume optional trailers up to and including the empty line
+                    line = await reader.readuntil(b'\r\n')
+                    response += line
+                    while line != b'\r\n':
+                        line = await reader.readuntil(b'\r\n')
+                        response += line
+                    break
+                response += await reader.readexactly(chunk_size + 2)
+
+        keep_alive = icap_headers.get('connection', '').lower() != 'close'
+        return bytes(response), keep_alive
+
+
+async def scan_files_async(scanner_ip: str, file_paths: List[str], max_in_flight: int = 8,
+                           chunk_size: int = DEFAULT_ASYNC_CHUNK_SIZE, verdict_cache: Optional['VerdictCache'] = None):
+    async with AsyncIcapClient(scanner_ip=scanner_ip, max_in_flight=max_in_flight, chunk_size=chunk_size,
+                               verdict_cache=verdict_cache) as client:
+
+        # a file is only read once it has a slot, so that at most max_in_flight files are held in memory at once,
+        # and it is read on the default executor so that the event loop is not blocked meanwhile
+        file_slots = asyncio.Semaphore(max_in_flight)
+        loop = asyncio.get_running_loop()
+
+        def read_file(file_path: str):
+            with open(file_path, 'rb') as f:
+                return f.read()
+
+        async def scan_file(file_path: str):
+            async with file_slots:
+                content = await loop.run_in_executor(None, read_file, file_path)
+                return await client.scan(content)
+
+        results = await asyncio.gather(*[scan_file(file_path) for file_path in file_paths], return_exceptions=True)
+        logger.info(f'Scanned {len(file_paths)} files with {client.requests_sent} requests over '
+                    f'{client.connections_opened} connections')
+        return results
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--scanner-ip', action='store', dest='scanner_ip', required=True)
-    parser.add_argument('-f', '--file-path', action='store', dest='file_path', required=True)
+    parser.add_argument('-f', '--file-path', action='store', dest='file_paths', required=True, nargs='+')
+    parser.add_argument('-c', '--concurrency', action='store', dest='concurrency', type=int, default=8,
+                        help='number of files in flight at once')
+    parser.add_argument('--chunk-size', action='store', dest='chunk_size', type=int,
+                        default=DEFAULT_ASYNC_CHUNK_SIZE, help='size in bytes of each chunk of the request body')
+    parser.add_argument('--verdict-cache', action='store', dest='verdict_cache_path', default=None,
+                        help='path of a local verdict cache, so previously scanned content is not sent again')
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    with open(args.file_path, 'rb') as f:
-        content = f.read()
-        result_content, header, verdict = send_icap_content(scanner_ip=args.scanner_ip, file_content=content)
+    verdict_cache = None
+    if args.verdict_cache_path:
+        from verdict_cache import VerdictCache
+        verdict_cache = VerdictCache(path=args.verdict_cache_path)
+    results = asyncio.run(scan_files_async(scanner_ip=args.scanner_ip, file_paths=args.file_paths,
+                                           max_in_flight=args.concurrency, chunk_size=args.chunk_size,
+                                           verdict_cache=verdict_cache))
+    if verdict_cache is not None:
+        logger.info(f'Verdict cache: {verdict_cache.get_stats()}')
+        verdict_cache.close()
+    for file_path, result in zip(args.file_paths, results):
+        if isinstance(result, BaseException):
+            print(f'{file_path}: scan failed: {result!r}')
+            continue
+        result_content, header, verdict = result
+        if len(args.file_paths) > 1:
+            print(f'{file_path}:')
         print(f'Verdict is {verdict}')
         print(f'header is {header}')
 
@@ -13,7 +13,7 @@
 #
 #
 
-import pandas, datetime, deepinstinct30 as di, sys
+import pandas, datetime, deepinstinct3 as di, sys
 
 # Optional hardcoded config - if not provided, you'll be prompted at runtime
 di.fqdn = 'SERVER-NAME.customers.deepinstinctweb.com'
@@ -54,10 +54,7 @@ devices = di.get_devices(include_deactivated=False)
 
 # add msp_name to tenant data
 print('INFO: Adding MSP names to Tenant data')
-for tenant in tenants:
-    for msp in msps:
-        if tenant['msp_id'] == msp['id']:
-            tenant['msp_name'] = msp['name']
+di.join_records(tenants, msps, 'msp_id', {'name': 'msp_name'})
 
 # If option to include policy mode counts is enabled, get policy details,
 # then parse policies to calculate mode, then add that data to devices
@@ -83,10 +80,7 @@ if include_policy_mode_counts:
                 policy['prevention_mode'] = True
 
     print('INFO: Adding policy mode to device data')
-    for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                device['prevention_mode'] = policy['prevention_mode']
+    di.join_records(devices, policies, 'policy_id', {'prevention_mode': 'prevention_mode'})
 
 # Calculate license usage for each tenant (plus prevention/detection data, if enabled in config)
 if include_policy_mode_counts:
@@ -98,20 +92,21 @@ for tenant in tenants:
     if include_policy_mode_counts:
         tenant['devices_in_prevention_mode'] = 0
         tenant['devices_in_detection_mode'] = 0
+tenants_by_id = di.index_by_field(tenants)
 for device in devices:
     # Check if the device has an activated license (if not skip it)
     if device['license_status'] == 'ACTIVATED':
         # If yes, then find the Tenant that this device belongs to
-        for tenant in tenants:
-            if tenant['id'] == device['tenant_id']:
-                # ...and increment the licenses_used counter in the matching tenant by 1
-                tenant['licenses_used'] += 1
-                # If enabled, also increment the prevention/detection counter
-                if include_policy_mode_counts:
-                    if device['prevention_mode']:
-                        tenant['devices_in_prevention_mode'] += 1
-                    else:
-                        tenant['devices_in_detection_mode'] += 1
+        tenant = tenants_by_id.get(device['tenant_id'])
+        if tenant is not None:
+            # ...and increment the licenses_used counter in the matching tenant by 1
+            tenant['licenses_used'] += 1
+            # If enabled, also increment the prevention/detection counter
+            if include_policy_mode_counts:
+                if device['prevention_mode']:
+                    tenant['devices_in_prevention_mode'] += 1
+                else:
+                    tenant['devices_in_detection_mode'] += 1
 
 # Calculate percent_of_licenses_used for reach tenant and add results to tenants data
 print('INFO: Calculating percentage of licenses used for each tenant')
@@ -0,0 +1,340 @@
+# Long-running daemon which runs periodic jobs (event forwarding, audit log
+# forwarding, device connectivity monitoring and Agentless scan count
+# monitoring) against many Deep Instinct servers from one command, instead of
+# running a copy of event_forwarder_slack.py, event_forwarder_email.py,
+# audit_log_forwarder_slack.py, device_connectivity_monitoring.py and
+# agentless_scan_count_monitoring.py with its own sleep loop per server.
+#
+# Each job runs at its own interval, with a random jitter so that jobs for many
+# servers do not all query at the same moment. A job is never started again
+# while a previous run is still in progress. The event forwarder job can adapt
+# its interval to the rate at which events arrive (see min_interval_in_seconds).
+#
+# Servers are divided between worker_processes worker processes. Within a
+# worker, jobs run on a thread pool and every job for a server shares that
+# server's pooled connections (deepinstinct3 keeps one session per fqdn). As
+# deepinstinct3 holds the server name and API key in module variables, jobs for
+# different servers in the same worker take turns, while jobs for the same
+# server run concurrently; set worker_processes to the number of servers to run
+# every server fully in parallel. A worker which exits unexpectedly is
+# restarted.
+#
+# Further job types can be added by defining a class with the same constructor
+# and run() method as the jobs below and adding it to job_types.
+#
+# USAGE
+# 1. Save the latest version of this file (poller_daemon.py), the forwarder
+#    engine (event_forwarder.py) and the DI API Wrapper (deepinstinct3.py) to
+#    the same folder on disk.
+# 2. Review and adjust configuration in-line below, then save changes.
+# 3. Execute the script with this command: python poller_daemon.py
+#
+# NOTE: State is kept on disk per server, with the server name in each file
+#       name (event_forwarder_SERVERNAME.sqlite for events, and the same
+#       audit_log_forwarder_slack_SERVERNAME.conf used by
+#       audit_log_forwarder_slack.py for the Audit Log). Be cautious not to
+#       delete/rename/move these files. Doing so will cause data to be re-sent.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
+#
+#
+
+#---import required libraries---
+import time, json, os, datetime, random, heapq, collections, threading, contextlib, multiprocessing, concurrent.futures, requests
+import deepinstinct3 as di, event_forwarder
+
+
+#---configuration---
+
+# Define the servers to poll and the jobs to run for each. Omit a job from a
+# server's 'jobs' to not run it for that server.
+servers = [
+    {'fqdn': 'FOO.customers.deepinstinctweb.com',
+     'key': 'BAR',
+     'jobs': {
+         'event_forwarder': {'interval_in_seconds': 300,
+                             'min_interval_in_seconds': 15, #interval after new events were found, omit for a fixed interval
+                             'sinks': [{'type': 'slack', 'webhook_url': 'https://hooks.slack.com/workflows/REDACTED'}],
+                             #'sinks': [{'type': 'email', 'username': 'USERNAME@gmail.com', 'password': 'PASSWORD', 'recipient': 'USER@DOMAIN'}],
+                             'search': {},
+                             'fields_to_remove': ['msp_name', 'msp_id', 'tenant_name', 'tenant_id']},
+         'audit_log_forwarder': {'interval_in_seconds': 300,
+                                 'webhook_url': 'https://hooks.slack.com/workflows/WEBHOOK-URL',
+                                 'categories': None}, #None for all categories
+         'device_connectivity_monitoring': {'interval_in_seconds': 21600,
+                                            'max_ratio_offline': 0.3},
+         'agentless_scan_count_monitoring': {'interval_in_seconds': 3600},
+     }},
+]
+
+# Define the number of worker processes the servers are divided between, and
+# the number of jobs each worker runs at once
+worker_processes = 8
+job_threads_per_worker = 8
+
+# Define the random variation applied to each job interval (0.1 is +/- 10%)
+jitter_ratio = 0.1
+
+
+#---define methods used at runtime---
+
+# a method to print a message to console prefixed with the time, server and job
+def log(server, job_name, *message):
+    print(datetime.datetime.now().strftime("%H:%M"), f'[{server["fqdn"]} {job_name}]', *message)
+
+# a method returning the short server name used in file names
+def get_server_name(server):
+    return server['fqdn'].split('.', 1)[0]
+
+
+class EventForwarderJob:
+
+    def __init__(self, server, config):
+        sinks = []
+        for sink in config['sinks']:
+            sink = dict(sink)
+            sink_type = sink.pop('type')
+            if sink_type == 'slack':
+                sinks.append(event_forwarder.SlackSink(**sink))
+            elif sink_type == 'email':
+                sinks.append(event_forwarder.EmailSink(**sink))
+            else:
+                raise ValueError(f'Unknown sink type {sink_type}')
+        self.forwarder = event_forwarder.EventForwarder(sinks, search=config.get('search', {}),
+                                                        fields_to_remove=config.get('fields_to_remove', []),
+                                                        queue_file_name=f'event_forwarder_{get_server_name(server)}.sqlite')
+        self.poll_interval = event_forwarder.AdaptivePollInterval(config.get('min_interval_in_seconds', config['interval_in_seconds']),
+                                                                  config['interval_in_seconds'])
+
+    def run(self):
+        try:
+            event_count = self.forwarder.poll()
+        except Exception:
+            self.poll_interval.update(0)
+            raise
+        self.poll_interval.update(event_count)
+
+    def get_interval(self):
+        return self.poll_interval.interval
+
+
+class AuditLogForwarderJob:
+
+    def __init__(self, server, config):
+        self.server = server
+        self.webhook_url = config['webhook_url']
+        self.categories = config.get('categories')
+        self.config_file_name = f'audit_log_forwarder_slack_{get_server_name(server)}.conf'
+        self.session = requests.Session()
+
+    def get_config(self):
+        try:
+            with open(self.config_file_name, 'r') as f:
+                config = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            return {}
+        if isinstance(config, int):
+            return {'last_id': config}
+        return config
+
+    def save_config(self, cursor):
+        with open(self.config_file_name + '.tmp', 'w') as f:
+            f.write(json.dumps(cursor))
+        os.replace(self.config_file_name + '.tmp', self.config_file_name)
+
+    def run(self):
+        from dateutil import parser
+        cursor = self.get_config()
+        entry_count = 0
+        try:
+            for entry in di.iter_audit_log(cursor=cursor, categories=self.categories):
+                slack_data = {'timestamp': parser.parse(entry['timestamp']).strftime("%Y-%m-%d %H:%M:%S %Z"),
+                              'user': entry['user_id'],
+                              'category': entry['category'].capitalize(),
+                              'type': entry['type'].capitalize(),
+                              'source': entry['source'],
+                              'text': entry['description']}
+                try:
+                    self.session.post(self.webhook_url, json=slack_data, timeout=30).raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    log(self.server, 'audit_log_forwarder', 'ERROR: Sending entry', entry['id'], 'failed:', e)
+                entry_count += 1
+                self.save_config(cursor)
+        finally:
+            self.save_config(cursor)
+        log(self.server, 'audit_log_forwarder', 'Sent', entry_count, 'entries, highest entry id is now', cursor.get('last_id', 0))
+
+
+class DeviceConnectivityMonitoringJob:
+
+    def __init__(self, server, config):
+        self.server = server
+        self.max_ratio_offline = config.get('max_ratio_offline', 0.3)
+
+    def run(self):
+        results = {'online_count': 0, 'offline_count': 0}
+        for device in di.get_devices():
+            if device['connectivity_status'] == 'ONLINE':
+                results['online_count'] += 1
+            elif device['connectivity_status'] == 'OFFLINE':
+                results['offline_count'] += 1
+        device_count = results['offline_count'] + results['online_count']
+        results['ratio_offline'] = results['offline_count'] / device_count if device_count else 0
+        log(self.server, 'device_connectivity_monitoring', json.dumps(results))
+        if results['ratio_offline'] > self.max_ratio_offline:
+            log(self.server, 'device_connectivity_monitoring', f'WARNING: More than {self.max_ratio_offline:.0%} of devices are offline')
+
+
+class AgentlessScanCountMonitoringJob:
+
+    def __init__(self, server, config):
+        self.server = server
+        self.previous_scanned_file_count = 0
+
+    def run(self):
+        current_scanned_file_count = 0
+        for device in di.get_devices():
+            if device['os'] == 'NETWORK_AGENTLESS':
+                current_scanned_file_count += device['scanned_files']
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d_%H.%M.%S")
+        with open(f'current_scanned_file_counts_{self.server["fqdn"]}.txt', 'a') as f:
+            f.write(f'{self.server["fqdn"]}\t{timestamp}\t{current_scanned_file_count}\t{current_scanned_file_count - self.previous_scanned_file_count}\n')
+        self.previous_scanned_file_count = current_scanned_file_count
+
+
+job_types = {'event_forwarder': EventForwarderJob,
+             'audit_log_forwarder': AuditLogForwarderJob,
+             'device_connectivity_monitoring': DeviceConnectivityMonitoringJob,
+             'agentless_scan_count_monitoring': AgentlessScanCountMonitoringJob}
+
+
+# Gives jobs access to deepinstinct3 for one server at a time. Servers take
+# turns in the order in which their jobs started waiting. When a server's turn
+# starts, all of its waiting jobs run at once, and further jobs for it join them
+# for as long as no other server is waiting; once the last of them finishes the
+# next server's turn starts. A job must not leave a request running once run()
+# returns, as the next server's fqdn and key are set as soon as the turn changes
+# (EventForwarderJob closes its event stream, which waits for the page prefetch).
+class ServerContext:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active_fqdn = None
+        self.active_count = 0
+        self.admit_count = 0
+        self.waiting_count = collections.Counter()
+        self.turns = collections.deque()
+
+    #gives the turn to the next server with jobs waiting (called with condition held)
+    def start_next_turn(self):
+        while self.turns:
+            self.active_fqdn = self.turns.popleft()
+            self.admit_count = self.waiting_count[self.active_fqdn]
+            if self.admit_count:
+                self.condition.notify_all()
+                return
+
+    @contextlib.contextmanager
+    def use(self, server):
+        fqdn = server['fqdn']
+        with self.condition:
+            if not (self.active_count and self.active_fqdn == fqdn and not self.turns):
+                self.waiting_count[fqdn] += 1
+                if fqdn not in self.turns:
+                    self.turns.append(fqdn)
+                if self.active_count == 0 and self.admit_count == 0:
+                    self.start_next_turn()
+                while not (self.active_fqdn == fqdn and self.admit_count > 0):
+                    self.condition.wait()
+                self.admit_count -= 1
+                self.waiting_count[fqdn] -= 1
+            self.active_count += 1
+            di.fqdn = server['fqdn']
+            di.key = server['key']
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active_count -= 1
+                if self.active_count == 0 and self.admit_count == 0:
+                    self.start_next_turn()
+
+
+# Runs the jobs for a list of servers until the process is stopped. Each job is
+# scheduled again only once its current run has finished, at its interval from
+# the start of that run (or straight away if the run took longer than that).
+# Jobs with a get_interval() method choose their own interval after each run.
+def run_worker(server_list):
+    di.quiet_mode = True
+    context = ServerContext()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=job_threads_per_worker)
+    condition = threading.Condition()
+    schedule = []
+
+    for server in server_list:
+        for job_name, config in server['jobs'].items():
+            try:
+                job = job_types[job_name](server, config)
+            except Exception as e:
+                log(server, job_name, 'ERROR: Job could not be created:', e)
+                continue
+            #spread the first runs out so that jobs do not all start at the same moment
+            interval = config['interval_in_seconds']
+            heapq.heappush(schedule, (time.monotonic() + random.uniform(0, interval * jitter_ratio), len(schedule), server, job_name, job, interval))
+
+    def run_job(due_time, order, server, job_name, job, interval):
+        wait_start_time = time.perf_counter()
+        try:
+            with context.use(server):
+                start_time = time.perf_counter()
+                job.run()
+        except Exception as e:
+            log(server, job_name, 'ERROR:', repr(e))
+        else:
+            log(server, job_name, 'Completed in', round(time.perf_counter() - start_time, 1), 'seconds after waiting',
+                round(start_time - wait_start_time, 1), 'seconds for its turn')
+
+        if hasattr(job, 'get_interval'):
+            interval = job.get_interval()
+        next_due_time = due_time + interval * (1 + random.uniform(-jitter_ratio, jitter_ratio))
+        with condition:
+            heapq.heappush(schedule, (max(next_due_time, time.monotonic()), order, server, job_name, job, interval))
+            condition.notify()
+
+    with condition:
+        while True:
+            wait_time = schedule[0][0] - time.monotonic() if schedule else None
+            if wait_time is not None and wait_time <= 0:
+                executor.submit(run_job, *heapq.heappop(schedule))
+            else:
+                condition.wait(wait_time)
+
+
+#---runtime---
+if __name__ == '__main__':
+    worker_count = max(1, min(worker_processes, len(servers)))
+    server_groups = [servers[i::worker_count] for i in range(worker_count)]
+    workers = [None] * worker_count
+
+    try:
+        while True:
+            for i, server_group in enumerate(server_groups):
+                if workers[i] is None or not workers[i].is_alive():
+                    if workers[i] is not None:
+                        print(datetime.datetime.now().strftime("%H:%M"), 'WARNING: Worker for', [server['fqdn'] for server in server_group],
+                              'exited with code', workers[i].exitcode, ', restarting')
+                    workers[i] = multiprocessing.Process(target=run_worker, args=(server_group,), daemon=True)
+                    workers[i].start()
+            time.sleep(10)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -24,6 +24,11 @@ from dateutil import parser
 di.key = 'BAR'
 di.fqdn = 'FOO.customers.deepinstinctweb.com'
 
+#set to True to keep a local copy of events on disk and only download events
+#newer than the previous run (status changes to previously stored events are
+#not picked up)
+di.use_event_store = False
+
 #get events from server
 search_parameters = {}
 search_parameters['type'] = ['STATIC_ANALYSIS']
@@ -24,6 +24,11 @@ from dateutil import parser
 di.key = 'BAR'
 di.fqdn = 'FOO.customers.deepinstinctweb.com'
 
+#set to True to keep a local copy of events on disk and only download events
+#newer than the previous run (status changes to previously stored events are
+#not picked up)
+di.use_event_store = False
+
 #read hash list from Excel file on disk
 file_name = 'premature_prevention_recovery.xlsx'
 folder_name = di.create_export_folder()
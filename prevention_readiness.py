@@ -92,6 +92,10 @@ config['minimum_event_id'] = input('Enter minimum_event_id as an integer, or pre
 if config['minimum_event_id'] == '':
     config['minimum_event_id'] = 0
 
+user_response = input('Use local event store (only downloads events newer than the last run; status changes to previously stored events are not picked up)? Enter YES or NO, or press enter to accept the default [NO]: ')
+if user_response.lower() == 'yes':
+    di.use_event_store = True
+
 #get the data from DI server
 print('INFO: Gathering data')
 print('\tCalling get_devices')
@@ -183,10 +187,7 @@ print('      Found', prevention_policy_count, 'prevention policies and', detecti
 
 #add in_prevention field to devices
 print('INFO: Adding prevention_mode field to device data')
-for device in devices:
-    for policy in policies:
-        if policy['id'] == device['policy_id']:
-            device['in_prevention'] = policy['prevention_mode']
+di.join_records(devices, policies, 'policy_id', {'prevention_mode': 'in_prevention'})
 
 #add event_count field to devices
 print('INFO: Adding event_count field to device data')
@@ -198,11 +199,7 @@ for device in devices:
 
 #add associated policy name and prevention mode to group data (for display purposes only)
 print('INFO: Adding policy_name and prevention_mode to device group data')
-for group in groups:
-    for policy in policies:
-        if group['policy_id'] == policy['id']:
-            group['policy_name'] = policy['name']
-            group['prevention_mode'] = policy['prevention_mode']
+di.join_records(groups, policies, 'policy_id', {'name': 'policy_name', 'prevention_mode': 'prevention_mode'})
 
 #add days_since_deployment field to devices
 print('INFO: Adding days_since_deployment to device data by comparing last_registration to current datetime')
@@ -245,12 +242,9 @@ for device in devices:
         devices_not_ready_for_prevention.append(device)
 
 print('INFO: Calculating how many devices in each group are ready for prevention')
+ready_device_counts = di.count_data_by_field(devices_ready_for_prevention, 'group_id')
 for group in groups:
-    group['devices_ready_for_prevention'] = 0
-for device in devices_ready_for_prevention:
-    for group in groups:
-        if device['group_id'] == group['id']:
-            group['devices_ready_for_prevention'] +=1
+    group['devices_ready_for_prevention'] = ready_device_counts.get(group['id'], 0)
 
 print('INFO: Building list of groups with devices ready for prevention')
 groups_with_devices_ready_for_prevention = []
@@ -0,0 +1,77 @@
+# Shared fixtures for the offline tests. The tests import the scripts from the
+# repository root and replace send_request with FakeServer, so no Deep Instinct
+# server is needed.
+import os, sys, json, threading, urllib.parse
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepinstinct3 as di
+
+
+class FakeResponse:
+
+    def __init__(self, method, url, status_code=200, data=None):
+        self.status_code = status_code
+        self.data = data
+        self.url = url
+        self.headers = {}
+        self.request = type('Request', (), {'method': method, 'url': url})()
+
+    def json(self):
+        return json.loads(json.dumps(self.data))
+
+
+# Answers the device and event search endpoints from in-memory lists, 50
+# records per page like the server, and records every request sent along with
+# the fqdn and key in use at the time
+class FakeServer:
+
+    page_size = 50
+
+    def __init__(self, devices=(), events=(), suspicious_events=()):
+        self.devices = list(devices)
+        self.events = {False: list(events), True: list(suspicious_events)}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def page(self, records, after_id):
+        page = [record for record in records if record['id'] > after_id][:self.page_size]
+        return page, page[-1]['id'] if page else None
+
+    def send_request(self, method, request_url, **kwargs):
+        url = urllib.parse.urlsplit(request_url)
+        query = urllib.parse.parse_qs(url.query)
+        with self.lock:
+            self.requests.append((method, url.path, dict(query), di.fqdn, di.key))
+        if url.path == '/api/v1/devices':
+            devices, last_id = self.page(self.devices, int(query['after_device_id'][0]))
+            return FakeResponse(method, request_url, data={'devices': devices, 'last_id': last_id})
+        if url.path in ('/api/v1/events/search', '/api/v1/suspicious-events/search'):
+            events = [event for event in self.events[url.path.startswith('/api/v1/suspicious')]
+                      if di.event_matches_search(event, kwargs.get('json') or {})]
+            events, last_id = self.page(events, int(query['after_event_id'][0]))
+            return FakeResponse(method, request_url, data={'events': events, 'last_id': last_id})
+        return FakeResponse(method, request_url, status_code=404)
+
+
+def make_devices(count):
+    return [{'id': i, 'hostname': f'HOST-{i % 7}-{i}', 'ip_address': f'10.{i % 3}.{i // 256 % 256}.{i % 256}',
+             'license_status': 'ACTIVATED' if i % 11 else 'DEACTIVATED', 'policy_id': i % 5 + 1, 'group_id': i % 4 + 1,
+             'tenant_id': i % 3 + 1} for i in range(1, count + 1)]
+
+
+def make_events(count, status='OPEN'):
+    return [{'id': i, 'device_id': i % 17 + 1, 'type': 'STATIC_ANALYSIS', 'status': status, 'action': 'PREVENTED',
+             'file_hash': f'{i:064x}', 'threat_severity': 'HIGH'} for i in range(1, count + 1)]
+
+
+@pytest.fixture
+def fake_server(monkeypatch, tmp_path):
+    server = FakeServer(devices=make_devices(230), events=make_events(173), suspicious_events=make_events(12))
+    monkeypatch.setattr(di, 'send_request', server.send_request)
+    monkeypatch.setattr(di, 'fqdn', 'test.example.com', raising=False)
+    monkeypatch.setattr(di, 'key', 'TEST-KEY', raising=False)
+    monkeypatch.setattr(di, 'quiet_mode', True)
+    monkeypatch.chdir(tmp_path)
+    return server
@@ -0,0 +1,224 @@
+# Offline tests for deepinstinct3: event paging and prefetch, the local event
+# store, device matching and the record joins. Where a method replaced a loop
+# in the baseline wrapper, the result is compared with that original loop.
+import contextlib, ipaddress, random, re, threading
+import pytest
+
+import deepinstinct3 as di
+from conftest import FakeResponse, make_devices
+
+
+#---event paging---
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_iter_events_returns_every_event_once_in_order(fake_server, prefetch):
+    events = list(di.iter_events(prefetch=prefetch))
+    assert [event['id'] for event in events] == list(range(1, 174))
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_iter_events_pages_by_last_id_and_stops_on_null_last_id(fake_server, prefetch):
+    list(di.iter_events(minimum_event_id=20, prefetch=prefetch))
+    after_ids = [int(query['after_event_id'][0]) for method, path, query, fqdn, key in fake_server.requests]
+    #pages of up to 50 from id 20, then one request which returns last_id None
+    assert after_ids == [20, 70, 120, 170, 173]
+
+
+def test_iter_events_applies_search_and_suspicious(fake_server):
+    fake_server.events[False][5]['status'] = 'CLOSED'
+    assert [event['id'] for event in di.iter_events(search={'status': ['CLOSED']})] == [6]
+    assert len(list(di.iter_events(suspicious=True))) == 12
+    assert fake_server.requests[-1][1] == '/api/v1/suspicious-events/search'
+
+
+def test_iter_events_with_no_events(fake_server):
+    fake_server.events[False] = []
+    assert list(di.iter_events()) == []
+    assert len(fake_server.requests) == 1
+
+
+def test_get_events_matches_iter_events(fake_server):
+    assert di.get_events(minimum_event_id=100) == list(di.iter_events(minimum_event_id=100, prefetch=False))
+
+
+def test_closing_iter_events_early_waits_for_prefetch(fake_server):
+    with contextlib.closing(di.iter_events()) as events:
+        for event in events:
+            if event['id'] == 60:
+                break
+    assert [thread for thread in threading.enumerate() if thread.name.startswith('ThreadPoolExecutor')] == []
+    #the page after the one being read may have been prefetched, but no further
+    assert len(fake_server.requests) <= 3
+
+
+#---local event store---
+
+def test_sync_event_store_is_incremental(fake_server):
+    assert di.sync_event_store() == 173
+    fake_server.events[False].extend({'id': i, 'device_id': 1, 'status': 'OPEN'} for i in range(174, 180))
+    fake_server.requests.clear()
+    assert di.sync_event_store() == 6
+    assert int(fake_server.requests[0][2]['after_event_id'][0]) == 173
+    assert [event['id'] for event in di.iter_stored_events()] == list(range(1, 180))
+
+
+def test_sync_event_store_full_refresh_replaces_stored_events(fake_server):
+    di.sync_event_store()
+    #close one event and delete two others on the server
+    fake_server.events[False][0]['status'] = 'CLOSED'
+    del fake_server.events[False][10:12]
+    assert di.sync_event_store() == 0
+    assert di.sync_event_store(full_refresh=True, batch_size=40) == 171
+    assert list(di.iter_stored_events()) == list(di.iter_events())
+    assert [event['id'] for event in di.iter_stored_events(search={'status': ['CLOSED']})] == [1]
+
+
+def test_interrupted_full_refresh_keeps_stored_events(fake_server, monkeypatch):
+    di.sync_event_store()
+    def failing_iter_events(**kwargs):
+        yield from fake_server.events[False][:100]
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(di, 'iter_events', failing_iter_events)
+    with pytest.raises(RuntimeError):
+        di.sync_event_store(full_refresh=True, batch_size=40)
+    assert len(list(di.iter_stored_events())) == 173
+
+
+def test_stored_events_match_server_search(fake_server):
+    for event in fake_server.events[False][::4]:
+        event['status'] = 'CLOSED'
+    di.sync_event_store()
+    for search in [{}, {'status': ['CLOSED']}, {'status': ['OPEN'], 'device_id': [3, 4]}, {'status': []}]:
+        stored = list(di.iter_stored_events(search=search, minimum_event_id=10))
+        assert stored == list(di.iter_events(search=search, minimum_event_id=10))
+
+
+def test_get_events_uses_event_store(fake_server):
+    assert di.get_events(use_event_store=True) == list(di.iter_events())
+    fake_server.requests.clear()
+    di.get_events(use_event_store=True)
+    #only the request checking for newer events is sent
+    assert len(fake_server.requests) == 1
+
+
+#---bulk event actions---
+
+def test_bulk_event_action_in_quiet_mode_returns_failures_without_printing(fake_server, monkeypatch, capsys):
+    def send_request(method, request_url, **kwargs):
+        fake_server.requests.append((method, request_url, kwargs['json']['ids']))
+        return FakeResponse(method, request_url, status_code=500 if 7 in kwargs['json']['ids'] else 204)
+    monkeypatch.setattr(di, 'send_request', send_request)
+    monkeypatch.setattr(di.time, 'sleep', lambda seconds: None)
+    summary = di.bulk_event_action(list(range(1, 21)), 'close', max_workers=1, initial_batch_size=1, max_batch_size=1, max_attempts=2)
+    assert summary['failed_ids'] == [7]
+    assert summary['succeeded'] == 19
+    assert len([request for request in fake_server.requests if request[2] == [7]]) == 2
+    assert capsys.readouterr().out == ''
+
+
+#---device matching---
+
+# The baseline get_device_ids loops, operating on a list of devices
+def baseline_get_device_ids(devices, search_list, regex_hostname_search=False, cidr_search=False):
+    device_ids = []
+    if regex_hostname_search:
+        for device in devices:
+            for regex in search_list:
+                if re.match(regex, device['hostname']):
+                    if device['id'] not in device_ids:
+                        device_ids.append(device['id'])
+    elif cidr_search:
+        for cidr in search_list:
+            for device in devices:
+                if ipaddress.ip_address(device['ip_address']) in ipaddress.ip_network(cidr):
+                    if device['id'] not in device_ids:
+                        device_ids.append(device['id'])
+    else:
+        for device in devices:
+            if device['hostname'] in search_list:
+                device_ids.append(device['id'])
+    return device_ids
+
+
+@pytest.fixture
+def devices():
+    devices = make_devices(2000)
+    devices[10]['ip_address'] = 'fd00::1'
+    devices[11]['ip_address'] = 'fd00:1::1'
+    devices[12]['ip_address'] = ''
+    return devices
+
+
+@pytest.mark.parametrize('search_list', [
+    ['10.0.0.0/8'],
+    ['10.1.0.0/16', '10.1.2.0/24', '10.2.3.128/25'],
+    ['10.0.1.0/24', '192.168.0.0/16'],
+    ['10.2.0.5/32', 'fd00::/64'],
+    ['172.16.0.0/12'],
+])
+def test_cidr_matching_matches_baseline(devices, search_list):
+    with_ip = [device for device in devices if device['ip_address']]
+    expected = baseline_get_device_ids(with_ip, search_list, cidr_search=True)
+    result = di.match_device_ids(devices, search_list, cidr_search=True)
+    #the baseline orders results by CIDR, match_device_ids by device
+    assert sorted(result) == sorted(expected)
+    assert result == [device['id'] for device in devices if device['id'] in set(expected)]
+
+
+@pytest.mark.parametrize('search_list', [
+    ['HOST-1'],
+    ['HOST-[12]-', 'HOST-3-1'],
+    ['host-4', '(?i)host-5-2'],
+    ['(HOST)-(6)-\\2', '(HOST)-(0)-1\\2'],
+    ['NOPE'],
+])
+def test_regex_matching_matches_baseline(devices, search_list):
+    expected = baseline_get_device_ids(devices, search_list, regex_hostname_search=True)
+    assert di.match_device_ids(devices, search_list, regex_hostname_search=True) == expected
+
+
+def test_hostname_matching_matches_baseline(devices):
+    search_list = ['HOST-1-8', 'HOST-3-10', 'HOST-3-10', 'missing']
+    assert di.match_device_ids(devices, search_list) == baseline_get_device_ids(devices, search_list)
+
+
+def test_get_device_ids_inventory_matches_device_list(fake_server):
+    inventory = di.get_device_inventory()
+    active_devices = [device for device in fake_server.devices if device['license_status'] == 'ACTIVATED']
+    hostnames = [device['hostname'] for device in random.Random(1).sample(active_devices, 20)]
+    for kwargs in [{}, {'regex_hostname_search': True}]:
+        assert di.get_device_ids(hostnames, inventory=inventory, **kwargs) == di.get_device_ids(hostnames, **kwargs)
+        assert di.get_device_ids(hostnames, **kwargs) == baseline_get_device_ids(active_devices, hostnames, **kwargs)
+    cidrs = ['10.1.0.0/24']
+    assert sorted(di.get_device_ids(cidrs, cidr_search=True, inventory=inventory)) == \
+        sorted(baseline_get_device_ids(active_devices, cidrs, cidr_search=True))
+
+
+#---record joins---
+
+def test_join_records_matches_nested_loop():
+    devices = make_devices(300)
+    policies = [{'id': i, 'name': f'Policy {i}', 'prevention_mode': i % 2 == 0} for i in range(1, 5)]
+    expected = [dict(device) for device in devices]
+    for device in expected:
+        for policy in policies:
+            if policy['id'] == device['policy_id']:
+                device['policy_name'] = policy['name']
+                device['in_prevention'] = policy['prevention_mode']
+    result = di.join_records(devices, policies, 'policy_id', {'name': 'policy_name', 'prevention_mode': 'in_prevention'})
+    assert result == expected
+    #devices in policy 5 have no matching policy and are left unchanged
+    assert all('policy_name' not in device for device in result if device['policy_id'] == 5)
+
+
+def test_count_data_by_field_matches_nested_loop():
+    devices = make_devices(300)
+    groups = [{'id': i} for i in range(1, 6)]
+    expected = {}
+    for group in groups:
+        expected[group['id']] = 0
+        for device in devices:
+            if device['group_id'] == group['id']:
+                expected[group['id']] += 1
+    counts = di.count_data_by_field(devices, 'group_id')
+    assert {group['id']: counts.get(group['id'], 0) for group in groups} == expected
@@ -0,0 +1,84 @@
+# Offline tests for poller_daemon: jobs for several servers sharing one worker
+# process must each only ever see their own server's name and API key.
+import multiprocessing, threading, time, urllib.parse
+
+import deepinstinct3 as di
+import poller_daemon
+
+
+servers = [{'fqdn': f'{name}.example.com', 'key': f'KEY-{name.upper()}',
+            'jobs': {'device_connectivity_monitoring': {'interval_in_seconds': 0.05},
+                     'agentless_scan_count_monitoring': {'interval_in_seconds': 0.05}}}
+           for name in ['one', 'two']]
+
+
+def test_jobs_for_two_servers_in_one_worker_never_mix_credentials(fake_server, monkeypatch, tmp_path):
+    for device in fake_server.devices:
+        device.update({'connectivity_status': 'ONLINE', 'os': 'NETWORK_AGENTLESS', 'scanned_files': 1})
+    log_file = tmp_path / 'requests.log'
+    lock = threading.Lock()
+
+    #records the server in the URL and the fqdn and key set at the start and the
+    #end of each request, so that a turn change during a request would show
+    def send_request(method, request_url, **kwargs):
+        seen = [di.fqdn, di.key]
+        time.sleep(0.005)
+        seen += [di.fqdn, di.key]
+        with lock, open(log_file, 'a') as f:
+            f.write(' '.join([urllib.parse.urlsplit(request_url).hostname] + seen) + '\n')
+        return fake_server.send_request(method, request_url, **kwargs)
+    monkeypatch.setattr(di, 'send_request', send_request)
+
+    #run a real worker process (forked, so that it keeps the stub) for both servers
+    worker = multiprocessing.get_context('fork').Process(target=poller_daemon.run_worker, args=(servers,), daemon=True)
+    worker.start()
+    try:
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            lines = log_file.read_text().splitlines() if log_file.exists() else []
+            if all(sum(line.startswith(server['fqdn']) for line in lines) >= 40 for server in servers):
+                break
+    finally:
+        worker.terminate()
+        worker.join()
+
+    keys = {server['fqdn']: server['key'] for server in servers}
+    requests = [line.split() for line in log_file.read_text().splitlines()]
+    assert {request[0] for request in requests} == set(keys)
+    for hostname, fqdn, key, fqdn_after, key_after in requests:
+        assert hostname == fqdn == fqdn_after
+        assert key == key_after == keys[fqdn]
+    #each server's Agentless scan count covers the activated devices (get_devices skips deactivated ones)
+    activated_count = sum(device['license_status'] == 'ACTIVATED' for device in fake_server.devices)
+    for server in servers:
+        counts = (tmp_path / f'current_scanned_file_counts_{server["fqdn"]}.txt').read_text().splitlines()
+        assert counts[0].split('\t')[2] == str(activated_count)
+
+
+def test_server_context_runs_one_server_at_a_time():
+    context = poller_daemon.ServerContext()
+    lock = threading.Lock()
+    active = []
+    overlaps = {'same_server': 0, 'other_server': 0}
+
+    def job(server):
+        with context.use(server):
+            with lock:
+                if any(fqdn != server['fqdn'] for fqdn in active):
+                    overlaps['other_server'] += 1
+                if server['fqdn'] in active:
+                    overlaps['same_server'] += 1
+                active.append(server['fqdn'])
+            time.sleep(0.01)
+            with lock:
+                active.remove(server['fqdn'])
+
+    threads = [threading.Thread(target=job, args=(servers[i % 2],)) for i in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps['other_server'] == 0
+    #jobs for the same server do run together
+    assert overlaps['same_server'] > 0
@@ -0,0 +1,44 @@
+# deepinstinct30.py keeps a copy of the retry policy and circuit breaker from
+# deepinstinct3.py (each wrapper is a standalone file). These tests check that
+# the two copies, including their comments, stay identical.
+import ast, os
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+shared_names = ['max_attempts', 'retry_backoff_in_seconds', 'max_retry_backoff_in_seconds', 'max_retry_after_in_seconds',
+                'retry_status_codes', 'circuit_breaker_threshold', 'circuit_breaker_reset_in_seconds', 'CircuitOpenError',
+                'CircuitBreaker', 'circuit_breakers', 'circuit_breakers_lock', 'get_circuit_breaker', 'get_retry_after',
+                'connection_was_opened', 'send_with_retries', 'check_response']
+
+
+# Returns the source of each top-level definition or assignment in a file by
+# name, together with the comment paragraph directly above it
+def get_definitions(file_name):
+    with open(os.path.join(root, file_name), encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    definitions = {}
+    for node in ast.parse('\n'.join(lines)).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, ast.Assign):
+            names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        else:
+            continue
+        #a line holding just '#' separates comment paragraphs and ends the search
+        start = node.lineno - 1
+        while start > 0 and lines[start - 1].startswith('#') and lines[start - 1] != '#':
+            start -= 1
+        for name in names:
+            definitions[name] = '\n'.join(lines[start:node.end_lineno])
+    return definitions
+
+
+@pytest.mark.parametrize('name', shared_names)
+def test_retry_policy_is_identical_in_deepinstinct3_and_deepinstinct30(name):
+    assert get_definitions('deepinstinct30.py')[name] == get_definitions('deepinstinct3.py')[name]
+
+
+def test_both_wrappers_send_requests_through_send_with_retries():
+    for file_name in ['deepinstinct3.py', 'deepinstinct30.py']:
+        assert 'send_with_retries(' in get_definitions(file_name)['send_request']
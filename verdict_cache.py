@@ -0,0 +1,138 @@
+# Library file which defines a local, persistent cache of scan verdicts keyed by
+# the SHA-256 of the scanned content, used by deepinstinctagentless and icap_DPA
+# so that content which has already been scanned is answered locally and only
+# unseen content is sent to the scanner.
+#
+# Entries expire after ttl_in_seconds, and once the cache holds more than
+# max_entries the least recently used entries are evicted. If scanner_version is
+# set, entries recorded against a different scanner version are treated as
+# misses, so that upgrading the scanner (and its model) invalidates the cache.
+# The last use time of entries read by get() is kept in memory and written to
+# disk with the next put(), on close(), or once flush_every_hits entries are
+# waiting to be written, so that cache hits do not each cost a write to disk.
+#
+# DEEP INSTINCT MAKES NO WARRANTIES OR REPRESENTATIONS REGARDING DEEP INSTINCT’S
+# PROGRAMMING SCRIPTS. TO THE FULLEST EXTENT PERMITTED BY APPLICABLE LAW,
+# DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES, REPRESENTATIONS AND CONDITIONS,
+# WHETHER EXPRESS, STATUTORY, OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, ANY
+# IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE OR
+# NON-INFRINGEMENT, AND ANY WARRANTIES ARISING OUT OF COURSE OF DEALING OR USAGE
+# OF TRADE. DEEP INSTINCT’S PROGRAMMING SCRIPTS ARE PROVIDED ON AN "AS IS" BASIS,
+# WITHOUT WARRANTY OF ANY KIND, AND DEEP INSTINCT DISCLAIMS ALL OTHER WARRANTIES,
+# EXPRESS, IMPLIED OR STATUTORY, INCLUDING ANY IMPLIED WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE, AND NONINFRINGEMENT.
+#
+#
+
+#Import required libraries
+import sqlite3, hashlib, json, time, threading
+
+#Size of the blocks read from disk while hashing a file
+hash_chunk_size = 1024 * 1024
+
+
+#Returns the SHA-256 of a file, reading it in blocks so that memory use is bounded
+def hash_file(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(hash_chunk_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+#Returns the SHA-256 of content already in memory
+def hash_content(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class VerdictCache:
+
+    def __init__(self, path='verdict_cache.sqlite', ttl_in_seconds=7*24*60*60, max_entries=1000000, scanner_version=None, flush_every_hits=1000):
+        self.path = path
+        self.ttl_in_seconds = ttl_in_seconds
+        self.max_entries = max_entries
+        self.scanner_version = scanner_version
+        self.flush_every_hits = flush_every_hits
+        self.pending_last_used = {} #(file_hash, source): last use time not yet written to disk
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS verdicts (
+                                       file_hash TEXT NOT NULL,
+                                       source TEXT NOT NULL,
+                                       verdict TEXT,
+                                       scan_guid TEXT,
+                                       scanner_version TEXT,
+                                       scanned_at REAL NOT NULL,
+                                       last_used_at REAL NOT NULL,
+                                       raw_verdict TEXT NOT NULL,
+                                       PRIMARY KEY (file_hash, source))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS verdicts_last_used_at ON verdicts (last_used_at)')
+        self.connection.commit()
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.flush_last_used()
+            self.connection.commit()
+            self.connection.close()
+
+    #returns the cached raw verdict for file_hash from the given source, or None on a miss
+    def get(self, file_hash, source='agentless'):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT raw_verdict, scanner_version, scanned_at FROM verdicts WHERE file_hash = ? AND source = ?',
+                                          (file_hash, source)).fetchone()
+            if row is None or (self.ttl_in_seconds and now - row[2] > self.ttl_in_seconds) or \
+                    (self.scanner_version is not None and row[1] != self.scanner_version):
+                self.misses += 1
+                return None
+            self.pending_last_used[(file_hash, source)] = now
+            if len(self.pending_last_used) >= self.flush_every_hits:
+                self.flush_last_used()
+                self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    #stores raw_verdict (the verdict as returned by the scanner) along with its simplified verdict and scan_guid
+    def put(self, file_hash, raw_verdict, source='agentless', verdict=None, scan_guid=None):
+        now = time.time()
+        with self.lock:
+            self.flush_last_used()
+            cursor = self.connection.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                             (file_hash, source, verdict, scan_guid, self.scanner_version, now, now, json.dumps(raw_verdict)))
+            self.entry_count += cursor.rowcount #replacements are also counted; corrected on eviction
+            if self.max_entries and self.entry_count > self.max_entries:
+                self.evict()
+            self.connection.commit()
+
+    #writes the pending last use times to the database, without committing (called with lock held)
+    def flush_last_used(self):
+        if self.pending_last_used:
+            self.connection.executemany('UPDATE verdicts SET last_used_at = ? WHERE file_hash = ? AND source = ?',
+                                        [(last_used_at, file_hash, source) for (file_hash, source), last_used_at in self.pending_last_used.items()])
+            self.pending_last_used.clear()
+
+    #removes expired entries, then the least recently used entries down to 90% of max_entries (called with lock held)
+    def evict(self):
+        if self.ttl_in_seconds:
+            self.connection.execute('DELETE FROM verdicts WHERE scanned_at < ?', (time.time() - self.ttl_in_seconds,))
+        self.connection.execute('''DELETE FROM verdicts WHERE rowid IN (
+                                       SELECT rowid FROM verdicts ORDER BY last_used_at LIMIT
+                                       MAX(0, (SELECT COUNT(*) FROM verdicts) - ?))''', (int(self.max_entries * 0.9),))
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': self.entry_count,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None}
@@ -28,15 +28,11 @@ def do_warranty_compliance_check(fqdn, key, exclude_empty_policies):
     devices = di.get_devices(include_deactivated=False)
 
     # Calculate device_count for each policy (how many active devices in policy)
-    # Add device_countfield with initial value zero
+    # Count devices by policy_id in one pass, then look up each policy's count
     print('INFO: Calculating device count for each policy')
+    device_counts = di.count_data_by_field(devices, 'policy_id')
     for policy in policies:
-        policy['device_count'] = 0
-    # Iterate through devices and policies, incrementing device_count appropriately
-    for device in devices:
-        for policy in policies:
-            if policy['id'] == device['policy_id']:
-                policy['device_count'] +=1
+        policy['device_count'] = device_counts.get(policy['id'], 0)
 
     if exclude_empty_policies:
         print('INFO: Narrowing policy list to include only those which contain 1 or more activated devices')